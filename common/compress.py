@@ -0,0 +1,266 @@
+"""
+Optional zstd compression of image data for kubeauto
+
+Compressed data is written in the zstd seekable format: independent frames of FRAME_SIZE
+bytes followed by a seek table. Frames are compressed and decompressed on several threads,
+and a member of a compressed tarball is read without decompressing what precedes it.
+The zstandard package is optional, plain data is read and written without it.
+"""
+import bisect
+import os
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Iterator, List, Optional, Tuple
+
+from .exceptions import CompressionError
+from .utils import iter_file_chunks
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct("<IBI")
+FRAME_SIZE = 8 * 1024 * 1024
+
+
+def zstd_available() -> bool:
+    return zstandard is not None
+
+
+def _require_zstd() -> None:
+    if zstandard is None:
+        raise CompressionError("zstd data needs the zstandard package: pip install zstandard")
+
+
+def _workers(workers: Optional[int]) -> int:
+    return workers or os.cpu_count() or 1
+
+
+def is_zstd(path: Path | str) -> bool:
+    """True when path holds zstd data, whatever its name"""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    return magic == ZSTD_MAGIC or magic == struct.pack("<I", SKIPPABLE_MAGIC)
+
+
+class ZstdWriter:
+    """
+    File-like writer compressing into independent zstd frames, FRAME_SIZE bytes of input each
+
+    Frames are compressed on a thread pool (zstd releases the GIL) and written in order,
+    at most 2 frames per worker are in flight. close() appends the seek table.
+    """
+
+    def __init__(self, fileobj: IO[bytes], level: int = 3, workers: Optional[int] = None,
+                 frame_size: int = FRAME_SIZE, pool: Optional[ThreadPoolExecutor] = None):
+        _require_zstd()
+        self._file = fileobj
+        self._level = level
+        self._workers = _workers(workers)
+        self._frame_size = frame_size
+        # a pool given by the caller is shared between writers and left running on close
+        self._own_pool = pool is None
+        self._pool = pool or ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="zstd")
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._table: List[Tuple[int, int]] = []
+        self._closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __enter__(self) -> "ZstdWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self._frame_size:
+            self._submit(bytes(self._buffer[:self._frame_size]))
+            del self._buffer[:self._frame_size]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        self._pending.append((len(block), self._pool.submit(self._compress, block)))
+        while len(self._pending) > self._workers * 2:
+            self._drain_one()
+
+    def _compress(self, block: bytes) -> bytes:
+        # compressor objects are not thread-safe, one per frame is cheap
+        return zstandard.ZstdCompressor(level=self._level).compress(block)
+
+    def _drain_one(self) -> None:
+        size, future = self._pending.popleft()
+        frame = future.result()
+        self._file.write(frame)
+        self._table.append((len(frame), size))
+        self.bytes_out += len(frame)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._drain_one()
+
+            entries = b"".join(struct.pack("<II", c, d) for c, d in self._table)
+            footer = SEEK_TABLE_FOOTER.pack(len(self._table), 0, SEEKABLE_MAGIC)
+            seek_table = struct.pack("<II", SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer
+            self._file.write(seek_table)
+            self.bytes_out += len(seek_table)
+        finally:
+            if self._own_pool:
+                self._pool.shutdown(wait=True)
+
+
+class ZstdSeekableReader:
+    """Read-only, seekable view of the decompressed content of a file written by ZstdWriter"""
+
+    def __init__(self, path: Path | str):
+        _require_zstd()
+        self.path = Path(path)
+        self._file = open(self.path, "rb")
+        try:
+            self._frames = self._read_seek_table()
+        except Exception:
+            self._file.close()
+            raise
+        self._starts = [frame[2] for frame in self._frames]
+        self.size = self._frames[-1][2] + self._frames[-1][3] if self._frames else 0
+        self._pos = 0
+        self._cached: Tuple[int, bytes] = (-1, b"")
+
+    def _read_seek_table(self) -> List[Tuple[int, int, int, int]]:
+        """return frames as (compressed offset, compressed size, offset, size)"""
+        try:
+            self._file.seek(-SEEK_TABLE_FOOTER.size, os.SEEK_END)
+            count, descriptor, magic = SEEK_TABLE_FOOTER.unpack(self._file.read(SEEK_TABLE_FOOTER.size))
+            if magic != SEEKABLE_MAGIC:
+                raise CompressionError(f"{self.path} is zstd but has no seek table")
+            entry_size = 12 if descriptor & 0x80 else 8
+            self._file.seek(-(count * entry_size + SEEK_TABLE_FOOTER.size), os.SEEK_END)
+            table = self._file.read(count * entry_size)
+        except (OSError, struct.error) as e:
+            raise CompressionError(f"Failed to read the seek table of {self.path}: {e}")
+
+        frames = []
+        compressed_offset = offset = 0
+        for i in range(count):
+            compressed, size = struct.unpack_from("<II", table, i * entry_size)
+            frames.append((compressed_offset, compressed, offset, size))
+            compressed_offset += compressed
+            offset += size
+        return frames
+
+    def _frame(self, index: int) -> bytes:
+        if self._cached[0] != index:
+            compressed_offset, compressed, _, size = self._frames[index]
+            self._file.seek(compressed_offset)
+            data = zstandard.ZstdDecompressor().decompress(self._file.read(compressed), max_output_size=size)
+            self._cached = (index, data)
+        return self._cached[1]
+
+    def read(self, n: int = -1) -> bytes:
+        end = self.size if n is None or n < 0 else min(self.size, self._pos + n)
+        parts = []
+        while self._pos < end:
+            index = bisect.bisect_right(self._starts, self._pos) - 1
+            data = self._frame(index)
+            start = self._pos - self._frames[index][2]
+            part = data[start:start + end - self._pos]
+            parts.append(part)
+            self._pos += len(part)
+        return b"".join(parts)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self.size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "ZstdSeekableReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def iter_frames(self, workers: Optional[int] = None) -> Iterator[bytes]:
+        """Decompressed frames in order, decompressed on a thread pool"""
+        workers = _workers(workers)
+
+        def decompress(frame: Tuple[int, int, int, int], compressed: bytes) -> bytes:
+            return zstandard.ZstdDecompressor().decompress(compressed, max_output_size=frame[3])
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="unzstd") as pool:
+            pending = deque()
+            for frame in self._frames:
+                self._file.seek(frame[0])
+                pending.append(pool.submit(decompress, frame, self._file.read(frame[1])))
+                while len(pending) > workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def iter_zstd_stream(fileobj: IO[bytes], chunk_size: int) -> Iterator[bytes]:
+    """Decompress zstd data read sequentially from fileobj, seek tables and other skippable frames are ignored"""
+    _require_zstd()
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True, closefd=False) as reader:
+            yield from iter(lambda: reader.read(chunk_size), b"")
+    except zstandard.ZstdError as e:
+        raise CompressionError(f"Corrupt zstd data: {e}")
+
+
+def open_archive_file(path: Path | str, compressed: Optional[bool] = None) -> IO[bytes]:
+    """
+    Open a possibly zstd-compressed file as seekable decompressed bytes
+
+    compressed None sniffs the content, callers knowing how they wrote the file say so.
+    """
+    if is_zstd(path) if compressed is None else compressed:
+        return ZstdSeekableReader(path)
+    return open(path, "rb")
+
+
+def iter_decompressed(path: Path | str, chunk_size: int, workers: Optional[int] = None,
+                      compressed: Optional[bool] = None) -> Iterator[bytes]:
+    """Yield the content of a possibly zstd-compressed file (sniffed unless compressed says), plain files as they are"""
+    if not (is_zstd(path) if compressed is None else compressed):
+        yield from iter_file_chunks(path, chunk_size)
+        return
+
+    _require_zstd()
+    try:
+        with ZstdSeekableReader(path) as reader:
+            yield from reader.iter_frames(workers)
+        return
+    except CompressionError:
+        pass
+
+    # zstd written by another tool, no seek table: single-threaded stream
+    with open(path, "rb") as f, zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as reader:
+        yield from iter(lambda: reader.read(chunk_size), b"")
@@ -1,5 +1,7 @@
+import platform
 from dataclasses import dataclass, field
-from common.os import SystemProbe
+from functools import cached_property
+from pathlib import Path
 
 
 @dataclass
@@ -100,6 +102,9 @@ class KubeConstant:
     EXTRA_BIN_DIR: str = field(default="/usr/local/kubeauto/extra-bin", metadata={
         "description": "This path stores extra binaries"
     })
+    RELEASES_DIR: str = field(default="/usr/local/kubeauto/.releases", metadata={
+        "description": "This path keeps every installed version of kube-bin and extra-bin, the active one is symlinked"
+    })
     DOCKER_BIN_DIR: str = field(default="/usr/local/kubeauto/docker-bin", metadata={
         "description": "This path stores docker binaries"
     })
@@ -115,18 +120,117 @@ class KubeConstant:
         "description": "This path stores app data"
     })
 
+    # chunk size for streaming image tarballs between disk and the docker engine
+    IMAGE_CHUNK_SIZE: int = field(default=4 * 1024 * 1024, metadata={
+        "description": "Fixed chunk size in bytes, peak memory of image load/save is bounded by it"
+    })
+
+    IMAGE_COMPRESSION: str = field(default="zstd", metadata={
+        "description": "zstd or none, compression of stored images (zstd needs the optional zstandard package)"
+    })
+    IMAGE_COMPRESSION_LEVEL: int = field(default=3, metadata={
+        "description": "zstd level of stored images, 3 is about as fast as the disk"
+    })
+    COMPRESSION_WORKERS: int = field(default=0, metadata={
+        "description": "Threads compressing/decompressing zstd frames, 0 means one per CPU"
+    })
+
+    # local registry serving images to the cluster nodes
+    LOCAL_REGISTRY: str = field(default="registry.talkschool.cn:5000", metadata={
+        "description": "Address of the local registry started by kubeauto"
+    })
+    REGISTRY_CONCURRENCY: int = field(default=4, metadata={
+        "description": "Max images pulled and pushed at the same time when uploading to the local registry"
+    })
+    REGISTRY_RETRIES: int = field(default=3, metadata={
+        "description": "Attempts per image for each pull or push"
+    })
+    REGISTRY_RETRY_BACKOFF: float = field(default=2.0, metadata={
+        "description": "Base seconds of the exponential backoff between attempts"
+    })
+
+    # mirrors of the docker static binaries, raced against each other to pick the fastest
+    DOCKER_MIRRORS: tuple = field(default=(
+        "https://mirrors.aliyun.com/docker-ce",
+        "https://mirrors.tuna.tsinghua.edu.cn/docker-ce",
+        "https://mirrors.ustc.edu.cn/docker-ce",
+        "https://download.docker.com",
+    ), metadata={
+        "description": "Base urls serving linux/static/stable/<arch>/docker-<version>.tgz"
+    })
+    DOWNLOAD_SEGMENTS: int = field(default=4, metadata={
+        "description": "HTTP range segments fetched in parallel per file"
+    })
+    DOWNLOAD_WORKERS: int = field(default=4, metadata={
+        "description": "Components of `download --all` fetched at the same time once docker is up"
+    })
+    DOWNLOAD_TIMEOUT: int = field(default=30, metadata={
+        "description": "Socket timeout in seconds of every download request"
+    })
+
+    # size budget of IMAGE_DIR, least recently used artifacts no cluster needs are evicted first
+    CACHE_BUDGET_GB: float = field(default=20.0, metadata={
+        "description": "Max size of the download cache (stored images, docker tarballs) in GB, 0 means no limit"
+    })
+    CACHE_MAX_AGE_DAYS: int = field(default=0, metadata={
+        "description": "Evict unpinned artifacts unused for that many days even under the budget, 0 disables it"
+    })
+
+    # ansible settings are sized per run from the inventory and the controller, see core/tuning.py
+    ANSIBLE_FORKS: int = field(default=50, metadata={
+        "description": "Upper bound of the forks computed for a run, whatever the hosts and controller allow"
+    })
+    SETUP_CONCURRENCY: int = field(default=4, metadata={
+        "description": "Max stages of 'setup all' running at the same time, each as its own ansible-playbook"
+    })
+    FACT_CACHE_TTL: int = field(default=86400, metadata={
+        "description": "Seconds the facts of a host are reused from clusters/<name>/facts/ by later playbook "
+                       "runs, 0 disables the cache"
+    })
+    ANSIBLE_PROFILE: str = field(default="safe", metadata={
+        "description": "Execution profile of playbooks: safe (linear, all facts) or fast (free strategy where "
+                       "possible, minimal facts, long-lived ssh connections)"
+    })
+    PROFILE_RUNS_KEEP: int = field(default=100, metadata={
+        "description": "Recorded playbook runs kept per cluster in clusters/<name>/runs for `kubeauto profile`"
+    })
+    DRAIN_CONCURRENCY: int = field(default=5, metadata={
+        "description": "Nodes of `del-node IP1 IP2 ...` drained at the same time"
+    })
+    DRAIN_TIMEOUT: int = field(default=300, metadata={
+        "description": "Seconds a node may take to drain before it is reported failed and left in the cluster"
+    })
+
     # path specifically for storing temporary files removed after copied to somewhere
     TEMP_PATH: str = field(default="/tmp", metadata={
         "description": "This path stores temporary binaries"
     })
 
-    def __post_init__(self):
-        """用于 @dataclass 自动生成的 __init__ 后执行额外逻辑"""
-        self.arch = SystemProbe().system_info["machine"]
+    @cached_property
+    def arch(self) -> str:
+        """machine arch, resolved on first use instead of on every construction"""
+        return platform.machine()
 
-    def docker_bin_url(self, version):
-        url = f"https://mirrors.aliyun.com/docker-ce/linux/static/stable/{self.arch}/docker-{version}.tgz"
-        return url
+    def kept_items(self):
+        """Top-level items of BASE_PATH a kubeauto install never replaces: the clusters and the other bundles"""
+        base_path = Path(self.BASE_PATH)
+        dirs = (self.IMAGE_DIR, self.KUBE_BIN_DIR, self.EXTRA_BIN_DIR, self.RELEASES_DIR, self.DOCKER_BIN_DIR)
+        return {"clusters"} | {Path(d).name for d in dirs if Path(d).parent == base_path}
+
+    def docker_bin_urls(self, version):
+        return [f"{mirror}/linux/static/stable/{self.arch}/docker-{version}.tgz" for mirror in self.DOCKER_MIRRORS]
+
+    @property
+    def default_images(self):
+        return [
+            f"calico/cni:{self.v_calico}",
+            f"calico/kube-controllers:{self.v_calico}",
+            f"calico/node:{self.v_calico}",
+            f"coredns/coredns:{self.v_coredns}",
+            f"brinnatt/k8s-dns-node-cache:{self.v_dnsnodecache}",
+            f"brinnatt/metrics-server:{self.v_metricsserver}",
+            f"brinnatt/pause:{self.v_pause}"
+        ]
 
     @property
     def component_images(self):
@@ -0,0 +1,119 @@
+"""
+Dependency graph scheduler for kubeauto
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional
+
+from .exceptions import KubeautoError
+from .logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+@dataclass
+class DagTask:
+    """A node of the graph and, once run, its timing"""
+    name: str
+    func: Callable[[], None]
+    deps: tuple = ()
+    status: str = "pending"
+    start: float = 0.0
+    end: float = 0.0
+    error: str = ""
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class TaskGraph:
+    """
+    Run callables as soon as their dependencies are done, on a bounded worker pool
+
+    Tasks are added after their dependencies, which keeps the graph acyclic. When a task
+    fails, the tasks depending on it (directly or not) are skipped, the others still run.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self.tasks: Dict[str, DagTask] = {}
+        self._origin = 0.0
+
+    def add(self, name: str, func: Callable[[], None], deps: Iterable[str] = ()) -> None:
+        deps = tuple(deps)
+        if name in self.tasks:
+            raise KubeautoError(f"Task {name} added twice")
+        unknown = [dep for dep in deps if dep not in self.tasks]
+        if unknown:
+            raise KubeautoError(f"Task {name} depends on unknown tasks: {', '.join(unknown)}")
+        self.tasks[name] = DagTask(name=name, func=func, deps=deps)
+
+    def run(self) -> List[DagTask]:
+        """Run the whole graph, return the failed tasks"""
+        self._origin = time.monotonic()
+        running: Dict[Future, DagTask] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dag") as pool:
+            while True:
+                for task in self.tasks.values():
+                    if task.status != "pending":
+                        continue
+                    dep_status = {self.tasks[dep].status for dep in task.deps}
+                    if dep_status & {"failed", "skipped"}:
+                        task.status = "skipped"
+                        logger.warning(f"Skip {task.name}, a task it depends on did not complete")
+                    elif dep_status <= {"done"}:
+                        task.status = "running"
+                        running[pool.submit(self._run_task, task)] = task
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+
+        return [task for task in self.tasks.values() if task.status == "failed"]
+
+    def _run_task(self, task: DagTask) -> None:
+        task.start = time.monotonic()
+        try:
+            task.func()
+            task.status = "done"
+        except Exception as e:
+            task.status = "failed"
+            task.error = str(e)
+            logger.error(f"{task.name} failed: {e}")
+        finally:
+            task.end = time.monotonic()
+
+    def critical_path(self) -> List[DagTask]:
+        """Chain of tasks bounding the total time: from the last task to finish, back through its latest dependency"""
+        finished = [t for t in self.tasks.values() if t.status in ("done", "failed")]
+        if not finished:
+            return []
+
+        path = [max(finished, key=lambda t: t.end)]
+        while True:
+            deps = [self.tasks[dep] for dep in path[-1].deps if self.tasks[dep].end]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda t: t.end))
+        return path[::-1]
+
+    def report(self, title: Optional[str] = None) -> None:
+        """Log when each task ran and the critical path"""
+        critical = {t.name for t in self.critical_path()}
+        wall = max((t.end for t in self.tasks.values()), default=self._origin) - self._origin
+
+        if title:
+            logger.info(title, extra={"to_stdout": True})
+        logger.info(f"  {'TASK':<20} {'START(s)':>9} {'TIME(s)':>9}  STATUS", extra={"to_stdout": True})
+        for task in sorted(self.tasks.values(), key=lambda t: (t.start or float("inf"), t.name)):
+            started = task.start - self._origin if task.start else 0.0
+            logger.info(f"{'*' if task.name in critical else ' '} {task.name:<20} {started:>9.1f} "
+                        f"{task.duration:>9.1f}  {task.status}", extra={"to_stdout": True})
+
+        chain = " -> ".join(f"{t.name} ({t.duration:.1f}s)" for t in self.critical_path())
+        logger.info(f"Critical path: {chain or '-'}, {wall:.1f}s wall", extra={"to_stdout": True})
@@ -45,3 +45,15 @@ class SystemExecutionError(KubeautoError):
 class CommandExecutionError(KubeautoError):
     """Command execution failed"""
     pass
+
+class ImageArchiveError(KubeautoError):
+    """Image tarball unreadable or malformed"""
+    pass
+
+class RegistryError(KubeautoError):
+    """Registry API request failed"""
+    pass
+
+class CompressionError(KubeautoError):
+    """Compressed data unreadable or compression unavailable"""
+    pass
@@ -0,0 +1,293 @@
+"""
+Parallel, resumable and checksum-verified HTTP downloads for kubeauto
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from .constants import KubeConstant
+from .exceptions import DownloadError
+from .logger import setup_logger
+from .utils import transfer_report
+
+logger = setup_logger(__name__)
+
+PROBE_BYTES = 256 * 1024
+MIN_SEGMENT_BYTES = 1024 * 1024
+STATE_SAVE_BYTES = 8 * 1024 * 1024
+READ_BYTES = 1024 * 1024
+RACE_GRACE_SECONDS = 2.0
+
+
+@dataclass
+class MirrorProbe:
+    """Result of probing one mirror for a file"""
+    url: str
+    size: int = 0
+    ranges: bool = False
+    etag: str = ""
+    seconds: float = 0.0
+
+
+@dataclass
+class Segment:
+    """Byte range [start, end] of the file, done bytes already written from start"""
+    start: int
+    end: int
+    done: int = 0
+
+    @property
+    def offset(self) -> int:
+        return self.start + self.done
+
+    @property
+    def remaining(self) -> int:
+        return self.end - self.start + 1 - self.done
+
+
+class HttpDownloader:
+    """
+    Download a file from the fastest of several mirrors
+
+    The mirrors are raced with a small ranged request, then the file is fetched as parallel
+    HTTP range segments into <dest>.part. Progress is kept in <dest>.part.json, so an
+    interrupted download resumes where it stopped. The SHA-256 of the result is checked
+    against the expected one (or the one recorded in <dest>.sha256 by an earlier download).
+    A copy with no checksum to compare with is kept when it has the size the mirrors announce,
+    or when no mirror is reachable at all, as on air-gapped hosts.
+    """
+
+    def __init__(self, segments: Optional[int] = None, timeout: Optional[int] = None,
+                 retries: Optional[int] = None):
+        self.kube_constant = KubeConstant()
+        self.segments = segments or self.kube_constant.DOWNLOAD_SEGMENTS
+        self.timeout = timeout or self.kube_constant.DOWNLOAD_TIMEOUT
+        self.retries = retries or self.kube_constant.REGISTRY_RETRIES
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def file_sha256(path: Path) -> str:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(READ_BYTES), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def fetch(self, urls: List[str], dest: Path | str, sha256: Optional[str] = None) -> Path:
+        """Download dest from urls unless a verified copy already exists, return dest"""
+        dest = Path(dest)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        checksum_file = dest.with_name(dest.name + ".sha256")
+        part = dest.with_name(dest.name + ".part")
+        state_file = dest.with_name(dest.name + ".part.json")
+
+        expected = sha256 or (checksum_file.read_text().split()[0] if checksum_file.exists() else None)
+        if dest.exists() and expected:
+            if self.file_sha256(dest) == expected:
+                logger.warning(f"{dest.name} exists already and its checksum is verified", extra={"to_stdout": True})
+                return dest
+            logger.warning(f"{dest.name} does not match its checksum, downloading again", extra={"to_stdout": True})
+            dest.unlink()
+
+        try:
+            mirrors = self._race(urls)
+        except DownloadError:
+            if not dest.exists():
+                raise
+            # offline with a copy placed by hand and no checksum to compare with: trust it from now on
+            checksum_file.write_text(f"{self.file_sha256(dest)}  {dest.name}\n")
+            logger.warning(f"{dest.name} exists already, no mirror reachable to check its size",
+                           extra={"to_stdout": True})
+            return dest
+        best = mirrors[0]
+
+        if dest.exists():
+            # no checksum to compare with: a copy of the right size is kept, a truncated one is not
+            if dest.stat().st_size == best.size:
+                checksum_file.write_text(f"{self.file_sha256(dest)}  {dest.name}\n")
+                logger.warning(f"{dest.name} exists already", extra={"to_stdout": True})
+                return dest
+            logger.warning(f"{dest.name} is truncated, downloading again", extra={"to_stdout": True})
+            dest.unlink()
+
+        start = time.monotonic()
+        if best.ranges and best.size:
+            segments = self._load_state(state_file, part, best) or self._plan(best.size)
+            resumed = sum(s.done for s in segments)
+            if resumed:
+                logger.info(f"Resuming {dest.name} at {resumed / 1024 ** 2:.1f} MB", extra={"to_stdout": True})
+            self._fetch_segments(mirrors, part, segments, state_file, best)
+        else:
+            resumed = 0
+            self._fetch_whole(mirrors, part)
+
+        digest = self.file_sha256(part)
+        if sha256 and digest != sha256:
+            part.unlink()
+            state_file.unlink(missing_ok=True)
+            raise DownloadError(f"Checksum mismatch for {dest.name}: expected {sha256}, got {digest}")
+
+        os.replace(part, dest)
+        state_file.unlink(missing_ok=True)
+        checksum_file.write_text(f"{digest}  {dest.name}\n")
+        logger.info(transfer_report("Downloaded", dest.name, dest.stat().st_size - resumed,
+                                    time.monotonic() - start), extra={"to_stdout": True})
+        return dest
+
+    def _race(self, urls: List[str]) -> List[MirrorProbe]:
+        """Probe all mirrors at once, return the usable ones, fastest first"""
+        pool = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="mirror")
+        pending = {pool.submit(self._probe, url): url for url in urls}
+        probes: List[MirrorProbe] = []
+        deadline = None
+        try:
+            while pending:
+                timeout = self.timeout if deadline is None else max(deadline - time.monotonic(), 0)
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    url = pending.pop(future)
+                    try:
+                        probes.append(future.result())
+                    except (OSError, ValueError, DownloadError) as e:
+                        logger.debug(f"Mirror {url} unusable: {e}")
+                # once one mirror answered, the others get a short grace period to be kept as fallbacks
+                if probes and deadline is None:
+                    deadline = time.monotonic() + RACE_GRACE_SECONDS
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        if not probes:
+            raise DownloadError(f"No mirror reachable: {', '.join(urls)}")
+
+        probes.sort(key=lambda p: p.seconds)
+        best = probes[0]
+        for probe in probes:
+            logger.debug(f"Mirror {probe.url}: {probe.seconds * 1000:.0f} ms, ranges={probe.ranges}")
+        logger.info(f"Fastest mirror: {best.url} ({best.seconds * 1000:.0f} ms)", extra={"to_stdout": True})
+        # fallbacks must serve the very same file
+        return [p for p in probes if p.size == best.size and p.ranges == best.ranges]
+
+    def _probe(self, url: str) -> MirrorProbe:
+        start = time.monotonic()
+        request = urllib.request.Request(url, headers={"Range": f"bytes=0-{PROBE_BYTES - 1}"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            probe = MirrorProbe(url=url, etag=resp.headers.get("ETag", ""))
+            if resp.status == 206:
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                if not total.isdigit():
+                    raise DownloadError(f"Unexpected Content-Range from {url}")
+                probe.size, probe.ranges = int(total), True
+            else:
+                probe.size = int(resp.headers.get("Content-Length") or 0)
+            resp.read(PROBE_BYTES)
+        probe.seconds = time.monotonic() - start
+        return probe
+
+    def _plan(self, size: int) -> List[Segment]:
+        count = max(1, min(self.segments, size // MIN_SEGMENT_BYTES))
+        step = -(-size // count)
+        return [Segment(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+    @staticmethod
+    def _load_state(state_file: Path, part: Path, best: MirrorProbe) -> Optional[List[Segment]]:
+        """Segments of an interrupted download of the same file, None if there is nothing to resume"""
+        if not state_file.exists() or not part.exists():
+            return None
+        try:
+            state = json.loads(state_file.read_text())
+            if state["size"] != best.size or (state["etag"] and best.etag and state["etag"] != best.etag):
+                return None
+            return [Segment(**s) for s in state["segments"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def _save_state(state_file: Path, best: MirrorProbe, segments: List[Segment]) -> None:
+        tmp = state_file.with_name(state_file.name + ".tmp")
+        tmp.write_text(json.dumps({"size": best.size, "etag": best.etag,
+                                   "segments": [asdict(s) for s in segments]}))
+        os.replace(tmp, state_file)
+
+    def _fetch_segments(self, mirrors: List[MirrorProbe], part: Path, segments: List[Segment],
+                        state_file: Path, best: MirrorProbe) -> None:
+        if not part.exists() or part.stat().st_size != best.size:
+            with open(part, "wb") as f:
+                f.truncate(best.size)
+
+        unsaved = 0
+
+        def progress(nbytes: int) -> None:
+            nonlocal unsaved
+            with self._lock:
+                unsaved += nbytes
+                if unsaved >= STATE_SAVE_BYTES:
+                    self._save_state(state_file, best, segments)
+                    unsaved = 0
+
+        todo = [s for s in segments if s.remaining]
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(todo), 1), thread_name_prefix="segment") as pool:
+                futures = [pool.submit(self._fetch_segment, mirrors, i, part, s, progress)
+                           for i, s in enumerate(todo)]
+                for future in futures:
+                    future.result()
+        finally:
+            with self._lock:
+                self._save_state(state_file, best, segments)
+
+    def _fetch_segment(self, mirrors: List[MirrorProbe], index: int, part: Path, segment: Segment,
+                       progress: Callable[[int], None]) -> None:
+        """Fetch one segment, moving to the next mirror after a failure"""
+        error = None
+        for attempt in range(self.retries):
+            mirror = mirrors[(index + attempt) % len(mirrors)] if attempt else mirrors[0]
+            request = urllib.request.Request(mirror.url, headers={"Range": f"bytes={segment.offset}-{segment.end}"})
+            try:
+                # unbuffered writes: whatever `done` counts is in the file if the process is killed
+                with urllib.request.urlopen(request, timeout=self.timeout) as resp, \
+                        open(part, "r+b", buffering=0) as f:
+                    if resp.status != 206:
+                        raise DownloadError(f"{mirror.url} ignored the range request")
+                    f.seek(segment.offset)
+                    while segment.remaining:
+                        chunk = resp.read(min(READ_BYTES, segment.remaining))
+                        if not chunk:
+                            raise DownloadError(f"{mirror.url} closed the connection early")
+                        f.write(chunk)
+                        segment.done += len(chunk)
+                        progress(len(chunk))
+                return
+            except (OSError, urllib.error.URLError, DownloadError) as e:
+                error = e
+                logger.warning(f"Segment {segment.start}-{segment.end} from {mirror.url} failed "
+                               f"(attempt {attempt + 1}/{self.retries}): {e}")
+                time.sleep(min(2 ** attempt, 10))
+        raise DownloadError(f"Failed to download bytes {segment.start}-{segment.end}: {error}")
+
+    def _fetch_whole(self, mirrors: List[MirrorProbe], part: Path) -> None:
+        """Plain sequential download for servers without range support"""
+        error = None
+        for attempt in range(self.retries):
+            mirror = mirrors[attempt % len(mirrors)]
+            try:
+                with urllib.request.urlopen(mirror.url, timeout=self.timeout) as resp, open(part, "wb") as f:
+                    for chunk in iter(lambda: resp.read(READ_BYTES), b""):
+                        f.write(chunk)
+                if mirror.size and part.stat().st_size != mirror.size:
+                    raise DownloadError(f"{mirror.url} closed the connection early")
+                return
+            except (OSError, urllib.error.URLError, DownloadError) as e:
+                error = e
+                logger.warning(f"Download from {mirror.url} failed (attempt {attempt + 1}/{self.retries}): {e}")
+                time.sleep(min(2 ** attempt, 10))
+        raise DownloadError(f"Failed to download {mirrors[0].url}: {error}")
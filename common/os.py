@@ -1,7 +1,4 @@
 import platform
-import psutil
-import distro
-import paramiko
 import subprocess
 import getpass
 from .logger import setup_logger
@@ -30,6 +27,8 @@ class SystemProbe:
         }
 
         if info['os'] == 'Linux':
+            import distro
+
             info.update({
                 'distro': distro.name(pretty=True),
                 'distro_version': distro.version(),
@@ -41,6 +40,8 @@ class SystemProbe:
     @staticmethod
     def disk_usage() -> Generator[Dict[str, Union[str, float]], None, None]:
         """get each mount point disk usage"""
+        import psutil
+
         for part in psutil.disk_partitions(all=False):
             usage = psutil.disk_usage(part.mountpoint)
             yield {
@@ -56,6 +57,8 @@ class SystemProbe:
     @staticmethod
     def network_interfaces() -> Generator[Dict[str, Union[str, Dict[str, str], Dict[str, float]]], None, None]:
         """get network interfaces info"""
+        import psutil
+
         net_stats = psutil.net_io_counters(pernic=True)
 
         # default value format
@@ -92,6 +95,8 @@ class SystemProbe:
     @staticmethod
     def hardware_resources() -> Dict[str, Union[int, float]]:
         """get cpu mem swap info"""
+        import psutil
+
         cpu_usage = psutil.cpu_percent(interval=0.2)
         mem = psutil.virtual_memory()
         swap = psutil.swap_memory()
@@ -128,6 +133,8 @@ class SystemProbe:
         Returns:
             Dictionary with host IPs as keys and status messages as values
         """
+        import paramiko
+
         # Generate or load public key
         private_key_path = Path.home() / ".ssh" / "id_rsa"
         if not private_key_path.exists():
@@ -4,7 +4,9 @@ Utility functions for kubeauto
 import subprocess
 import shutil
 import ipaddress
-from typing import List
+import re
+import resource
+from typing import Dict, Iterator, List
 from pathlib import Path
 from .logger import setup_logger
 from .exceptions import CommandExecutionError
@@ -56,6 +58,60 @@ def rmrf(path: Path) -> None:
         raise CommandExecutionError(f"Failed to remove {path}: {e}")
 
 
+def within(root: Path, path: Path) -> bool:
+    """Whether path stays inside root once `..` and the symlinks already on disk are resolved"""
+    root, path = root.resolve(), path.resolve()
+    return path == root or root in path.parents
+
+
+def safe_member(root: Path, rel: str, linkname: str = "") -> Path:
+    """
+    root / rel for a member of an archive, ValueError when it (or its symlink target) would leave root
+
+    Only the parent of the member is resolved: the member itself is about to be replaced.
+    """
+    target = root / rel
+    if Path(rel).is_absolute() or target.name in ("", ".", "..") or not within(root, target.parent):
+        raise ValueError(f"{rel} leaves {root}")
+    if linkname and (Path(linkname).is_absolute() or not within(root, target.parent / linkname)):
+        raise ValueError(f"{rel} links to {linkname}, out of {root}")
+    return target
+
+
+def iter_file_chunks(path: Path | str, chunk_size: int) -> Iterator[bytes]:
+    """Yield a file in fixed-size chunks, only one chunk is held in memory at a time"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_config_values(config_file: Path) -> Dict[str, str]:
+    """Top-level `KEY: value` scalars of a cluster config.yml, quotes and comments stripped"""
+    values = {}
+    for line in config_file.read_text().splitlines():
+        match = re.match(r'^(\w+):\s*"?([^"#\s]*)', line)
+        if match:
+            values[match.group(1)] = match.group(2)
+    return values
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the current process in MB"""
+    # ru_maxrss is reported in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def transfer_report(action: str, target: str, nbytes: int, seconds: float) -> str:
+    """Format size, throughput and peak memory of a transfer"""
+    size_mb = nbytes / 1024 ** 2
+    throughput = size_mb / seconds if seconds > 0 else 0.0
+    return (f"{action} {target}: {size_mb:.1f} MB in {seconds:.1f}s "
+            f"({throughput:.1f} MB/s, peak RSS {peak_rss_mb():.1f} MB)")
+
+
 def validate_ip(ip: str) -> bool:
     """Validate an IP address"""
     try:
@@ -0,0 +1,345 @@
+"""
+Daemonless access to saved image tarballs for kubeauto
+"""
+import json
+import os
+import shutil
+import tarfile
+from functools import cached_property
+from pathlib import Path, PurePosixPath
+from typing import IO, Dict, List, Optional, Set
+
+from common.compress import open_archive_file
+from common.exceptions import CompressionError, ImageArchiveError
+from common.logger import setup_logger
+from common.utils import rmrf, within
+
+logger = setup_logger(__name__)
+
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+
+INDEX_MEDIA_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+)
+
+
+def _normalize(name: str) -> str:
+    """Normalize a tar member name to a relative posix path"""
+    parts = [part for part in PurePosixPath(name).parts if part not in ("/", ".")]
+    if ".." in parts:
+        raise ImageArchiveError(f"Refuse to extract {name} outside of the destination")
+    return "/".join(parts)
+
+
+def _target(destination: Path, rel: str) -> Path:
+    """
+    destination / rel, refused when a symlink written by an earlier member or layer takes it out of destination
+
+    Layer content may hold any symlink (k8s/foo -> /etc), a later k8s/foo/passwd must not follow it.
+    """
+    target = destination / rel
+    if not within(destination, target.parent):
+        raise ImageArchiveError(f"Refuse to extract {rel} through a symlink leading out of {destination}")
+    return target
+
+
+class ImageArchive:
+    """
+    Read-only view of a `docker save` tarball, either the legacy layout or the OCI layout
+
+    Layers are read straight out of the tarball, so neither dockerd nor a container is needed
+    to get at the files of an image. Tarballs compressed by kubeauto (.tar.zst) are read the same way.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        try:
+            # plain .tar or zstd-compressed .tar.zst alike
+            self._file = open_archive_file(self.path)
+            self._tar = tarfile.open(fileobj=self._file, mode="r:")
+        except (OSError, tarfile.TarError, CompressionError) as e:
+            raise ImageArchiveError(f"Failed to open image archive {self.path}: {e}")
+        self._members = {_normalize(m.name): m for m in self._tar.getmembers()}
+
+    def __enter__(self) -> "ImageArchive":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._tar.close()
+        self._file.close()
+
+    def _open_member(self, name: str) -> IO[bytes]:
+        """Open a member of the archive as a binary stream"""
+        member = self._members.get(_normalize(name))
+        fileobj = self._tar.extractfile(member) if member is not None else None
+        if fileobj is None:
+            raise ImageArchiveError(f"{name} not found in image archive {self.path}")
+        return fileobj
+
+    def member_size(self, name: str) -> int:
+        """Size in bytes of a member of the archive"""
+        member = self._members.get(_normalize(name))
+        if member is None:
+            raise ImageArchiveError(f"{name} not found in image archive {self.path}")
+        return member.size
+
+    def open_independent(self, name: str) -> IO[bytes]:
+        """
+        Open a member on its own file handle
+
+        Unlike _open_member the stream does not share the position of the archive,
+        so several members can be read from different threads at the same time.
+        """
+        member = self._members.get(_normalize(name))
+        if member is None or not member.isfile():
+            raise ImageArchiveError(f"{name} not found in image archive {self.path}")
+        return _MemberReader(self.path, member.offset_data, member.size)
+
+    def _read_json(self, name: str):
+        with self._open_member(name) as f:
+            return json.load(f)
+
+    @cached_property
+    def manifest(self) -> List[Dict]:
+        """`docker save` manifest, built from index.json for archives carrying only the OCI layout"""
+        if "manifest.json" in self._members:
+            return self._read_json("manifest.json")
+
+        if "index.json" not in self._members:
+            raise ImageArchiveError(f"{self.path} has neither manifest.json nor index.json")
+
+        manifest = []
+        for descriptor in self._read_json("index.json").get("manifests", []):
+            image_manifest = self._read_json(self._blob_path(descriptor["digest"]))
+            # multi-arch index: keep the first image manifest
+            while image_manifest.get("mediaType") in INDEX_MEDIA_TYPES:
+                image_manifest = self._read_json(self._blob_path(image_manifest["manifests"][0]["digest"]))
+
+            ref = descriptor.get("annotations", {}).get("io.containerd.image.name")
+            manifest.append({
+                "Config": self._blob_path(image_manifest["config"]["digest"]),
+                "RepoTags": [ref] if ref else [],
+                "Layers": [self._blob_path(layer["digest"]) for layer in image_manifest.get("layers", [])],
+            })
+        return manifest
+
+    @staticmethod
+    def _blob_path(digest: str) -> str:
+        algorithm, _, hexdigest = digest.partition(":")
+        return f"blobs/{algorithm}/{hexdigest}"
+
+    def layers(self, image: Optional[str] = None) -> List[str]:
+        """Layer member names of an image, bottom layer first"""
+        if not self.manifest:
+            raise ImageArchiveError(f"No image found in {self.path}")
+
+        if image is None:
+            return self.manifest[0]["Layers"]
+
+        for entry in self.manifest:
+            if image in (entry.get("RepoTags") or []):
+                return entry["Layers"]
+        raise ImageArchiveError(f"Image {image} not found in {self.path}")
+
+    def extract(self, subtree: str, destination: Path, image: Optional[str] = None,
+                only: Optional[Set[str]] = None) -> List[str]:
+        """
+        Extract a subtree of the image filesystem into destination
+
+        Layers are applied in order, honouring whiteouts and opaque directories, and only
+        members under subtree are written. As with `docker cp` followed by a move, every
+        top-level item of subtree replaces the one already in destination.
+
+        With only (paths relative to subtree), just those files are rewritten and
+        everything else in destination is left as it is.
+
+        return relative paths of extracted regular files
+        """
+        subtree = _normalize(subtree)
+        destination.mkdir(parents=True, exist_ok=True)
+
+        replaced: Set[str] = set()
+        extracted: Dict[str, None] = {}
+        for layer in self.layers(image):
+            self._apply_layer(layer, subtree, destination, replaced, extracted, only)
+
+        logger.debug(f"Extracted {len(extracted)} files of /{subtree} from {self.path} to {destination}")
+        return list(extracted)
+
+    def _apply_layer(self, layer: str, subtree: str, destination: Path,
+                     replaced: Set[str], extracted: Dict[str, None], only: Optional[Set[str]] = None) -> None:
+        """Apply one layer to destination"""
+        layer_paths: Set[str] = set()
+        hardlinks = []
+
+        try:
+            with self._open_member(layer) as fileobj, tarfile.open(fileobj=fileobj, mode="r|*") as layer_tar:
+                for member in layer_tar:
+                    path = _normalize(member.name)
+                    parent, _, base = path.rpartition("/")
+
+                    if base == WHITEOUT_OPAQUE:
+                        if only is not None:
+                            self._whiteout_only(parent, subtree, destination, only, extracted, keep=layer_paths)
+                        else:
+                            self._whiteout(parent, subtree, destination, replaced, extracted, keep=layer_paths)
+                        continue
+                    if base.startswith(WHITEOUT_PREFIX):
+                        target = f"{parent}/{base[len(WHITEOUT_PREFIX):]}" if parent else base[len(WHITEOUT_PREFIX):]
+                        if only is not None:
+                            self._whiteout_only(target, subtree, destination, only, extracted, remove_self=True)
+                        else:
+                            self._whiteout(target, subtree, destination, replaced, extracted, remove_self=True)
+                        continue
+
+                    rel = self._relative(path, subtree)
+                    if not rel:
+                        continue
+
+                    if only is not None:
+                        if rel not in only:
+                            continue
+                    else:
+                        top = rel.split("/", 1)[0]
+                        if top not in replaced:
+                            rmrf(_target(destination, top))
+                            replaced.add(top)
+
+                    layer_paths.add(rel)
+                    if member.islnk():
+                        hardlinks.append((rel, member))
+                    else:
+                        self._write_member(layer_tar, member, _target(destination, rel))
+                        if member.isfile():
+                            extracted[rel] = None
+        except (OSError, tarfile.TarError) as e:
+            raise ImageArchiveError(f"Failed to read layer {layer} of {self.path}: {e}")
+
+        # hardlink targets may come later in the layer stream
+        for rel, member in hardlinks:
+            source = self._relative(_normalize(member.linkname), subtree)
+            target = _target(destination, rel)
+            if not source or not (destination / source).exists() or not within(destination, destination / source):
+                logger.warning(f"Skip hardlink {rel}, its target {member.linkname} is outside /{subtree}")
+                continue
+            rmrf(target)
+            os.link(destination / source, target)
+            extracted[rel] = None
+
+    @staticmethod
+    def _relative(path: str, subtree: str) -> Optional[str]:
+        """Path relative to subtree, None if path is not strictly below subtree"""
+        if not subtree:
+            return path or None
+        if path.startswith(subtree + "/"):
+            return path[len(subtree) + 1:]
+        return None
+
+    def _whiteout(self, path: str, subtree: str, destination: Path, replaced: Set[str],
+                  extracted: Dict[str, None], remove_self: bool = False, keep: Optional[Set[str]] = None) -> None:
+        """
+        Remove what lower layers put at path (or, for opaque dirs, under it)
+
+        Only items written by this extraction are touched, whatever else lives in destination is left alone.
+        """
+        if not path or path == subtree or subtree.startswith(path + "/"):
+            # whiteout covering the whole subtree
+            rel = ""
+        else:
+            rel = self._relative(path, subtree)
+            if rel is None or rel.split("/", 1)[0] not in replaced:
+                return
+            if remove_self:
+                rmrf(_target(destination, rel))
+                self._forget(extracted, rel)
+                return
+
+        root = _target(destination, rel) if rel else destination
+        if not root.is_dir() or root.is_symlink():
+            return
+        for child in root.iterdir():
+            child_rel = f"{rel}/{child.name}" if rel else child.name
+            if child_rel.split("/", 1)[0] not in replaced or (keep and child_rel in keep):
+                continue
+            rmrf(child)
+            self._forget(extracted, child_rel)
+
+    def _whiteout_only(self, path: str, subtree: str, destination: Path, only: Set[str],
+                       extracted: Dict[str, None], remove_self: bool = False, keep: Optional[Set[str]] = None) -> None:
+        """_whiteout restricted to the selected files"""
+        if not path or path == subtree or subtree.startswith(path + "/"):
+            rel = ""
+        else:
+            rel = self._relative(path, subtree)
+            if rel is None:
+                return
+
+        for name in only:
+            if rel and not (name.startswith(rel + "/") or (remove_self and name == rel)):
+                continue
+            if keep and name in keep:
+                continue
+            rmrf(_target(destination, name))
+            extracted.pop(name, None)
+
+    @staticmethod
+    def _forget(extracted: Optional[Dict[str, None]], rel: str) -> None:
+        if extracted is None:
+            return
+        for name in [n for n in extracted if n == rel or n.startswith(rel + "/")]:
+            del extracted[name]
+
+    @staticmethod
+    def _write_member(layer_tar: tarfile.TarFile, member: tarfile.TarInfo, target: Path) -> None:
+        """Write a directory, regular file or symlink member to target"""
+        if member.isdir():
+            if target.is_symlink() or (target.exists() and not target.is_dir()):
+                rmrf(target)
+            target.mkdir(parents=True, exist_ok=True)
+            os.chmod(target, member.mode & 0o7777)
+            return
+
+        if target.is_symlink() or target.exists():
+            rmrf(target)
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        if member.issym():
+            os.symlink(member.linkname, target)
+        elif member.isfile():
+            with layer_tar.extractfile(member) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.chmod(target, member.mode & 0o7777)
+            os.utime(target, (member.mtime, member.mtime))
+        else:
+            logger.debug(f"Skip special file {member.name}")
+
+
+class _MemberReader:
+    """Read-only stream over [offset, offset + size) of a file"""
+
+    def __init__(self, path: Path, offset: int, size: int):
+        self._file = open_archive_file(path)
+        self._file.seek(offset)
+        self._remaining = size
+
+    def read(self, n: int = -1) -> bytes:
+        if self._remaining <= 0:
+            return b""
+        n = self._remaining if n is None or n < 0 else min(n, self._remaining)
+        data = self._file.read(n)
+        self._remaining -= len(data)
+        return data
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "_MemberReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
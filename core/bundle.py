@@ -0,0 +1,474 @@
+"""
+Single-file offline bundles for kubeauto
+"""
+import hashlib
+import json
+import os
+import struct
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional, Set, Tuple
+
+from common.compress import ZstdWriter, iter_zstd_stream, zstd_available
+from common.constants import KubeConstant
+from common.exceptions import ClusterNotFoundError, CompressionError, DownloadError
+from common.logger import setup_logger
+from common.utils import read_config_values, rmrf, safe_member, transfer_report
+from .inventory import Inventory
+from .layerstore import LayerStore
+from .manifest import BundleManifest
+from .release import ReleaseDir, link_binaries, stage_dir, swap_into
+
+logger = setup_logger(__name__)
+
+BUNDLE_MAGIC = b"KUBEAUTO-BUNDLE1"
+INDEX_FOOTER = struct.Struct("<Q16s")
+COPY_BYTES = 1024 * 1024
+# smaller files are stored as they are, a zstd stream per tiny file is not worth it
+COMPRESS_MIN_BYTES = 64 * 1024
+COMPRESSED_MAGICS = (b"\x1f\x8b", b"\x28\xb5\x2f\xfd", b"\x5e\x2a\x4d\x18", b"PK\x03\x04")
+STATE_SAVE_SECONDS = 5
+
+# config.yml switch -> component of KubeConstant.component_images
+ADDON_SWITCHES = {
+    "dashboard_install": "dashboard",
+    "prom_install": "prometheus",
+    "kubeapps_install": "kubeapps",
+    "local_path_provisioner_install": "local-path-provisioner",
+    "nfs_provisioner_install": "nfs-provisioner",
+    "kubeblocks_install": "kubeblocks",
+    "kb_addon_mysql_install": "kb-addon-mysql",
+    "kb_addon_pg_install": "kb-addon-pg",
+    "kb_addon_redis_install": "kb-addon-redis",
+    "kb_addon_minio_install": "kb-addon-minio",
+    "kb_addon_es_install": "kb-addon-es",
+    "kb_addon_mongodb_install": "kb-addon-mongodb",
+    "network_check_enabled": "network-check",
+}
+
+# import order: what the others rely on comes first
+COMPONENT_ORDER = ("docker", "store:", "images:", "kubeauto", "k8s_bin", "ext_bin", "harbor")
+
+
+@dataclass
+class BundleEntry:
+    """One file of the bundle, stored at [offset, offset + size)"""
+    root: str
+    path: str
+    components: List[str] = field(default_factory=list)
+    type: str = "file"
+    offset: int = 0
+    size: int = 0
+    raw_size: int = 0
+    sha256: str = ""
+    codec: str = "none"
+    mode: int = 0o644
+    mtime_ns: int = 0
+    linkname: str = ""
+
+
+class _HashingWriter:
+    """Write-through to fileobj, hashing and counting what goes through"""
+
+    def __init__(self, fileobj: IO[bytes]):
+        self._file = fileobj
+        self.sha = hashlib.sha256()
+        self.nbytes = 0
+
+    def write(self, data: bytes) -> int:
+        self.sha.update(data)
+        self.nbytes += len(data)
+        return self._file.write(data)
+
+
+class _SliceReader:
+    """Read [offset, offset + size) of fileobj, hashing what is read"""
+
+    def __init__(self, fileobj: IO[bytes], offset: int, size: int):
+        self._file = fileobj
+        self._file.seek(offset)
+        self._remaining = size
+        self.sha = hashlib.sha256()
+
+    def read(self, n: int = -1) -> bytes:
+        n = self._remaining if n is None or n < 0 else min(n, self._remaining)
+        data = self._file.read(n) if n else b""
+        self._remaining -= len(data)
+        self.sha.update(data)
+        return data
+
+    def drain(self) -> None:
+        while self.read(COPY_BYTES):
+            pass
+
+
+class BundleManager:
+    """
+    Pack everything `download` puts on a host into one file, and unpack it on air-gapped hosts
+
+    The bundle is the files back to back followed by a JSON index and a fixed footer, so an
+    import seeks straight to the components it needs. Components:
+      docker, kubeauto, k8s_bin, ext_bin, harbor  installed bundles and the docker tarball
+      store:<name>                                images of the layer store (blobs shared between images are packed once)
+      images:<group>                              repositories of the local registry, grouped as `download -X/-E`
+    """
+
+    def __init__(self):
+        self.kube_constant = KubeConstant()
+        self.base_path = Path(self.kube_constant.BASE_PATH)
+        self.image_dir = Path(self.kube_constant.IMAGE_DIR)
+        self.kube_bin_dir = Path(self.kube_constant.KUBE_BIN_DIR)
+        self.extra_bin_dir = Path(self.kube_constant.EXTRA_BIN_DIR)
+        self.sys_bin_dir = Path(self.kube_constant.SYS_BIN_DIR)
+        self.releases_dir = Path(self.kube_constant.RELEASES_DIR)
+        self.registry_dir = Path(self.kube_constant.BASE_DATA_PATH) / "registry"
+        self.clusters_dir = self.base_path / "clusters"
+        self.store = LayerStore(self.image_dir)
+
+    # ---------------------------------------------------------------- export
+
+    def export_bundle(self, output: Path, components: Optional[List[str]] = None) -> None:
+        """Write the selected components (default: all) into a single bundle file"""
+        sources = self._sources()
+        selected = self._select(list(sources), components)
+
+        start = time.monotonic()
+        entries: Dict[Tuple[str, str], BundleEntry] = {}
+        tmp = output.with_name(output.name + ".part")
+        with open(tmp, "wb") as f:
+            f.write(BUNDLE_MAGIC)
+            for component in selected:
+                for root, rel in sources[component][1]:
+                    entry = entries.get((root, rel))
+                    if entry is None:
+                        entry = entries[(root, rel)] = self._write_entry(f, root, rel)
+                    entry.components.append(component)
+
+            index = json.dumps({
+                "format": 1,
+                "created": int(time.time()),
+                "components": {c: sources[c][0] for c in selected},
+                "entries": [asdict(e) for e in entries.values()],
+            }).encode()
+            f.write(index)
+            f.write(INDEX_FOOTER.pack(len(index), BUNDLE_MAGIC))
+        os.replace(tmp, output)
+
+        for component in selected:
+            logger.info(f"  {component:<40} {sources[component][0].get('version', '')}", extra={"to_stdout": True})
+        logger.info(transfer_report("Exported", f"{len(selected)} components to {output}", output.stat().st_size,
+                                    time.monotonic() - start), extra={"to_stdout": True})
+
+    def _roots(self) -> Dict[str, Path]:
+        return {
+            "kubeauto": self.base_path,
+            "k8s_bin": self.kube_bin_dir,
+            "ext_bin": self.extra_bin_dir,
+            "harbor": self.image_dir,
+            "docker": self.image_dir,
+            "store": self.image_dir,
+            "registry": self.registry_dir,
+        }
+
+    def _sources(self) -> Dict[str, Tuple[Dict, List[Tuple[str, str]]]]:
+        """component -> (info, [(root, relative path)]) of everything present on this host"""
+        sources = {}
+        for bundle, root in (("kubeauto", self.base_path), ("k8s_bin", self.kube_bin_dir),
+                             ("ext_bin", self.extra_bin_dir), ("harbor", self.image_dir)):
+            manifest = BundleManifest.load(root, bundle)
+            if manifest is None:
+                logger.warning(f"{bundle} has no manifest, reinstall it with `download` to bundle it")
+                continue
+            files = [(bundle, rel) for rel in manifest.files]
+            files.append((bundle, BundleManifest.path(root, bundle).name))
+            sources[bundle] = ({"version": manifest.version, "components": manifest.components}, files)
+
+        # the .part and .part.json of an unfinished download are not artifacts
+        dockers = sorted(p for pattern in ("docker-*.tgz", "docker-*.tgz.sha256")
+                         for p in self.image_dir.glob(pattern)) if self.image_dir.exists() else []
+        if dockers:
+            versions = [p.name[len("docker-"):-len(".tgz")] for p in dockers if p.name.endswith(".tgz")]
+            sources["docker"] = ({"version": ",".join(versions)}, [("docker", p.name) for p in dockers])
+
+        for name in self.store.names():
+            manifest = self.store.load_manifest(name)
+            digests = {e["digest"] for e in manifest["entries"] if e["type"] == "file"}
+            files = [("store", str(self.store.blob_file(d).relative_to(self.image_dir))) for d in sorted(digests)]
+            files.append(("store", str(self.store.manifest_path(name).relative_to(self.image_dir))))
+            sources[f"store:{name}"] = ({"version": manifest.get("image") or ""}, files)
+
+        for group, repos in self._registry_groups().items():
+            files = []
+            for repo in repos:
+                files.extend(self._registry_files(repo))
+            sources[f"images:{group}"] = ({"version": ",".join(repos)}, list(dict.fromkeys(files)))
+        return sources
+
+    def _registry_groups(self) -> Dict[str, List[str]]:
+        """Repositories of the local registry by image group, those of no group under `other`"""
+        repositories = self.registry_dir / "docker/registry/v2/repositories"
+        if not repositories.exists():
+            return {}
+        present = sorted(str(p.parent.relative_to(repositories)) for p in repositories.rglob("_manifests"))
+
+        owner = {}
+        groups = {"default": self.kube_constant.default_images, **self.kube_constant.component_images}
+        for group, images in groups.items():
+            for image in images:
+                owner.setdefault(image.split(":")[0], group)
+
+        result: Dict[str, List[str]] = {}
+        for repo in present:
+            result.setdefault(owner.get(repo, "other"), []).append(repo)
+        return result
+
+    def _registry_files(self, repo: str) -> List[Tuple[str, str]]:
+        """Blobs referenced by a repository first, then the repository metadata"""
+        v2 = self.registry_dir / "docker/registry/v2"
+        repo_dir = v2 / "repositories" / repo
+        blobs, metadata = [], []
+        for path in sorted(repo_dir.rglob("*")):
+            if not path.is_file() or "_uploads" in path.relative_to(repo_dir).parts:
+                continue
+            metadata.append(("registry", str(path.relative_to(self.registry_dir))))
+            if path.name == "link":
+                digest = path.read_text().strip().partition(":")[2]
+                blob = v2 / "blobs/sha256" / digest[:2] / digest / "data"
+                if blob.exists():
+                    blobs.append(("registry", str(blob.relative_to(self.registry_dir))))
+        return list(dict.fromkeys(blobs)) + metadata
+
+    def _write_entry(self, f: IO[bytes], root: str, rel: str) -> BundleEntry:
+        source = self._roots()[root] / rel
+        st = source.lstat()
+        entry = BundleEntry(root=root, path=rel, mode=st.st_mode & 0o7777, mtime_ns=st.st_mtime_ns)
+        if source.is_symlink():
+            entry.type, entry.linkname = "symlink", os.readlink(source)
+            return entry
+
+        entry.offset, entry.raw_size = f.tell(), st.st_size
+        writer = _HashingWriter(f)
+        with open(source, "rb") as src:
+            head = src.read(4)
+            src.seek(0)
+            if zstd_available() and st.st_size >= COMPRESS_MIN_BYTES and not head.startswith(COMPRESSED_MAGICS):
+                entry.codec = "zstd"
+                with ZstdWriter(writer, self.kube_constant.IMAGE_COMPRESSION_LEVEL,
+                                self.kube_constant.COMPRESSION_WORKERS) as zw:
+                    for chunk in iter(lambda: src.read(COPY_BYTES), b""):
+                        zw.write(chunk)
+            else:
+                for chunk in iter(lambda: src.read(COPY_BYTES), b""):
+                    writer.write(chunk)
+        entry.size, entry.sha256 = writer.nbytes, writer.sha.hexdigest()
+        return entry
+
+    # ---------------------------------------------------------------- import
+
+    @staticmethod
+    def read_index(path: Path) -> Tuple[Dict, str]:
+        """Index of a bundle and its id (hash of the index)"""
+        try:
+            with open(path, "rb") as f:
+                if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+                    raise DownloadError(f"{path} is not a kubeauto bundle")
+                f.seek(-INDEX_FOOTER.size, os.SEEK_END)
+                length, magic = INDEX_FOOTER.unpack(f.read(INDEX_FOOTER.size))
+                if magic != BUNDLE_MAGIC:
+                    raise DownloadError(f"{path} is truncated, its index is missing")
+                f.seek(-(INDEX_FOOTER.size + length), os.SEEK_END)
+                raw = f.read(length)
+            index = json.loads(raw)
+        except ValueError as e:
+            raise DownloadError(f"Bundle {path} has a corrupt index: {e}")
+        except (OSError, struct.error) as e:
+            raise DownloadError(f"Failed to read bundle {path}: {e}")
+        return index, hashlib.sha256(raw).hexdigest()[:16]
+
+    def list_bundle(self, path: Path) -> None:
+        index, _ = self.read_index(path)
+        sizes: Dict[str, int] = {}
+        for entry in index["entries"]:
+            for component in entry["components"]:
+                sizes[component] = sizes.get(component, 0) + entry["size"]
+        logger.info(f"{'COMPONENT':<40} {'SIZE(MB)':>10}  VERSION", extra={"to_stdout": True})
+        for component, info in index["components"].items():
+            logger.info(f"{component:<40} {sizes.get(component, 0) / 1024 ** 2:>10.1f}  {info.get('version', '')}",
+                        extra={"to_stdout": True})
+
+    def import_bundle(self, path: Path, cluster: Optional[str] = None, components: Optional[List[str]] = None,
+                      resume: bool = True) -> None:
+        """
+        Install components of a bundle: those named, else those the cluster config needs, else all
+
+        Every file is checked against its SHA-256 while it is copied. Progress is saved as it
+        goes, so running the same import again after an interruption continues where it stopped.
+        """
+        index, bundle_id = self.read_index(path)
+        available = list(index["components"])
+        wanted = set(components or [])
+        if cluster:
+            wanted |= self.components_for_cluster(cluster, available)
+        selected = self._select(available, sorted(wanted) if wanted else None)
+        selected.sort(key=lambda c: next(i for i, p in enumerate(COMPONENT_ORDER) if c.startswith(p)))
+
+        self.image_dir.mkdir(parents=True, exist_ok=True)
+        state_file = self.image_dir / f".bundle-import-{bundle_id}.json"
+        if not resume:
+            rmrf(state_file)
+        state = self._load_state(state_file)
+
+        entries = [BundleEntry(**e) for e in index["entries"]]
+        start = time.monotonic()
+        copied = 0
+        try:
+            with open(path, "rb") as f:
+                for component in selected:
+                    if component in state["components"]:
+                        logger.info(f"{component} already imported", extra={"to_stdout": True})
+                        continue
+                    todo = [(i, e) for i, e in enumerate(entries) if component in e.components]
+                    # blobs of the store come before the manifest naming them, no gc in between
+                    with self.store.lock() if component.startswith("store:") else nullcontext():
+                        copied += self._import_component(f, component, index["components"][component], todo,
+                                                         state, state_file)
+                    state["components"].append(component)
+                    logger.info(f"{component} has been imported", extra={"to_stdout": True})
+        finally:
+            self._save_state(state_file, state)
+
+        rmrf(state_file)
+        logger.info(transfer_report("Imported", f"{len(selected)} components from {path}", copied,
+                                    time.monotonic() - start), extra={"to_stdout": True})
+
+    def components_for_cluster(self, cluster: str, available: List[str]) -> Set[str]:
+        """Components needed by a cluster (its name, or a directory holding its config.yml and hosts)"""
+        cluster_dir = Path(cluster) if Path(cluster).is_dir() else self.clusters_dir / cluster
+        config_file, hosts_file = cluster_dir / "config.yml", cluster_dir / "hosts"
+        if not config_file.exists() or not hosts_file.exists():
+            raise ClusterNotFoundError(f"config.yml and hosts of cluster {cluster} not found in {cluster_dir}")
+
+        settings = read_config_values(config_file)
+        inventory = Inventory.load(hosts_file)
+        network = inventory.section_vars("all:vars").get("CLUSTER_NETWORK")
+
+        wanted = {"docker", "kubeauto", "k8s_bin", "ext_bin", "images:default"}
+        wanted |= {c for c in available if c.startswith("store:registry-")}
+        wanted |= {f"images:{group}" for switch, group in ADDON_SWITCHES.items()
+                   if settings.get(switch, "").lower() in ("yes", "true")}
+        if network in self.kube_constant.component_images:
+            wanted.add(f"images:{network}")
+        if inventory.hosts("harbor"):
+            wanted.add("harbor")
+
+        missing = sorted(wanted - set(available))
+        if missing:
+            logger.warning(f"Cluster {cluster} needs components the bundle lacks: {', '.join(missing)}",
+                           extra={"to_stdout": True})
+        return wanted & set(available)
+
+    def _import_component(self, f: IO[bytes], component: str, info: Dict, todo: List[Tuple[int, BundleEntry]],
+                          state: Dict, state_file: Path) -> int:
+        """Copy the entries of a component into place, return bytes copied"""
+        done = set(state["entries"])
+        saved_at = time.monotonic()
+        copied = 0
+
+        if component in ("k8s_bin", "ext_bin"):
+            releases = ReleaseDir(self.releases_dir, component, self._roots()[component])
+            target_root = releases.staging(info["version"], resume=True)
+        elif component in ("kubeauto", "harbor"):
+            releases = None
+            target_root = stage_dir(self._roots()[component], f"import-{component}", resume=True)
+        else:
+            releases = None
+            target_root = None
+
+        for i, entry in sorted(todo, key=lambda item: item[1].offset):
+            if i in done:
+                continue
+            root = target_root or self._roots()[entry.root]
+            try:
+                target = safe_member(root, entry.path, entry.linkname if entry.type == "symlink" else "")
+            except ValueError as e:
+                raise DownloadError(f"Refusing {component} entry of the bundle: {e}")
+            # blobs are named by their digest: one already there is the same content
+            if not (target_root is None and target.exists() and entry.root in ("store", "registry")
+                    and "blobs" in Path(entry.path).parts):
+                copied += self._extract_entry(f, entry, target)
+            done.add(i)
+            state["entries"].append(i)
+            if time.monotonic() - saved_at > STATE_SAVE_SECONDS:
+                self._save_state(state_file, state)
+                saved_at = time.monotonic()
+
+        if releases is not None:
+            # nothing staged: a previous run committed the release but stopped before recording it
+            if any(target_root.iterdir()) or not releases.path(info["version"]).is_dir():
+                releases.commit(target_root, info["version"])
+            else:
+                rmrf(target_root)
+            releases.activate(info["version"])
+            if component == "k8s_bin":
+                link_binaries(self.kube_bin_dir, self.sys_bin_dir)
+        elif target_root is not None:
+            swap_into(target_root, self._roots()[component], BundleManifest.path(target_root, component).name,
+                      keep=self.kube_constant.kept_items() if component == "kubeauto" else ())
+            rmrf(target_root)
+        return copied
+
+    @staticmethod
+    def _extract_entry(f: IO[bytes], entry: BundleEntry, target: Path) -> int:
+        """Copy one entry to target through a temp file, verifying its checksum on the way"""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if entry.type == "symlink":
+            rmrf(target)
+            os.symlink(entry.linkname, target)
+            return 0
+
+        tmp = target.with_name(f".{target.name}.part")
+        reader = _SliceReader(f, entry.offset, entry.size)
+        try:
+            chunks: Iterator[bytes] = iter_zstd_stream(reader, COPY_BYTES) if entry.codec == "zstd" \
+                else iter(lambda: reader.read(COPY_BYTES), b"")
+            with open(tmp, "wb") as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            reader.drain()
+            if reader.sha.hexdigest() != entry.sha256:
+                raise DownloadError(f"Checksum mismatch for {entry.root}/{entry.path}, the bundle is corrupted")
+            os.chmod(tmp, entry.mode)
+            os.utime(tmp, ns=(entry.mtime_ns, entry.mtime_ns))
+            os.replace(tmp, target)
+        except CompressionError:
+            # a damaged compressed entry fails to decompress before its checksum can be compared
+            raise DownloadError(f"Checksum mismatch for {entry.root}/{entry.path}, the bundle is corrupted")
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        return entry.size
+
+    @staticmethod
+    def _load_state(state_file: Path) -> Dict:
+        try:
+            state = json.loads(state_file.read_text())
+            return {"entries": list(state["entries"]), "components": list(state["components"])}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {"entries": [], "components": []}
+
+    @staticmethod
+    def _save_state(state_file: Path, state: Dict) -> None:
+        tmp = state_file.with_name(state_file.name + ".tmp")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, state_file)
+
+    @staticmethod
+    def _select(available: List[str], components: Optional[List[str]]) -> List[str]:
+        if not components:
+            return list(available)
+        unknown = [c for c in components if c not in available]
+        if unknown:
+            raise DownloadError(f"Unknown components: {', '.join(unknown)} (available: {', '.join(available)})")
+        return [c for c in available if c in components]
@@ -0,0 +1,278 @@
+"""
+Size-budgeted download cache of kubeauto
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from common.constants import KubeConstant
+from common.logger import setup_logger
+from common.utils import read_config_values, rmrf
+from .inventory import Inventory
+from .layerstore import LayerStore
+from .manifest import BundleManifest
+
+logger = setup_logger(__name__)
+
+# file artifacts of IMAGE_DIR besides the layer store: docker tarballs and tarballs of older kubeauto
+FILE_PATTERNS = ("docker-*.tgz", "*.tar")
+FILE_SIDECARS = (".sha256", ".part", ".part.json")
+
+
+@dataclass
+class CacheArtifact:
+    """Something `download` fetched and can fetch again: a stored image or a file"""
+    key: str
+    kind: str
+    last_used: float
+    paths: List[Path] = field(default_factory=list)
+    blobs: Set[str] = field(default_factory=set)
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    pinned_by: List[str] = field(default_factory=list)
+
+
+class CacheManager:
+    """
+    Keep IMAGE_DIR under CACHE_BUDGET_GB by evicting the least recently used artifacts
+
+    Every lookup of `download` is recorded as a hit or a miss in `.cache.json`, with the time
+    of the last use that orders evictions. Artifacts used by a cluster under clusters/, by an
+    installed bundle or by the configured docker/registry versions are pinned, never evicted.
+    A stored image frees only the blobs no remaining image shares.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, image_dir: Optional[Path] = None):
+        self.kube_constant = KubeConstant()
+        self.image_dir = Path(image_dir or self.kube_constant.IMAGE_DIR)
+        self.base_path = Path(self.kube_constant.BASE_PATH)
+        self.clusters_dir = self.base_path / "clusters"
+        self.kube_bin_dir = Path(self.kube_constant.KUBE_BIN_DIR)
+        self.extra_bin_dir = Path(self.kube_constant.EXTRA_BIN_DIR)
+        self.store = LayerStore(self.image_dir)
+        self.index_file = self.image_dir / ".cache.json"
+
+    def record(self, key: str, hit: bool) -> None:
+        """Count a lookup of an artifact and mark it used now"""
+        with self._lock:
+            index = self._load_index()
+            stats = index["artifacts"].setdefault(key, {"hits": 0, "misses": 0})
+            counter = "hits" if hit else "misses"
+            stats[counter] += 1
+            stats["last_used"] = time.time()
+            index[counter] += 1
+            try:
+                self._save_index(index)
+            except OSError as e:
+                logger.warning(f"Failed to record cache usage of {key}: {e}")
+
+    def artifacts(self) -> List[CacheArtifact]:
+        """Every artifact in the cache, with its stats and pins"""
+        index = self._load_index()["artifacts"]
+        pins = self.pins()
+        artifacts = []
+
+        for name in self.store.names():
+            path = self.store.manifest_path(name)
+            blobs = {e["digest"].split(":", 1)[-1] for e in self.store.load_manifest(name)["entries"]
+                     if e["type"] == "file"}
+            artifacts.append(CacheArtifact(key=name, kind="image", last_used=path.stat().st_mtime,
+                                           paths=[path], blobs=blobs, size=path.stat().st_size))
+
+        # files the harbor bundle installed into IMAGE_DIR belong to it, not to the cache
+        harbor = BundleManifest.load(self.image_dir, "harbor")
+        seen = set(harbor.files) | {BundleManifest.path(self.image_dir, "harbor").name} if harbor else set()
+        for pattern in FILE_PATTERNS:
+            for path in sorted(self.image_dir.glob(pattern + "*")):
+                key = next((path.name[:-len(s)] for s in FILE_SIDECARS if path.name.endswith(s)), path.name)
+                if key in seen or not any(Path(key).match(p) for p in FILE_PATTERNS):
+                    continue
+                seen.add(key)
+                paths = [p for p in [self.image_dir / key] + [self.image_dir / (key + s) for s in FILE_SIDECARS]
+                         if p.exists()]
+                artifacts.append(CacheArtifact(key=key, kind="file", paths=paths,
+                                               last_used=max(p.stat().st_mtime for p in paths),
+                                               size=sum(p.stat().st_size for p in paths)))
+
+        for artifact in artifacts:
+            stats = index.get(artifact.key, {})
+            artifact.last_used = stats.get("last_used", artifact.last_used)
+            artifact.hits, artifact.misses = stats.get("hits", 0), stats.get("misses", 0)
+            artifact.pinned_by = pins.get(artifact.key, [])
+        return artifacts
+
+    def pins(self) -> Dict[str, List[str]]:
+        """artifact key -> what needs it"""
+        pins: Dict[str, List[str]] = {}
+
+        def pin(key: str, reason: str) -> None:
+            pins.setdefault(key, []).append(reason)
+
+        pin(f"registry-{self.kube_constant.v_docker_registry}", "local registry")
+        pin(f"docker-{self.kube_constant.v_docker}.tgz", "docker")
+        for bundle, destination in (("kubeauto", self.base_path), ("k8s_bin", self.kube_bin_dir),
+                                    ("ext_bin", self.extra_bin_dir), ("harbor", self.image_dir)):
+            manifest = BundleManifest.load(destination, bundle)
+            if manifest:
+                pin(f"{bundle}_{manifest.version}", "installed")
+
+        if self.clusters_dir.exists():
+            for config_file in sorted(self.clusters_dir.glob("*/config.yml")):
+                cluster = config_file.parent.name
+                try:
+                    config = read_config_values(config_file)
+                    harbor = Inventory.load(config_file.parent / "hosts").hosts("harbor")
+                except OSError as e:
+                    logger.warning(f"Failed to read cluster {cluster}, pinning its versions skipped: {e}")
+                    continue
+                if config.get("K8S_VER"):
+                    pin(f"k8s_bin_v{config['K8S_VER'].lstrip('v')}", f"cluster {cluster}")
+                if config.get("HARBOR_VER") and harbor:
+                    pin(f"harbor_{config['HARBOR_VER']}", f"cluster {cluster}")
+        return pins
+
+    def size(self, artifacts: Optional[List[CacheArtifact]] = None) -> int:
+        """Bytes taken by the cache: stored blobs and manifests, plus files"""
+        artifacts = self.artifacts() if artifacts is None else artifacts
+        total = sum(a.size for a in artifacts)
+        if self.store.blob_dir.exists():
+            total += sum(blob.stat().st_size for blob in self.store.blob_dir.iterdir())
+        return total
+
+    def prune(self, budget_gb: Optional[float] = None, max_age_days: Optional[int] = None,
+              dry_run: bool = False) -> List[CacheArtifact]:
+        """
+        Evict unpinned artifacts, least recently used first, until the cache fits the budget
+
+        Artifacts unused for max_age_days are evicted whatever the size. return evicted artifacts
+        """
+        budget_gb = self.kube_constant.CACHE_BUDGET_GB if budget_gb is None else budget_gb
+        max_age_days = self.kube_constant.CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+        budget = budget_gb * 1024 ** 3 if budget_gb else float("inf")
+        cutoff = time.time() - max_age_days * 86400 if max_age_days else 0
+
+        with self._lock:
+            artifacts = self.artifacts()
+            blob_sizes, blob_users = self._blobs(artifacts)
+            total = sum(a.size for a in artifacts) + sum(blob_sizes.values())
+
+            evicted, reclaimed = [], 0
+            for artifact in sorted(artifacts, key=lambda a: a.last_used):
+                if artifact.pinned_by:
+                    continue
+                if total <= budget and artifact.last_used >= cutoff:
+                    # what follows was used more recently: not expired either
+                    break
+                freed = artifact.size
+                for digest in artifact.blobs:
+                    blob_users[digest] -= 1
+                    if blob_users[digest] == 0:
+                        freed += blob_sizes.get(digest, 0)
+                if not dry_run:
+                    freed = self._evict(artifact)
+                total -= freed
+                reclaimed += freed
+                artifact.size = freed
+                evicted.append(artifact)
+
+            if not dry_run:
+                # orphans: blobs left by an interrupted ingest or a removed manifest
+                reclaimed += self.store.gc()
+                index = self._load_index()
+                present = {a.key for a in artifacts} - {a.key for a in evicted}
+                index["artifacts"] = {k: v for k, v in index["artifacts"].items() if k in present}
+                index["evictions"] += len(evicted)
+                index["reclaimed_bytes"] += reclaimed
+                self._save_index(index)
+
+        verb = "Would evict" if dry_run else "Evicted"
+        for artifact in evicted:
+            logger.info(f"{verb} {artifact.key} ({artifact.size / 1024 ** 2:.1f} MB, last used "
+                        f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(artifact.last_used))})",
+                        extra={"to_stdout": True})
+        logger.info(f"{verb} {len(evicted)} artifacts, {reclaimed / 1024 ** 2:.1f} MB reclaimed, "
+                    f"cache is {total / 1024 ** 3:.2f} GB (budget {budget_gb or 'unlimited'} GB)",
+                    extra={"to_stdout": True})
+        if total > budget:
+            logger.warning("The cache is still over budget, everything left is pinned", extra={"to_stdout": True})
+        return evicted
+
+    def enforce_budget(self) -> None:
+        """Prune only when the cache is over its budget or holds expired artifacts"""
+        budget_gb, max_age_days = self.kube_constant.CACHE_BUDGET_GB, self.kube_constant.CACHE_MAX_AGE_DAYS
+        if not budget_gb and not max_age_days:
+            return
+        artifacts = self.artifacts()
+        cutoff = time.time() - max_age_days * 86400 if max_age_days else 0
+        expired = any(a.last_used < cutoff and not a.pinned_by for a in artifacts)
+        if expired or (budget_gb and self.size(artifacts) > budget_gb * 1024 ** 3):
+            self.prune()
+
+    def show_stats(self) -> None:
+        """Artifacts by last use, with their hits/misses and pins, then the totals"""
+        artifacts = sorted(self.artifacts(), key=lambda a: a.last_used, reverse=True)
+        blob_sizes, blob_users = self._blobs(artifacts)
+        index = self._load_index()
+
+        logger.info(f"{'ARTIFACT':<40} {'SIZE(MB)':>10} {'HITS':>6} {'MISSES':>6}  {'LAST USED':<16}  PINNED BY",
+                    extra={"to_stdout": True})
+        for artifact in artifacts:
+            # stored images: the blobs only they use, shared base layers are counted in the total only
+            size = artifact.size + sum(blob_sizes.get(d, 0) for d in artifact.blobs if blob_users[d] == 1)
+            logger.info(f"{artifact.key:<40} {size / 1024 ** 2:>10.1f} {artifact.hits:>6} {artifact.misses:>6}  "
+                        f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(artifact.last_used)):<16}  "
+                        f"{', '.join(artifact.pinned_by) or '-'}", extra={"to_stdout": True})
+
+        lookups = index["hits"] + index["misses"]
+        budget_gb = self.kube_constant.CACHE_BUDGET_GB
+        logger.info(f"{len(artifacts)} artifacts, {self.size(artifacts) / 1024 ** 3:.2f} GB of "
+                    f"{f'{budget_gb} GB' if budget_gb else 'unlimited'} budget in {self.image_dir}",
+                    extra={"to_stdout": True})
+        logger.info(f"{index['hits']} hits, {index['misses']} misses "
+                    f"({index['hits'] / lookups if lookups else 0:.0%} hit rate), {index['evictions']} evictions, "
+                    f"{index['reclaimed_bytes'] / 1024 ** 2:.1f} MB reclaimed", extra={"to_stdout": True})
+
+    def _blobs(self, artifacts: List[CacheArtifact]) -> tuple[Dict[str, int], Dict[str, int]]:
+        """(blob -> bytes on disk, blob -> number of stored images using it)"""
+        sizes = {}
+        if self.store.blob_dir.exists():
+            for blob in self.store.blob_dir.iterdir():
+                if not blob.name.startswith("."):
+                    sizes[blob.name.split(".", 1)[0]] = blob.stat().st_size
+        users: Dict[str, int] = {}
+        for artifact in artifacts:
+            for digest in artifact.blobs:
+                users[digest] = users.get(digest, 0) + 1
+        return sizes, users
+
+    def _evict(self, artifact: CacheArtifact) -> int:
+        """Delete an artifact, return bytes freed"""
+        if artifact.kind == "image":
+            return self.store.remove(artifact.key)
+        freed = 0
+        for path in artifact.paths:
+            if path.exists():
+                freed += path.stat().st_size
+                rmrf(path)
+        return freed
+
+    def _load_index(self) -> Dict:
+        index = {"hits": 0, "misses": 0, "evictions": 0, "reclaimed_bytes": 0, "artifacts": {}}
+        try:
+            index.update(json.loads(self.index_file.read_text()))
+        except (OSError, ValueError):
+            pass
+        return index
+
+    def _save_index(self, index: Dict) -> None:
+        self.image_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_file.with_name(f"{self.index_file.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(index, indent=1))
+        os.replace(tmp, self.index_file)
@@ -0,0 +1,67 @@
+"""
+Checkpoints of the setup stages of a cluster: how each stage went on each of its hosts, kept in
+clusters/<name>/checkpoints.json so a failed setup can be resumed
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from common.logger import setup_logger
+from .playbook import PlaybookResult
+
+logger = setup_logger(__name__)
+
+CHECKPOINTS_FILE = "checkpoints.json"
+
+
+class Checkpoints:
+    """
+    stage -> {"time", "playbook", "hosts": {host: ok, failed or unreachable}}
+
+    Each record merges into the previous one of the stage, so a run limited to some hosts
+    leaves the others as they were. A stage is done once all its hosts are ok. Stages of
+    setup all record from their own threads, every record is written at once.
+    """
+
+    def __init__(self, cluster_dir: Path):
+        self.path = cluster_dir / CHECKPOINTS_FILE
+        self._lock = threading.Lock()
+        try:
+            self.stages: Dict[str, Dict] = json.loads(self.path.read_text()).get("stages", {})
+        except (OSError, ValueError, AttributeError):
+            self.stages = {}
+
+    def record(self, stage: str, playbook: str, hosts: Iterable[str], result: Optional[PlaybookResult]) -> None:
+        """Outcome of a run of stage on hosts, result None for a run that did not finish"""
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"hosts": {}})
+            entry.update(time=time.time(), playbook=playbook)
+            for host in hosts:
+                entry["hosts"][host] = result.status(host) if result else "failed"
+            self._save()
+
+    def reset(self, stages: Iterable[str]) -> None:
+        with self._lock:
+            for stage in stages:
+                self.stages.pop(stage, None)
+            self._save()
+
+    def pending_hosts(self, stage: str, hosts: Iterable[str]) -> List[str]:
+        """Hosts of the stage not recorded as ok"""
+        recorded = self.stages.get(stage, {}).get("hosts", {})
+        return [host for host in hosts if recorded.get(host) != "ok"]
+
+    def done(self, stage: str, hosts: Iterable[str]) -> bool:
+        return stage in self.stages and not self.pending_hosts(stage, hosts)
+
+    def _save(self) -> None:
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps({"stages": self.stages}, indent=2))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            # the setup goes on, only a later --resume loses what this run did
+            logger.warning(f"Failed to save the setup checkpoints in {self.path}: {e}")
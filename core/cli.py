@@ -2,17 +2,20 @@
 Command line interface for kubeauto
 """
 import argparse
+import re
 import sys
-from typing import Dict, Callable
+import time
+from datetime import datetime
+from functools import cached_property
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
 
 from common.utils import confirm_action, validate_ip
-from common.exceptions import KubeautoError, DownloadError, DockerManageError, SystemExecutionError
+from common.exceptions import KubeautoError, DownloadError, DockerManageError, InvalidIPError, SystemExecutionError
 from common.logger import setup_logger
 from common.constants import KubeConstant
 from common.os import SystemProbe
 from .controller import ClusterManager
-from .downloader import DownloadManager
-from .docker import DockerManager
 
 logger = setup_logger(__name__)
 
@@ -21,7 +24,6 @@ class KubeautoCLI:
     """Main CLI application class"""
 
     def __init__(self):
-        self.docker = DockerManager()
         self.parser = argparse.ArgumentParser(
             description="Kubeauto - Kubernetes cluster management tool",
             formatter_class=argparse.RawTextHelpFormatter
@@ -35,6 +37,13 @@ class KubeautoCLI:
         self.kube_constant = KubeConstant()
         self._setup_commands()
 
+    @cached_property
+    def docker(self):
+        """Docker manager, imported and built only by the subcommands needing it"""
+        from .docker import DockerManager
+
+        return DockerManager()
+
     def _setup_commands(self) -> None:
         """Initialize all CLI commands"""
         # Cluster setup commands
@@ -42,6 +51,8 @@ class KubeautoCLI:
         self._setup_setup_command()
         self._setup_list_command()
         self._setup_checkout_command()
+        self._setup_fleet_command()
+        self._setup_profile_command()
         self._setup_start_aio_command()
 
         # Cluster operation commands
@@ -66,6 +77,8 @@ class KubeautoCLI:
 
         # Download commands
         self._setup_download_command()
+        self._setup_bundle_command()
+        self._setup_cache_command()
 
         # Docker commands
         self._setup_docker_command()
@@ -73,12 +86,26 @@ class KubeautoCLI:
         # System commands
         self._setup_system_command()
 
-    def _add_common_cluster_args(self, parser: argparse.ArgumentParser) -> None:
-        """Add common cluster arguments to a parser"""
+    def _add_common_cluster_args(self, parser: argparse.ArgumentParser, playbooks: bool = False) -> None:
+        """Add common cluster arguments to a parser, playbooks for the commands running ansible"""
         parser.add_argument(
             "cluster",
             help="Name of the cluster to operate on"
         )
+        if playbooks:
+            parser.add_argument(
+                "--profile",
+                dest="ansible_profile",
+                choices=("safe", "fast"),
+                help="Ansible execution profile, sized from the inventory and this machine (default: "
+                     f"{self.kube_constant.ANSIBLE_PROFILE}): safe runs linear with all facts, fast uses the "
+                     "free strategy where possible, minimal facts and long-lived ssh connections"
+            )
+            parser.add_argument(
+                "--refresh-facts",
+                action="store_true",
+                help="Gather the facts of every host again instead of reusing the cached ones"
+            )
 
     def _setup_new_command(self) -> None:
         """
@@ -96,7 +123,7 @@ class KubeautoCLI:
             "setup",
             help="Setup a cluster with specific step"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
             "step",
             help="""Setup step:
@@ -107,10 +134,43 @@ class KubeautoCLI:
   05/kube-node     Setup worker nodes
   06/network       Setup network plugin
   07/cluster-addon Setup cluster addons
-  90/all           Run all setup steps
+  90/all           Run all setup steps, independent stages at the same time
   10/ex-lb         Install external load balancer
   11/harbor        Install Harbor registry"""
         )
+        parser.add_argument(
+            "--max-failures",
+            type=int,
+            metavar="N",
+            help="Abort the playbook as soon as more than N hosts failed (options of setup go before the cluster name)"
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="With all: skip the stages a previous setup completed on all their hosts"
+        )
+        parser.add_argument(
+            "--from",
+            dest="from_step",
+            metavar="STEP",
+            help="With all: start from this step (01-07, 10, 11 or its name) or stage, skipping the stages before it"
+        )
+        parser.add_argument(
+            "--only-failed-hosts",
+            action="store_true",
+            help="Run only on the hosts the previous setup of the step (or of each stage of all) did not complete on"
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="With all: run each stage only on the hosts whose inputs (config.yml keys, hosts variables, "
+                 "templates, binaries) changed since its last success"
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="With all: print why each stage would run or be skipped with --incremental, run nothing"
+        )
         parser.add_argument(
             "extra_args",
             nargs=argparse.REMAINDER,
@@ -124,6 +184,70 @@ class KubeautoCLI:
             help="List all managed clusters"
         )
 
+    def _setup_fleet_command(self) -> None:
+        """Setup 'fleet' command"""
+        parser = self.subparsers.add_parser(
+            "fleet",
+            help="Query nodes and settings across all managed clusters"
+        )
+        parser.add_argument(
+            "query",
+            choices=["nodes", "clusters", "sync"],
+            help="nodes: nodes by ip/role/cluster; clusters: clusters by setting; sync: re-read changed clusters"
+        )
+        parser.add_argument(
+            "--ip",
+            help="Nodes with this exact IP"
+        )
+        parser.add_argument(
+            "--role",
+            help="Nodes with this role (etcd, master, node, harbor, ex_lb, chrony)"
+        )
+        parser.add_argument(
+            "-c", "--cluster",
+            help="Nodes of this cluster"
+        )
+        parser.add_argument(
+            "-s", "--setting",
+            action="append",
+            metavar="KEY=PATTERN",
+            help="Clusters whose config.yml or [all:vars] KEY matches the glob PATTERN, e.g. calico_ver='v3.26*'"
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Re-read every cluster on sync, whatever the mtimes"
+        )
+
+    def _setup_profile_command(self) -> None:
+        """Setup 'profile' command"""
+        parser = self.subparsers.add_parser(
+            "profile",
+            help="Show where the time of a recorded playbook run went"
+        )
+        self._add_common_cluster_args(parser)
+        parser.add_argument(
+            "run",
+            nargs="?",
+            help="Run to show (prefix of its name, e.g. 20250101 or a full run id), the latest one by default"
+        )
+        parser.add_argument(
+            "--diff",
+            metavar="RUN",
+            help="Compare with an earlier run, task by task"
+        )
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=15,
+            help="Rows per table (default: 15)"
+        )
+        parser.add_argument(
+            "--list",
+            action="store_true",
+            help="List the recorded runs of the cluster"
+        )
+
     def _setup_checkout_command(self) -> None:
         """Setup 'checkout' command"""
         parser = self.subparsers.add_parser(
@@ -145,7 +269,7 @@ class KubeautoCLI:
             "start",
             help="Start all cluster services"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_stop_command(self) -> None:
         """Setup 'stop' command"""
@@ -153,7 +277,7 @@ class KubeautoCLI:
             "stop",
             help="Stop all cluster services"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_upgrade_command(self) -> None:
         """Setup 'upgrade' command"""
@@ -161,7 +285,7 @@ class KubeautoCLI:
             "upgrade",
             help="Upgrade the cluster components"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_backup_command(self) -> None:
         """Setup 'backup' command"""
@@ -169,7 +293,7 @@ class KubeautoCLI:
             "backup",
             help="Backup cluster state (etcd snapshot)"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_restore_command(self) -> None:
         """Setup 'restore' command"""
@@ -177,7 +301,7 @@ class KubeautoCLI:
             "restore",
             help="Restore cluster from backup"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_destroy_command(self) -> None:
         """Setup 'destroy' command"""
@@ -185,7 +309,7 @@ class KubeautoCLI:
             "destroy",
             help="Destroy the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_add_etcd_command(self) -> None:
         """Setup 'add-etcd' command"""
@@ -193,7 +317,7 @@ class KubeautoCLI:
             "add-etcd",
             help="Add an etcd node to the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
             "ip",
             help="IP address of the new etcd node"
@@ -211,7 +335,7 @@ class KubeautoCLI:
             "add-master",
             help="Add a master node to the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
             "ip",
             help="IP address of the new master node"
@@ -229,16 +353,18 @@ class KubeautoCLI:
             "add-node",
             help="Add a worker node to the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
-            "ip",
-            help="IP address of the new worker node"
+            "nodes",
+            nargs="*",
+            metavar="IP [EXTRA_INFO]",
+            help="IP addresses of the new worker nodes, each optionally followed by its additional "
+                 "information as key=value words (e.g. k8s_nodename=worker-01)"
         )
         parser.add_argument(
-            "extra_info",
-            nargs="?",
-            default="",
-            help="Additional node information (optional)"
+            "-f", "--file",
+            type=Path,
+            help="File listing the nodes to add, one 'IP [EXTRA_INFO]' per line, # starts a comment"
         )
 
     def _setup_del_etcd_command(self) -> None:
@@ -247,7 +373,7 @@ class KubeautoCLI:
             "del-etcd",
             help="Remove an etcd node from the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
             "ip",
             help="IP address of the etcd node to remove"
@@ -259,7 +385,7 @@ class KubeautoCLI:
             "del-master",
             help="Remove a master node from the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
             "ip",
             help="IP address of the master node to remove"
@@ -271,10 +397,29 @@ class KubeautoCLI:
             "del-node",
             help="Remove a worker node from the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
         parser.add_argument(
-            "ip",
-            help="IP address of the worker node to remove"
+            "ips",
+            nargs="*",
+            metavar="IP",
+            help="IP addresses of the worker nodes to remove"
+        )
+        parser.add_argument(
+            "-f", "--file",
+            type=Path,
+            help="File listing the nodes to remove, one IP per line, # starts a comment"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=self.kube_constant.DRAIN_CONCURRENCY,
+            help=f"Nodes drained at the same time (default: {self.kube_constant.DRAIN_CONCURRENCY})"
+        )
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=self.kube_constant.DRAIN_TIMEOUT,
+            help=f"Seconds each node may take to drain (default: {self.kube_constant.DRAIN_TIMEOUT})"
         )
 
     def _setup_kca_renew_command(self) -> None:
@@ -283,7 +428,7 @@ class KubeautoCLI:
             "kca-renew",
             help="Force renew CA certificates and all other certs"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
     def _setup_kcfg_adm_command(self) -> None:
         """Setup 'kcfg-adm' command"""
@@ -291,7 +436,7 @@ class KubeautoCLI:
             "kcfg-adm",
             help="Manage kubeconfig users for the cluster"
         )
-        self._add_common_cluster_args(parser)
+        self._add_common_cluster_args(parser, playbooks=True)
 
         action_group = parser.add_mutually_exclusive_group(required=True)
         action_group.add_argument(
@@ -390,6 +535,102 @@ class KubeautoCLI:
             metavar="COMPONENT",
             help="Download specific extra component (required specific component)"
         )
+        component_group.add_argument(
+            "-P", "--push-archive",
+            metavar="TAR",
+            nargs="+",
+            help="Push saved image tarballs (or images of the layer store) to the local registry "
+                 "through the registry API (no docker daemon)"
+        )
+        component_group.add_argument(
+            "--rollback",
+            metavar="BUNDLE",
+            choices=["k8s_bin", "ext_bin"],
+            help="Switch k8s_bin or ext_bin back to the version active before the last install"
+        )
+        component_group.add_argument(
+            "-U", "--du",
+            action="store_true",
+            help="Show disk usage of saved images and how much shared layers save"
+        )
+
+        pipeline_group = parser.add_argument_group("image pipeline options (-D/-X/-E/-P)")
+        pipeline_group.add_argument(
+            "-j", "--parallel",
+            metavar="N",
+            type=int,
+            default=self.kube_constant.REGISTRY_CONCURRENCY,
+            help=f"Images pulled and pushed concurrently (default: {self.kube_constant.REGISTRY_CONCURRENCY})"
+        )
+        pipeline_group.add_argument(
+            "--retries",
+            metavar="N",
+            type=int,
+            default=self.kube_constant.REGISTRY_RETRIES,
+            help=f"Attempts per image pull or push (default: {self.kube_constant.REGISTRY_RETRIES})"
+        )
+
+    def _setup_bundle_command(self) -> None:
+        """Setup 'bundle' command"""
+        parser = self.subparsers.add_parser(
+            "bundle",
+            help="Export or import a single-file offline bundle"
+        )
+        parser.add_argument(
+            "action",
+            choices=["export", "import", "list"],
+            help="export: pack what download installed; import: install from a bundle; list: show its components"
+        )
+        parser.add_argument(
+            "file",
+            type=Path,
+            help="Bundle file"
+        )
+        parser.add_argument(
+            "--components",
+            nargs="+",
+            metavar="COMPONENT",
+            help="Components to export or import (default: all), see 'bundle list'"
+        )
+        parser.add_argument(
+            "-c", "--cluster",
+            metavar="CLUSTER",
+            help="Import only what this cluster needs (cluster name or directory with its config.yml and hosts)"
+        )
+        parser.add_argument(
+            "--no-resume",
+            action="store_true",
+            help="Restart an interrupted import from scratch"
+        )
+
+    def _setup_cache_command(self) -> None:
+        """Setup 'cache' command"""
+        parser = self.subparsers.add_parser(
+            "cache",
+            help="Show or prune the download cache"
+        )
+        parser.add_argument(
+            "action",
+            choices=["stats", "prune"],
+            help="stats: artifacts, hits/misses and pins; prune: evict least recently used artifacts"
+        )
+        parser.add_argument(
+            "--budget",
+            type=float,
+            metavar="GB",
+            help=f"Size budget of the cache (default: {self.kube_constant.CACHE_BUDGET_GB}, 0 means no limit)"
+        )
+        parser.add_argument(
+            "--max-age",
+            type=int,
+            metavar="DAYS",
+            help="Also evict artifacts unused for DAYS days"
+        )
+        parser.add_argument(
+            "-n", "--dry-run",
+            action="store_true",
+            help="Show what prune would evict without deleting anything"
+        )
 
     def _setup_docker_command(self) -> None:
         """Setup 'docker' command"""
@@ -478,6 +719,8 @@ class KubeautoCLI:
             "setup": self._handle_setup,
             "list": self._handle_list,
             "checkout": self._handle_checkout,
+            "fleet": self._handle_fleet,
+            "profile": self._handle_profile,
             "start-aio": self._handle_start_aio,
 
             # Cluster operation commands
@@ -502,6 +745,8 @@ class KubeautoCLI:
 
             # Download commands
             "download": self._handle_download,
+            "bundle": self._handle_bundle,
+            "cache": self._handle_cache,
 
             # Docker commands
             "docker": self._handle_docker,
@@ -524,8 +769,11 @@ class KubeautoCLI:
 
     def _handle_setup(self, args: argparse.Namespace) -> None:
         """Handle 'setup' command"""
-        cm = ClusterManager()
-        cm.setup_cluster(args.cluster, args.step, args.extra_args)
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
+        if (args.resume or args.from_step or args.incremental or args.explain) and args.step not in ("all", "90"):
+            self.parser.error("--resume, --from, --incremental and --explain only apply to setup all")
+        cm.setup_cluster(args.cluster, args.step, args.extra_args, args.max_failures, args.resume, args.from_step,
+                         args.only_failed_hosts, args.incremental, args.explain)
 
     def _handle_list(self, args: argparse.Namespace) -> None:
         """Handle 'list' command"""
@@ -542,6 +790,104 @@ class KubeautoCLI:
         cm = ClusterManager()
         cm.checkout_cluster(args.cluster)
 
+    def _handle_fleet(self, args: argparse.Namespace) -> None:
+        """Handle 'fleet' command"""
+        from .fleet import FleetStore
+
+        settings = {}
+        for setting in args.setting or []:
+            key, sep, pattern = setting.partition("=")
+            if not sep:
+                self.parser.error(f"--setting expects KEY=PATTERN, got {setting}")
+            settings[key] = pattern
+
+        cm = ClusterManager()
+        start = time.perf_counter()
+        with FleetStore(cm.clusters_dir) as fleet:
+            synced = fleet.sync(force=args.force)
+            if args.query == "sync":
+                logger.info(f"{synced} clusters re-read", extra={"to_stdout": True})
+                return
+
+            if args.query == "nodes":
+                rows = fleet.nodes(args.ip, args.role, args.cluster)
+                logger.info(f"{'CLUSTER':<24} {'ROLE':<8} {'IP':<16} VARS", extra={"to_stdout": True})
+                for node in rows:
+                    logger.info(f"{node.cluster:<24} {node.role:<8} {node.ip:<16} "
+                                f"{' '.join(f'{k}={v}' for k, v in node.extra_info.items())}",
+                                extra={"to_stdout": True})
+            else:
+                rows = fleet.clusters(settings)
+                logger.info(f"{'CLUSTER':<24} {'K8S':<10} {'NETWORK':<12} {'NODES':>5}  LAST OPERATION",
+                            extra={"to_stdout": True})
+                for cluster in rows:
+                    last = "-"
+                    if cluster.last_operation:
+                        at = datetime.fromtimestamp(cluster.last_operation_at).strftime("%Y-%m-%d %H:%M")
+                        last = f"{cluster.last_operation} ({cluster.last_status}, {at})"
+                    logger.info(f"{cluster.name:<24} {cluster.config.get('K8S_VER', '-'):<10} "
+                                f"{cluster.config.get('CLUSTER_NETWORK', '-'):<12} {len(cluster.hosts):>5}  {last}",
+                                extra={"to_stdout": True})
+        logger.info(f"{len(rows)} rows in {(time.perf_counter() - start) * 1000:.1f} ms "
+                    f"({synced} clusters re-read)", extra={"to_stdout": True})
+
+    def _handle_profile(self, args: argparse.Namespace) -> None:
+        """Handle 'profile' command"""
+        from .profiler import RunProfile, diff_runs, find_run, list_runs
+
+        cm = ClusterManager()
+        cluster_dir = cm.clusters_dir / args.cluster
+        if not cluster_dir.exists():
+            raise FileNotFoundError(f"Cluster {args.cluster} not found")
+        out = {"to_stdout": True}
+
+        if args.list:
+            logger.info(f"{'RUN':<40} {'PLAYBOOK':<24} {'WALL(s)':>9}  RESULT", extra=out)
+            for path in list_runs(cluster_dir):
+                run = RunProfile.load(path)
+                result = "aborted" if run.aborted else ("running" if run.returncode is None else
+                                                        f"exit {run.returncode}")
+                logger.info(f"{run.run_id:<40} {run.playbook:<24} {run.wall:>9.1f}  {result}", extra=out)
+            return
+
+        run = RunProfile.load(find_run(cluster_dir, args.run))
+        if args.diff:
+            before = RunProfile.load(find_run(cluster_dir, args.diff))
+            logger.info(f"{before.run_id} -> {run.run_id}: {before.wall:.1f}s -> {run.wall:.1f}s "
+                        f"({run.wall - before.wall:+.1f}s), fact gathering {before.facts_wall:.1f}s -> "
+                        f"{run.facts_wall:.1f}s", extra=out)
+            logger.info(f"{'BEFORE(s)':>10} {'AFTER(s)':>10} {'DELTA(s)':>10}  {'ROLE':<20} TASK", extra=out)
+            for (play, role, task), seconds_before, seconds_after in diff_runs(before, run)[:args.top]:
+                delta = seconds_after - seconds_before
+                logger.info(f"{seconds_before:>10.1f} {seconds_after:>10.1f} {delta:>+10.1f}  {role or '-':<20} {task}",
+                            extra=out)
+            return
+
+        facts_share = run.facts_wall / run.wall * 100 if run.wall else 0.0
+        logger.info(f"Run {run.run_id} ({run.playbook}): {run.wall:.1f}s, "
+                    f"{'aborted' if run.aborted else f'exit {run.returncode}'}, {len(run.tasks)} tasks, "
+                    f"{len(run.hosts)} hosts", extra=out)
+        logger.info(f"Fact gathering: {run.facts_wall:.1f}s ({facts_share:.1f}% of the run) over "
+                    f"{sum(t.is_facts for t in run.tasks)} plays", extra=out)
+
+        logger.info("Slowest tasks:", extra=out)
+        logger.info(f"{'WALL(s)':>9} {'HOSTS':>6} {'SLOWEST HOST':<24} {'RETRIES':>7}  "
+                    f"{'ROLE':<20} TASK", extra=out)
+        for t in run.slowest_tasks(args.top):
+            slowest = f"{t.slowest_host} {t.slowest:.1f}s" if t.slowest_host else "-"
+            logger.info(f"{t.wall:>9.1f} {t.hosts:>6} {slowest:<24} {t.retries:>7}  {t.role or '-':<20} {t.task}",
+                        extra=out)
+
+        logger.info("Slowest roles:", extra=out)
+        logger.info(f"{'WALL(s)':>9} {'TASKS':>6}  ROLE", extra=out)
+        for role, wall, tasks in run.roles()[:args.top]:
+            logger.info(f"{wall:>9.1f} {tasks:>6}  {role}", extra=out)
+
+        logger.info("Busiest hosts (task seconds summed):", extra=out)
+        logger.info(f"{'BUSY(s)':>9}  HOST", extra=out)
+        for host, seconds in sorted(run.hosts.items(), key=lambda h: h[1], reverse=True)[:args.top]:
+            logger.info(f"{seconds:>9.1f}  {host}", extra=out)
+
     def _handle_start_aio(self, args: argparse.Namespace) -> None:
         """Handle 'start-aio' command"""
         cm = ClusterManager()
@@ -549,72 +895,103 @@ class KubeautoCLI:
 
     def _handle_start(self, args: argparse.Namespace) -> None:
         """Handle 'start' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.cluster_command(args.cluster, "start")
 
     def _handle_stop(self, args: argparse.Namespace) -> None:
         """Handle 'stop' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.cluster_command(args.cluster, "stop")
 
     def _handle_upgrade(self, args: argparse.Namespace) -> None:
         """Handle 'upgrade' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.cluster_command(args.cluster, "upgrade")
 
     def _handle_backup(self, args: argparse.Namespace) -> None:
         """Handle 'backup' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.cluster_command(args.cluster, "backup")
 
     def _handle_restore(self, args: argparse.Namespace) -> None:
         """Handle 'restore' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.cluster_command(args.cluster, "restore")
 
     def _handle_destroy(self, args: argparse.Namespace) -> None:
         """Handle 'destroy' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.cluster_command(args.cluster, "destroy")
 
     def _handle_add_etcd(self, args: argparse.Namespace) -> None:
         """Handle 'add-etcd' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.add_node(args.cluster, args.ip, "etcd", args.extra_info)
 
     def _handle_add_master(self, args: argparse.Namespace) -> None:
         """Handle 'add-master' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.add_node(args.cluster, args.ip, "master", args.extra_info)
 
     def _handle_add_node(self, args: argparse.Namespace) -> None:
         """Handle 'add-node' command"""
-        cm = ClusterManager()
-        cm.add_node(args.cluster, args.ip, "node", args.extra_info)
+        nodes: List[Tuple[str, str]] = []
+        lines = [args.nodes]
+        if args.file:
+            if not args.file.is_file():
+                raise FileNotFoundError(f"Node list {args.file} not found")
+            lines += [line.split("#", 1)[0].split() for line in args.file.read_text().splitlines()]
+
+        # key=value words are extra information of the node before them, anything else must be an IP
+        invalid = []
+        for words in lines:
+            for word in words:
+                if validate_ip(word):
+                    nodes.append((word, ""))
+                elif nodes and re.fullmatch(r"\w+=\S*", word):
+                    ip, extra_info = nodes[-1]
+                    nodes[-1] = (ip, f"{extra_info} {word}".strip())
+                else:
+                    invalid.append(word)
+        if invalid:
+            raise InvalidIPError(f"Invalid IP address: {', '.join(invalid)} (extra information is key=value)")
+        if not nodes:
+            raise ValueError("No node to add, give IP addresses or --file")
+
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
+        cm.add_nodes(args.cluster, nodes)
 
     def _handle_del_etcd(self, args: argparse.Namespace) -> None:
         """Handle 'del-etcd' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.remove_node(args.cluster, args.ip, "etcd")
 
     def _handle_del_master(self, args: argparse.Namespace) -> None:
         """Handle 'del-master' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.remove_node(args.cluster, args.ip, "master")
 
     def _handle_del_node(self, args: argparse.Namespace) -> None:
         """Handle 'del-node' command"""
-        cm = ClusterManager()
-        cm.remove_node(args.cluster, args.ip, "node")
+        ips = list(args.ips)
+        if args.file:
+            if not args.file.is_file():
+                raise FileNotFoundError(f"Node list {args.file} not found")
+            ips += [word for line in args.file.read_text().splitlines() for word in line.split("#", 1)[0].split()]
+        if not ips:
+            raise ValueError("No node to remove, give IP addresses or --file")
+
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
+        cm.remove_nodes(args.cluster, ips, args.concurrency, args.timeout)
 
     def _handle_kca_renew(self, args: argparse.Namespace) -> None:
         """Handle 'kca-renew' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         cm.renew_ca_certs(args.cluster)
 
     def _handle_kcfg_adm(self, args: argparse.Namespace) -> None:
         """Handle 'kcfg-adm' command"""
-        cm = ClusterManager()
+        cm = ClusterManager(args.ansible_profile, args.refresh_facts)
         if args.add:
             cm.kubeconfig_admin(args.cluster, "add", args.user, args.type, args.expiry)
         elif args.delete:
@@ -626,22 +1003,24 @@ class KubeautoCLI:
 
     def _handle_download(self, args: argparse.Namespace) -> None:
         """Handle download command with version enforcement"""
+        from .downloader import DownloadManager
+
         dm = DownloadManager()
 
         # required at least one argument
         if not any([args.all, args.docker, args.k8s_bin, args.ext_bin, args.kubeauto, args.harbor,
-                    args.default_images, args.ext_images]):
+                    args.default_images, args.ext_images, args.push_archive, args.du, args.rollback]):
             self.subparsers.choices["download"].print_help()
             raise DownloadError("Download command requires at least one argument")
 
         # handle param conflict manually
         if args.all and any([args.docker, args.k8s_bin, args.ext_bin, args.kubeauto, args.harbor,
-                             args.default_images, args.ext_images]):
+                             args.default_images, args.ext_images, args.push_archive, args.du, args.rollback]):
             self.subparsers.choices["download"].print_help()
             raise DownloadError("Download option --all/-D cannot be used with other download options")
 
         if args.all:
-            dm.download_all()
+            dm.download_all(args.parallel, args.retries)
         else:
             if args.docker:
                 if self.docker.is_docker_installed:
@@ -671,14 +1050,56 @@ class KubeautoCLI:
                 dm.get_harbor_offline_pkg(args.harbor)
 
             if args.default_images:
-                dm.get_default_images()
+                dm.get_default_images(args.parallel, args.retries)
 
             if args.ext_images:
-                dm.get_extra_images(args.ext_images)
+                dm.get_extra_images(args.ext_images, args.parallel, args.retries)
+
+            if args.push_archive:
+                dm.registry.push_archives(args.push_archive, args.parallel)
+
+            if args.rollback:
+                dm.rollback(args.rollback)
+
+            if args.du:
+                dm.show_store_usage()
+
+        if any([args.all, args.docker, args.k8s_bin, args.ext_bin, args.kubeauto, args.harbor,
+                args.default_images, args.ext_images]):
+            dm.cache.enforce_budget()
+
+    def _handle_bundle(self, args: argparse.Namespace) -> None:
+        """Handle 'bundle' command"""
+        from .bundle import BundleManager
+
+        bm = BundleManager()
+        if args.action != "import" and (args.cluster or args.no_resume):
+            self.subparsers.choices["bundle"].print_help()
+            raise DownloadError("--cluster and --no-resume only apply to 'bundle import'")
+
+        if args.action == "export":
+            bm.export_bundle(args.file, args.components)
+        elif args.action == "import":
+            bm.import_bundle(args.file, args.cluster, args.components, resume=not args.no_resume)
+        else:
+            bm.list_bundle(args.file)
+
+    def _handle_cache(self, args: argparse.Namespace) -> None:
+        """Handle 'cache' command"""
+        from .cache import CacheManager
+
+        cache = CacheManager()
+        if args.action == "stats":
+            if args.budget is not None or args.max_age is not None or args.dry_run:
+                self.subparsers.choices["cache"].print_help()
+                raise DownloadError("--budget, --max-age and --dry-run only apply to 'cache prune'")
+            cache.show_stats()
+        else:
+            cache.prune(args.budget, args.max_age, args.dry_run)
 
     def _handle_docker(self, args: argparse.Namespace) -> None:
         """Handle 'docker' command"""
-        docker = DockerManager()
+        docker = self.docker
 
         # required at least one argument
         if not any([args.set_proxy, args.del_proxy, args.no_proxy, args.remove, args.remove_all, args.remove_existed]):
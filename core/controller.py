@@ -1,24 +1,43 @@
 """
 Main cluster operations for kubeauto
 """
-import ipaddress
+import json
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import List, Optional
-from common.utils import run_command, validate_ip, confirm_action
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from common.utils import run_command, validate_ip, confirm_action, read_config_values, rmrf
 from common.exceptions import (
-    ClusterExistsError, ClusterNotFoundError,
+    ClusterExistsError, ClusterNotFoundError, CommandExecutionError,
     InvalidIPError, NodeExistsError, NodeNotFoundError, ClusterNewError,
 )
 from common.logger import setup_logger
 from common.constants import KubeConstant
+from .checkpoint import Checkpoints
+from .inputs import InputStore, config_blocks, host_inputs, stage_inputs
+from .facts import fact_cache_env, invalidate_facts
+from .fleet import track_operation
+from .inventory import Inventory
+from .kubeconfig import FingerprintIndex
+from .playbook import PlaybookResult, raise_for_result, run_playbook
+from .profiler import RunRecorder
+from .stages import SETUP_STAGES, Stage
+from .tuning import tune, warm_up_ssh
 
 logger = setup_logger(__name__)
 
 
 class ClusterManager:
-    def __init__(self):
+    def __init__(self, ansible_profile: Optional[str] = None, refresh_facts: bool = False):
         self.kube_constant = KubeConstant()
+        self.ansible_profile = ansible_profile or self.kube_constant.ANSIBLE_PROFILE
+        self.refresh_facts = refresh_facts
+        self._inputs_cache: Dict[Tuple[str, str], Dict] = {}
         self.base_path = Path(self.kube_constant.BASE_PATH)
         self.kube_bin_dir = Path(self.kube_constant.KUBE_BIN_DIR)
         self.extra_bin_dir = Path(self.kube_constant.EXTRA_BIN_DIR)
@@ -41,26 +60,16 @@ class ClusterManager:
         return clusters
 
     def get_current_cluster(self) -> Optional[str]:
-        """Get current cluster from kubeconfig"""
+        """Get current cluster from kubeconfig, through the fingerprint index: no process is spawned"""
         current_config = Path.home() / ".kube/config"
-        if not current_config.exists():
+        if not current_config.exists() or not self.clusters_dir.exists():
             return None
 
         try:
-            # Get MD5 of current config (excluding server field)
-            md5_cmd = ["sed", "/server/d", str(current_config), "|", "md5sum"]
-            current_md5 = run_command(md5_cmd, shell=True).stdout.split()[0]
-
-            # Compare with cluster configs
-            for cluster in self.list_clusters():
-                cluster_config = self.clusters_dir / cluster / "kubectl.kubeconfig"
-                cluster_md5_cmd = ["sed", "/server/d", str(cluster_config), "|", "md5sum"]
-                cluster_md5 = run_command(cluster_md5_cmd, shell=True).stdout.split()[0]
-
-                if cluster_md5 == current_md5:
-                    return cluster
-
-            return None
+            index = FingerprintIndex(self.clusters_dir)
+            current = index.match(current_config)
+            index.save()
+            return current
         except Exception as e:
             logger.error(f"Error getting current cluster: {e}")
             return None
@@ -113,13 +122,21 @@ class ClusterManager:
         logger.info(f"1. Configure {cluster_hosts}", extra={"to_stdout": True})
         logger.info(f"2. Configure {cluster_config}", extra={"to_stdout": True})
 
-    def setup_cluster(self, name: str, step: str, extra_args: Optional[list[str]] = None) -> None:
+    def setup_cluster(self, name: str, step: str, extra_args: Optional[list[str]] = None,
+                      max_failures: Optional[int] = None, resume: bool = False, from_step: Optional[str] = None,
+                      only_failed_hosts: bool = False, incremental: bool = False, explain: bool = False) -> None:
         """
         Set up a cluster with specific step
 
         name: Cluster name
         step: Setup step (01-07, 10, 11, 90 or step name)
         extra_args: Additional arguments to pass to ansible-playbook
+        max_failures: Abort the playbook once more hosts than that have failed
+        resume: Step all only, skip the stages already done on all their hosts
+        from_step: Step all only, start from this step or stage, the ones it depends on are skipped
+        only_failed_hosts: Run on the hosts the last setup did not complete on
+        incremental: Step all only, run each stage on the hosts whose inputs changed since its last success
+        explain: Step all only, tell why each stage would run or be skipped, and stop there
         """
         self._validate_cluster(name)
 
@@ -152,15 +169,34 @@ class ClusterManager:
             return
 
         extra_args = extra_args or []
+        if playbook == "90.setup.yml":
+            from_stages = None
+            if from_step:
+                from_stages = [stage.name for stage in SETUP_STAGES if stage.name == from_step]
+                from_stages = from_stages or [stage.name for stage in SETUP_STAGES
+                                              if stage.step == playbook_map.get(from_step, "").split(".")[0]]
+                if not from_stages:
+                    raise ValueError(f"Invalid setup step or stage: {from_step}")
+            self._setup_all(name, extra_args, max_failures, resume, from_stages, only_failed_hosts,
+                            incremental or explain, explain)
+            return
 
-        cmd = [
-            "ansible-playbook",
-            "-i", str(self.clusters_dir / name / "hosts"),
-            "-e", f"@{self.clusters_dir / name / 'config.yml'}",
-            *extra_args,
-            str(self.playbooks_dir / playbook)
-        ]
-
+        # the stages of 'setup all' this step is made of, checkpointed as they would be there
+        step_stages = [stage for stage in SETUP_STAGES if stage.step == playbook.split(".")[0]]
+        inventory = Inventory.load(self.clusters_dir / name / "hosts")
+        checkpoints = Checkpoints(self.clusters_dir / name)
+        inputs = InputStore(self.clusters_dir / name)
+        hosts = list(dict.fromkeys(host for stage in step_stages for host in stage.hosts(inventory)))
+        if only_failed_hosts:
+            hosts = list(dict.fromkeys(host for stage in step_stages
+                                       for host in checkpoints.pending_hosts(stage.name, stage.hosts(inventory))))
+            if not hosts:
+                logger.info(f"Step {step} is done on every host of cluster {name}, nothing to re-run",
+                            extra={"to_stdout": True})
+                return
+            extra_args = ["--limit", ",".join(hosts), *extra_args]
+
+        cmd = self._playbook_cmd(name, self.playbooks_dir / playbook, *extra_args)
         logger.info(f"Running command: {' '.join(cmd)}", extra={"to_stdout": True})
 
         # Show component versions
@@ -169,7 +205,178 @@ class ClusterManager:
         if not confirm_action(f"cluster:{name} setup step:{step} begins"):
             return
 
-        run_command(cmd, capture_output=False)
+        with track_operation(self.clusters_dir, name, f"setup {step}"):
+            result = None
+            try:
+                result = self._run_playbook(name, cmd, check=False, max_failures=max_failures)
+            finally:
+                for stage in step_stages:
+                    stage_hosts = set(stage.hosts(inventory))
+                    self._record_stage(name, inventory, stage, [h for h in hosts if h in stage_hosts], result,
+                                       checkpoints, inputs)
+            if result.returncode != 0:
+                raise_for_result(cmd, result)
+
+    def _setup_all(self, name: str, extra_args: List[str], max_failures: Optional[int] = None,
+                   resume: bool = False, from_stages: Optional[List[str]] = None,
+                   only_failed_hosts: bool = False, incremental: bool = False, explain: bool = False) -> None:
+        """
+        Set up a cluster with every stage of SETUP_STAGES, each as its own playbook run
+
+        A stage starts once the stages it depends on are done, up to SETUP_CONCURRENCY at the
+        same time; the output of each run goes to clusters/<name>/logs/<stage>.log. A failed
+        stage stops the stages depending on it, the others go on.
+
+        The outcome of every stage on every host is checkpointed. resume skips the stages done
+        on all their hosts, from_stages skips those that are not one of them or after them, and
+        only_failed_hosts runs each stage on its hosts not checkpointed as ok. incremental then
+        keeps the hosts whose inputs (core/inputs.py) changed since the last success of the
+        stage on them, and explain prints what changed instead of running anything.
+        """
+        from common.dag import TaskGraph
+
+        if self.refresh_facts:
+            # once for all the stages, the first ones start together
+            invalidate_facts(self.clusters_dir / name)
+            self.refresh_facts = False
+        inventory = Inventory.load(self.clusters_dir / name / "hosts")
+        checkpoints = Checkpoints(self.clusters_dir / name)
+        inputs = InputStore(self.clusters_dir / name)
+        logs_dir = self.clusters_dir / name / "logs"
+        logs_dir.mkdir(exist_ok=True)
+
+        # --from: the stages given and every stage depending on them, directly or not
+        selected = None
+        if from_stages:
+            selected = set(from_stages)
+            for stage in SETUP_STAGES:
+                if selected & set(stage.deps):
+                    selected.add(stage.name)
+
+        graph = TaskGraph(self.kube_constant.SETUP_CONCURRENCY)
+        plan, explained = [], []
+        logger.info(f"{'STAGE':<16} {'PLAYBOOK':<24} {'HOSTS':>5}  {'AFTER':<30} RUN", extra={"to_stdout": True})
+        for stage in SETUP_STAGES:
+            hosts = stage.hosts(inventory)
+            if stage.optional and not hosts:
+                continue
+            deps = [dep for dep in stage.deps if dep in graph.tasks]
+
+            run = hosts
+            if selected is not None and stage.name not in selected:
+                run, why = [], "no, before --from"
+            elif resume and checkpoints.done(stage.name, hosts):
+                run, why = [], "no, done"
+            elif only_failed_hosts and stage.name in checkpoints.stages:
+                run = checkpoints.pending_hosts(stage.name, hosts)
+                why = f"{len(run)} failed host(s)" if run else "no, done"
+            else:
+                why = "yes"
+            if incremental and run:
+                changes = {host: inputs.changes(stage.name, host, *self._stage_inputs(name, inventory, stage, host))
+                           for host in run}
+                run = [host for host in run if changes[host]]
+                why = ("no, inputs unchanged" if not run else
+                       f"{len(run)} host(s) with changed inputs" if len(run) < len(hosts) else "yes, inputs changed")
+                explained.append((stage, changes))
+            elif explain:
+                explained.append((stage, {}))
+            plan.append((stage, run))
+            graph.add(stage.name, lambda stage=stage, run=run: self._run_stage(
+                name, inventory, stage, run, len(run) < len(hosts), extra_args, max_failures, logs_dir,
+                checkpoints, inputs), deps)
+            logger.info(f"{stage.name:<16} {stage.playbook:<24} {len(hosts):>5}  {', '.join(deps) or '-':<30} {why}",
+                        extra={"to_stdout": True})
+
+        if explain:
+            self._explain_stages(name, explained, inputs)
+            return
+        if not any(run for _, run in plan):
+            logger.info(f"Every stage is done on cluster {name}, nothing to run", extra={"to_stdout": True})
+            return
+
+        self._show_component_versions(name)
+
+        if not confirm_action(f"cluster:{name} setup step:all begins"):
+            return
+
+        # stages run from scratch start without the outcome of an earlier setup
+        checkpoints.reset(stage.name for stage, run in plan if run and not (resume or only_failed_hosts or incremental))
+        operation = " ".join(["setup all"] + (["--resume"] if resume else []) +
+                             (["--only-failed-hosts"] if only_failed_hosts else []) +
+                             (["--incremental"] if incremental else []))
+        with track_operation(self.clusters_dir, name, operation):
+            failed = graph.run()
+            graph.report(f"Setup timeline of cluster {name} (* critical path):")
+            if failed:
+                skipped = [task.name for task in graph.tasks.values() if task.status == "skipped"]
+                raise CommandExecutionError(
+                    f"Setup of cluster {name} failed in {', '.join(task.name for task in failed)}" +
+                    (f", not run: {', '.join(skipped)}" if skipped else "") + f", see the logs in {logs_dir}, "
+                    f"continue with: kubeauto setup --resume {name} all")
+
+    def _run_stage(self, cluster: str, inventory: Inventory, stage: Stage, hosts: List[str], limited: bool,
+                   extra_args: List[str], max_failures: Optional[int], logs_dir: Path, checkpoints: Checkpoints,
+                   inputs: InputStore) -> None:
+        if not hosts:
+            # skipped, the plan printed before the run says why
+            return
+        log = logs_dir / f"{stage.name}.log"
+        # a run narrowed to some hosts names them, which replaces the limit of the stage
+        limit = ["--limit", ",".join(hosts)] if limited else stage.args()
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / stage.playbook, *limit, *extra_args)
+        logger.info(f"Stage {stage.name} started on {len(hosts)} host(s), output in {log}", extra={"to_stdout": True})
+        result = None
+        try:
+            result = self._run_playbook(cluster, cmd, check=False, max_failures=max_failures, output=log)
+        finally:
+            self._record_stage(cluster, inventory, stage, hosts, result, checkpoints, inputs)
+        if result.returncode != 0:
+            raise_for_result(cmd, result)
+        logger.info(f"Stage {stage.name} done", extra={"to_stdout": True})
+
+    def _stage_inputs(self, cluster: str, inventory: Inventory, stage: Stage, host: str) -> Tuple[Dict, str]:
+        """(inputs of the playbook and roles of stage, digest of host), see core/inputs.py"""
+        key = (cluster, stage.name)
+        if key not in self._inputs_cache:
+            config_file = self.clusters_dir / cluster / "config.yml"
+            self._inputs_cache[key] = stage_inputs(
+                stage, self.playbooks_dir, self.base_path / "roles",
+                config_blocks(config_file) if config_file.exists() else {}, inventory,
+                (self.kube_bin_dir, self.extra_bin_dir))
+        return self._inputs_cache[key], host_inputs(inventory, host)
+
+    def _record_stage(self, cluster: str, inventory: Inventory, stage: Stage, hosts: List[str],
+                      result: Optional[PlaybookResult], checkpoints: Checkpoints, inputs: InputStore) -> None:
+        """Checkpoint a run of stage, and keep the inputs it succeeded with on each host"""
+        checkpoints.record(stage.name, stage.playbook, hosts, result)
+        done = [host for host in hosts if result and result.status(host) == "ok"]
+        if done:
+            units = self._stage_inputs(cluster, inventory, stage, done[0])[0]
+            inputs.record(stage.name, done, units, {host: host_inputs(inventory, host) for host in done})
+
+    def _explain_stages(self, cluster: str, explained: List[Tuple[Stage, Dict[str, List[Tuple[str, str]]]]],
+                        inputs: InputStore) -> None:
+        """Why each stage of setup all runs on its hosts or is skipped"""
+        out = {"to_stdout": True}
+        logger.info(f"Inputs of the stages of cluster {cluster} since their last successful run:", extra=out)
+        for stage, changes in explained:
+            changed = [host for host, found in changes.items() if found]
+            if not changes:
+                logger.info(f"{stage.name}: not run, see the plan above", extra=out)
+                continue
+            if not changed:
+                last = datetime.fromtimestamp(inputs.last_run(stage.name)).strftime("%Y-%m-%d %H:%M")
+                logger.info(f"{stage.name}: skipped, inputs unchanged since {last}", extra=out)
+                continue
+            logger.info(f"{stage.name}: runs on {len(changed)} of {len(changes)} host(s)", extra=out)
+            reasons: Dict[Tuple[str, str], List[str]] = {}
+            for host in changed:
+                for reason in changes[host]:
+                    reasons.setdefault(reason, []).append(host)
+            for (unit, what), hosts in reasons.items():
+                where = " ".join(hosts) if len(hosts) <= 3 else f"{len(hosts)} hosts"
+                logger.info(f"  {unit}: {what} ({where})", extra=out)
 
     def cluster_command(self, name: str, command: str) -> None:
         """Execute cluster-wide command (start, stop, upgrade, backup, restore, destroy)"""
@@ -189,19 +396,14 @@ class ClusterManager:
             logger.error(f"Invalid command: {command}", extra={"to_stdout": True})
             return
 
-        cmd = [
-            "ansible-playbook",
-            "-i", str(self.clusters_dir / name / "hosts"),
-            "-e", f"@{self.clusters_dir / name / 'config.yml'}",
-            str(self.playbooks_dir / playbook)
-        ]
-
+        cmd = self._playbook_cmd(name, self.playbooks_dir / playbook)
         logger.info(f"Running command: {' '.join(cmd)}", extra={"to_stdout": True})
 
         if not confirm_action(f"cluster:{name} {command} begins"):
             return
 
-        run_command(cmd, capture_output=False)
+        with track_operation(self.clusters_dir, name, command):
+            self._run_playbook(name, cmd)
 
     def checkout_cluster(self, name: str) -> None:
         """Switch to a cluster's kubeconfig"""
@@ -214,7 +416,19 @@ class ClusterManager:
         dest_config = Path.home() / ".kube/config"
         dest_config.parent.mkdir(exist_ok=True)
 
-        run_command(["cp", "-f", str(kubeconfig), str(dest_config)])
+        # copy then rename: kubectl never sees a half-written config
+        tmp = dest_config.with_name(f".config.{os.getpid()}.tmp")
+        try:
+            shutil.copyfile(kubeconfig, tmp)
+            os.chmod(tmp, kubeconfig.stat().st_mode & 0o777)
+            os.replace(tmp, dest_config)
+        except OSError as e:
+            rmrf(tmp)
+            raise ClusterNotFoundError(f"Failed to set {dest_config} from {kubeconfig}: {e}")
+
+        index = FingerprintIndex(self.clusters_dir)
+        index.set("@current", dest_config, index.fingerprint(name, kubeconfig))
+        index.save()
         logger.info(f"Set default kubeconfig: cluster {name} (current)", extra={"to_stdout": True})
 
     def start_aio_cluster(self) -> None:
@@ -253,6 +467,10 @@ class ClusterManager:
 
     def add_node(self, cluster: str, ip: str, role: str, extra_info: str = "") -> None:
         """Add a node to the cluster"""
+        if role == "node":
+            self.add_nodes(cluster, [(ip, extra_info)])
+            return
+
         self._validate_cluster(cluster)
         self._validate_ip(ip)
 
@@ -260,12 +478,12 @@ class ClusterManager:
         if not hosts_file.exists():
             raise ClusterNotFoundError(f"Hosts file not found for cluster {cluster}")
 
-        # Check if node already exists
-        self._check_node_exists(hosts_file, ip, role)
-
-        # Add node to hosts file
-        node_line = f"{ip} {extra_info}".strip()
-        self._add_to_hosts_section(hosts_file, role, node_line)
+        # Add node to hosts file, unless it is already there
+        inventory = Inventory.load(hosts_file)
+        inventory.add(Inventory.role_section(role), ip, extra_info)
+        inventory.save()
+        # the address may have belonged to another machine before
+        invalidate_facts(self.clusters_dir / cluster, [ip])
 
         # Run appropriate playbook
         playbook = {
@@ -277,27 +495,94 @@ class ClusterManager:
         if not playbook:
             raise ValueError(f"Invalid role: {role}")
 
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"NODE_TO_ADD={ip}",
-            "-e", f"@{self.clusters_dir / cluster / 'config.yml'}",
-            str(self.playbooks_dir / playbook)
-        ]
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / playbook, "-e", f"NODE_TO_ADD={ip}")
 
         logger.info(f"Adding {role} node {ip} to cluster {cluster}", extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        with track_operation(self.clusters_dir, cluster, f"add-{role} {ip}"):
+            self._run_playbook(cluster, cmd)
+
+            # After adding a new node, we still have to notify related services
+            if role == "etcd":
+                self._notify_etcd_apiserver(cluster)
+            elif role == "master":
+                self._restart_load_balancers(cluster)
+            elif role == "node":
+                pass
+
+    def add_nodes(self, cluster: str, nodes: List[Tuple[str, str]]) -> Dict[str, str]:
+        """
+        Add worker nodes, (ip, extra_info) each, with a single 22.addnode.yml run
+
+        Every IP is checked before anything changes and the hosts file is written once. Ansible
+        works on up to ANSIBLE_FORKS nodes at the same time and a node failing does not stop the
+        others. Nodes that did not make it are taken out of the hosts file again, so the same
+        command can be rerun with them. Returns ip -> ok, failed or unreachable.
+        """
+        self._validate_cluster(cluster)
+        if not nodes:
+            raise ValueError("No node to add")
 
-        # After adding a new node, we still have to notify related services
-        if role == "etcd":
-            self._notify_etcd_apiserver(cluster)
-        elif role == "master":
-            self._restart_load_balancers(cluster)
-        elif role == "node":
-            pass
+        hosts_file = self.clusters_dir / cluster / "hosts"
+        if not hosts_file.exists():
+            raise ClusterNotFoundError(f"Hosts file not found for cluster {cluster}")
+
+        ips = [ip for ip, _ in nodes]
+        invalid = [ip for ip in ips if not validate_ip(ip)]
+        if invalid:
+            raise InvalidIPError(f"Invalid IP address: {', '.join(invalid)}")
+        repeated = [ip for ip, count in Counter(ips).items() if count > 1]
+        if repeated:
+            raise InvalidIPError(f"IP address given more than once: {', '.join(repeated)}")
+
+        section = Inventory.role_section("node")
+        inventory = Inventory.load(hosts_file)
+        existing = [ip for ip in ips if inventory.has(section, ip)]
+        if existing:
+            raise NodeExistsError(f"Node already exists in {section} section: {', '.join(existing)}")
+        for ip, extra_info in nodes:
+            inventory.add(section, ip, extra_info)
+        inventory.save()
+        # the addresses may have belonged to other machines before
+        invalidate_facts(self.clusters_dir / cluster, ips)
+
+        # NODE_TO_ADD is the host pattern of the play, ip1,ip2,... targets the whole batch
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / "22.addnode.yml", "-e", f"NODE_TO_ADD={','.join(ips)}")
+
+        logger.info(f"Adding {len(ips)} worker node(s) to cluster {cluster}: {' '.join(ips)}",
+                    extra={"to_stdout": True})
+        operation = f"add-node {ips[0]}" if len(ips) == 1 else f"add-node {len(ips)} nodes"
+        with track_operation(self.clusters_dir, cluster, operation):
+            result = self._run_playbook(cluster, cmd, check=False)
+            # a node without any task result never got past the start of the play
+            results = {ip: result.status(ip) for ip in ips}
+            failed = [ip for ip in ips if results[ip] != "ok"]
+
+            print("%-40s %-12s" % ("NODE", "RESULT"))
+            for ip in ips:
+                print("%-40s %-12s" % (ip, results[ip]))
+
+            if failed:
+                inventory = Inventory.load(hosts_file)
+                for ip in failed:
+                    inventory.remove(section, ip)
+                inventory.save()
+                invalidate_facts(self.clusters_dir / cluster, failed)
+                raise CommandExecutionError(
+                    f"{len(failed)} of {len(ips)} node(s) failed to join cluster {cluster} and were removed from "
+                    f"its hosts file, rerun add-node with: {' '.join(failed)}")
+            if result.returncode != 0:
+                raise CommandExecutionError(f"ansible-playbook exited with code {result.returncode} after adding "
+                                            f"{' '.join(ips)} to cluster {cluster}")
+
+        logger.info(f"{len(ips)} worker node(s) added to cluster {cluster}", extra={"to_stdout": True})
+        return results
 
     def remove_node(self, cluster: str, ip: str, role: str) -> None:
         """Remove a node from the cluster"""
+        if role == "node":
+            self.remove_nodes(cluster, [ip])
+            return
+
         self._validate_cluster(cluster)
         self._validate_ip(ip)
 
@@ -306,7 +591,9 @@ class ClusterManager:
             raise ClusterNotFoundError(f"Hosts file not found for cluster {cluster}")
 
         # Check if node exists
-        self._check_node_not_exists(hosts_file, ip, role)
+        section = Inventory.role_section(role)
+        if not Inventory.load(hosts_file).has(section, ip):
+            raise NodeNotFoundError(f"Node {ip} not found in {section} section")
 
         # Run appropriate playbook
         playbook = {
@@ -318,30 +605,150 @@ class ClusterManager:
         if not playbook:
             raise ValueError(f"Invalid role: {role}")
 
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"NODE_TO_DEL={ip}",
-            "-e", f"CLUSTER={cluster}",
-            "-e", f"@{self.clusters_dir / cluster / 'config.yml'}",
-            str(self.playbooks_dir / playbook)
-        ]
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / playbook,
+                                 "-e", f"NODE_TO_DEL={ip}", "-e", f"CLUSTER={cluster}")
 
         logger.info(f"Removing {role} node {ip} from cluster {cluster}", extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        with track_operation(self.clusters_dir, cluster, f"del-{role} {ip}"):
+            self._run_playbook(cluster, cmd)
+
+            # Remove node from hosts file, as it is after the playbook
+            inventory = Inventory.load(hosts_file)
+            inventory.remove(section, ip)
+            inventory.save()
+            invalidate_facts(self.clusters_dir / cluster, [ip])
+
+            # After removing a node, we still have to notify related services
+            if role == "etcd":
+                self._notify_etcd_apiserver(cluster)
+            elif role == "master":
+                self._reconfigure_kubeconfig(cluster)
+                self._restart_load_balancers(cluster)
+                self._kubectl_del_master(cluster, ip)
+            elif role == "node":
+                pass
+
+    def remove_nodes(self, cluster: str, ips: List[str], concurrency: Optional[int] = None,
+                     timeout: Optional[int] = None) -> Dict[str, str]:
+        """
+        Remove worker nodes: confirm once, drain them concurrently, clean them in one 32.delnode.yml run
 
-        # Remove node from hosts file
-        self._remove_from_hosts_section(hosts_file, role, ip)
+        At most concurrency nodes drain at the same time and each gets timeout seconds. A node
+        that fails to drain is left untouched in the cluster; the others are cleaned, deleted
+        with a single kubectl call and dropped from the hosts file in one write.
+        Returns ip -> removed, drain failed or not cleaned (removed, cleanup on the host failed).
+        """
+        self._validate_cluster(cluster)
+        if not ips:
+            raise ValueError("No node to remove")
+        concurrency = concurrency or self.kube_constant.DRAIN_CONCURRENCY
+        timeout = timeout or self.kube_constant.DRAIN_TIMEOUT
+
+        hosts_file = self.clusters_dir / cluster / "hosts"
+        if not hosts_file.exists():
+            raise ClusterNotFoundError(f"Hosts file not found for cluster {cluster}")
 
-        # After removing a node, we still have to notify related services
-        if role == "etcd":
-            self._notify_etcd_apiserver(cluster)
-        elif role == "master":
-            self._reconfigure_kubeconfig(cluster)
-            self._restart_load_balancers(cluster)
-            self._kubectl_del_master(cluster, ip)
-        elif role == "node":
-            pass
+        invalid = [ip for ip in ips if not validate_ip(ip)]
+        if invalid:
+            raise InvalidIPError(f"Invalid IP address: {', '.join(invalid)}")
+        ips = list(dict.fromkeys(ips))
+
+        section = Inventory.role_section("node")
+        inventory = Inventory.load(hosts_file)
+        missing = [ip for ip in ips if not inventory.has(section, ip)]
+        if missing:
+            raise NodeNotFoundError(f"Node not found in {section} section: {', '.join(missing)}")
+        masters = inventory.hosts("kube_master")
+        if masters and set(masters) <= set(ips):
+            raise ValueError("You CAN NOT delete the last member of kube_master")
+
+        if not confirm_action(f"Removing {len(ips)} worker node(s) from cluster {cluster}: {' '.join(ips)}"):
+            return {}
+
+        results = {}
+        operation = f"del-node {ips[0]}" if len(ips) == 1 else f"del-node {len(ips)} nodes"
+        with track_operation(self.clusters_dir, cluster, operation):
+            # nodes that never joined have no name, there is nothing to drain or delete
+            names = self._node_names(cluster)
+            drain_opts = self._drain_options(cluster)
+            logger.info(f"Draining {len(ips)} node(s), {concurrency} at a time, {timeout}s each",
+                        extra={"to_stdout": True})
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(ips)))) as executor:
+                futures = {ip: executor.submit(self._drain_node, cluster, names[ip], drain_opts, timeout)
+                           for ip in ips if ip in names}
+                for ip, future in futures.items():
+                    error = future.result()
+                    if error:
+                        results[ip] = "drain failed"
+                        logger.error(f"Failed to drain node {names[ip]} ({ip}): {error}", extra={"to_stdout": True})
+            drained = [ip for ip in ips if ip not in results]
+
+            if drained:
+                cmd = self._playbook_cmd(cluster, self.playbooks_dir / "32.delnode.yml",
+                                         "-e", f"NODE_TO_DEL={','.join(drained)}", "-e", f"CLUSTER={cluster}")
+                result = self._run_playbook(cluster, cmd, check=False)
+                for ip in drained:
+                    # as before, data left on a node does not keep it in the cluster
+                    results[ip] = "removed" if result.status(ip) == "ok" else "not cleaned"
+
+                delete = [names[ip] for ip in drained if ip in names]
+                if delete:
+                    run_command([str(self.kube_bin_dir / "kubectl"), "--kubeconfig",
+                                 str(self.clusters_dir / cluster / "kubectl.kubeconfig"), "delete", "node", *delete],
+                                check=False, capture_output=False)
+
+                inventory = Inventory.load(hosts_file)
+                for ip in drained:
+                    inventory.remove(section, ip)
+                inventory.save()
+                invalidate_facts(self.clusters_dir / cluster, drained)
+
+            print("%-40s %-30s %-15s" % ("NODE", "NAME", "RESULT"))
+            for ip in ips:
+                print("%-40s %-30s %-15s" % (ip, names.get(ip, "-"), results[ip]))
+
+            failed = [ip for ip in ips if results[ip] == "drain failed"]
+            if failed:
+                raise CommandExecutionError(
+                    f"{len(failed)} of {len(ips)} node(s) could not be drained and are still in cluster {cluster}: "
+                    f"{' '.join(failed)}")
+        return results
+
+    def _node_names(self, cluster: str) -> Dict[str, str]:
+        """InternalIP -> node name of the nodes registered in the cluster, from one kubectl call"""
+        kubeconfig = self.clusters_dir / cluster / "kubectl.kubeconfig"
+        cmd = [str(self.kube_bin_dir / "kubectl"), "--kubeconfig", str(kubeconfig), "get", "nodes", "-o", "json"]
+        names = {}
+        for item in json.loads(run_command(cmd).stdout).get("items", []):
+            for address in item.get("status", {}).get("addresses", []):
+                if address.get("type") == "InternalIP":
+                    names[address["address"]] = item["metadata"]["name"]
+        return names
+
+    def _drain_options(self, cluster: str) -> List[str]:
+        """kubectl drain flags, --delete-local-data was renamed in kubernetes 1.20"""
+        k8s_ver = read_config_values(self.clusters_dir / cluster / "config.yml").get("K8S_VER", "")
+        match = re.match(r"v?(\d+)\.(\d+)", k8s_ver)
+        legacy = match is not None and (int(match.group(1)), int(match.group(2))) < (1, 20)
+        return ["--delete-local-data" if legacy else "--delete-emptydir-data", "--ignore-daemonsets", "--force"]
+
+    def _drain_node(self, cluster: str, name: str, drain_opts: List[str], timeout: int) -> Optional[str]:
+        """Drain a node, return why it failed or None"""
+        kubeconfig = self.clusters_dir / cluster / "kubectl.kubeconfig"
+        cmd = [str(self.kube_bin_dir / "kubectl"), "--kubeconfig", str(kubeconfig),
+               "drain", name, *drain_opts, f"--timeout={timeout}s"]
+        logger.info(f"Draining node {name}", extra={"to_stdout": True})
+        try:
+            # kubectl enforces the timeout, the extra minute only guards against a hung client
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout + 60)
+        except subprocess.TimeoutExpired:
+            return f"timed out after {timeout}s"
+        except OSError as e:
+            return str(e)
+        if result.returncode != 0:
+            return result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"
+        logger.info(f"Node {name} drained", extra={"to_stdout": True})
+        return None
 
     def renew_ca_certs(self, cluster: str) -> None:
         """Force renew CA certificates and all other certs in the cluster"""
@@ -354,16 +761,9 @@ class ClusterManager:
         if not confirm_action(f"Renew all certs in cluster {cluster}"):
             return
 
-        cmd = [
-            "ansible-playbook",
-            "-i", str(self.clusters_dir / cluster / "hosts"),
-            "-e", f"@{self.clusters_dir / cluster / 'config.yml'}",
-            "-e", "CHANGE_CA=true",
-            str(self.playbooks_dir / "96.update-certs.yml"),
-            "-t", "force_change_certs"
-        ]
-
-        run_command(cmd, capture_output=False)
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / "96.update-certs.yml",
+                                 "-e", "CHANGE_CA=true", "-t", "force_change_certs")
+        self._run_playbook(cluster, cmd)
 
     def kubeconfig_admin(self, cluster: str, action: str, user_name: str = None,
                          user_type: str = "admin", expiry: str = "4800h") -> None:
@@ -374,20 +774,15 @@ class ClusterManager:
             if not user_name:
                 user_name = f"user-{datetime.now().strftime('%Y%m%d%H%M')}"
 
-            cmd = [
-                "ansible-playbook",
-                "-i", str(self.clusters_dir / cluster / "hosts"),
-                "-e", f"@{self.clusters_dir / cluster / 'config.yml'}",
-                "-e", f"CUSTOM_EXPIRY={expiry}",
-                "-e", f"USER_TYPE={user_type}",
-                "-e", f"USER_NAME={user_name}",
-                "-e", "ADD_KCFG=true",
-                "-t", "add-kcfg",
-                str(self.base_path / "roles/deploy/deploy.yml")
-            ]
+            cmd = self._playbook_cmd(cluster, self.base_path / "roles/deploy/deploy.yml",
+                                     "-e", f"CUSTOM_EXPIRY={expiry}",
+                                     "-e", f"USER_TYPE={user_type}",
+                                     "-e", f"USER_NAME={user_name}",
+                                     "-e", "ADD_KCFG=true",
+                                     "-t", "add-kcfg")
 
             logger.info(f"Adding user {user_name} ({user_type}) to cluster {cluster}")
-            run_command(cmd, capture_output=False)
+            self._run_playbook(cluster, cmd)
 
         elif action == "delete":
             if not user_name:
@@ -491,6 +886,59 @@ class ClusterManager:
                             print("%-30s %-15s %-20s" % (user, "unknown", expiry))
             print("")
 
+    def _playbook_cmd(self, cluster: str, playbook: Path, *args: str) -> List[str]:
+        """ansible-playbook argv of a cluster: its hosts file and config.yml, then args"""
+        return [
+            "ansible-playbook",
+            "-i", str(self.clusters_dir / cluster / "hosts"),
+            "-e", f"@{self.clusters_dir / cluster / 'config.yml'}",
+            *args,
+            str(playbook)
+        ]
+
+    def _run_playbook(self, cluster: str, cmd: List[str], check: bool = True,
+                      max_failures: Optional[int] = None, output: Optional[Path] = None) -> PlaybookResult:
+        """
+        Every playbook kubeauto runs goes through here, followed through its event stream
+
+        The output of ansible goes to the terminal, or to the output file when given.
+        """
+        cluster_dir = self.clusters_dir / cluster
+        inventory = Inventory.load(cluster_dir / "hosts")
+        config_file = cluster_dir / "config.yml"
+        profile = tune(self.ansible_profile, inventory, read_config_values(config_file) if config_file.exists() else {},
+                       Path(cmd[-1]), self.base_path / "roles", self.kube_constant.ANSIBLE_FORKS)
+        logger.info(profile.describe(), extra={"to_stdout": True})
+        unreachable = warm_up_ssh(inventory, profile)
+        if unreachable:
+            logger.warning(f"No ssh connection to {' '.join(unreachable)} before the run", extra={"to_stdout": True})
+
+        if self.refresh_facts:
+            invalidate_facts(cluster_dir)
+            # gathered again by this run, the following runs of the same command reuse them
+            self.refresh_facts = False
+        env = {**profile.env(), **fact_cache_env(cluster_dir, profile.gather_subset, self.kube_constant.FACT_CACHE_TTL)}
+
+        listeners = []
+        try:
+            recorder = RunRecorder(cluster_dir, cmd, self.kube_constant.PROFILE_RUNS_KEEP)
+            listeners.append(recorder)
+        except OSError as e:
+            # timings are a diagnostic, the playbook runs without them
+            logger.warning(f"Failed to record the timings of {cmd[-1]}: {e}")
+            recorder = None
+
+        result = None
+        try:
+            result = run_playbook(cmd, self.base_path / "plugins/callback", env=env, listeners=listeners,
+                                  max_failures=max_failures, check=False, output=output)
+        finally:
+            if recorder:
+                recorder.close(result)
+        if check and result.returncode != 0:
+            raise_for_result(cmd, result)
+        return result
+
     def _validate_cluster(self, name: str) -> None:
         """Validate cluster exists"""
         if not (self.clusters_dir / name).exists():
@@ -501,194 +949,35 @@ class ClusterManager:
         if not validate_ip(ip):
             raise InvalidIPError(f"Invalid IP address: {ip}")
 
-    def _check_node_exists(self, hosts_file: Path, ip: str, role: str) -> None:
-        """Optimized version for large files using line-by-line reading"""
-        section_patterns = {
-            'etcd': ('[etcd]', '[kube_master]'),
-            'master': ('[kube_master]', '[kube_node]'),
-            'node': ('[kube_node]', None)  # node section is the last one
-        }
-
-        if role not in section_patterns:
-            raise ValueError(f"Invalid node role: {role}")
-
-        start_section, end_section = section_patterns[role]
-        in_section = False
-
-        with hosts_file.open() as f:
-            for line in f:
-                line = line.strip()
-
-                if line == start_section:
-                    in_section = True
-                    continue
-
-                if end_section and line == end_section:
-                    break  # break in advance, no need to scan the whole file
-
-                if in_section and line and not line.startswith('#'):
-                    if line.startswith(ip) or f" {ip} " in line:
-                        raise NodeExistsError(f"Node {ip} already exists in {role} section")
-
-    def _check_node_not_exists(self, hosts_file: Path, ip: str, role: str) -> None:
-        """Optimized version for checking node absence in large files"""
-        section_patterns = {
-            'etcd': ('[etcd]', '[kube_master]'),
-            'master': ('[kube_master]', '[kube_node]'),
-            'node': ('[kube_node]', None)  # node section is the last one
-        }
-
-        if role not in section_patterns:
-            raise ValueError(f"Invalid node role: {role}")
-
-        start_section, end_section = section_patterns[role]
-        in_section = False
-
-        with hosts_file.open() as f:
-            for line in f:
-                line = line.strip()
-
-                if line == start_section:
-                    in_section = True
-                    continue
-
-                if end_section and line == end_section:
-                    break  # break in advance, no need to scan the whole file
-
-                if in_section and line and not line.startswith('#'):
-                    if line.startswith(ip) or f" {ip} " in line:
-                        return  # If node exists, return immediately, no raise
-
-        # Looked up the whole section, not found, raise
-        raise NodeNotFoundError(f"Node {ip} not found in {role} section")
-
-    def _add_to_hosts_section(self, hosts_file: Path, role: str, line: str) -> None:
-        """Add a line to the end of a specific section using ipaddress library"""
-        section = f"[kube_{role}]" if role != "etcd" else "[etcd]"
-
-        content = hosts_file.read_text().splitlines()
-        section_start = -1
-        last_ip_line = -1
-
-        for i, l in enumerate(content):
-            if l.strip() == section:
-                section_start = i
-            elif section_start != -1 and l.startswith('[') and l.endswith(']'):
-                break  # Next section found
-            elif section_start != -1:
-                # Try to parse first token as IP
-                parts = l.split()
-                if parts:
-                    try:
-                        ipaddress.ip_address(parts[0])
-                        last_ip_line = i
-                    except ValueError:
-                        continue
-
-        if section_start == -1:
-            raise ValueError(f"Section {section} not found in hosts file")
-
-        insert_pos = last_ip_line + 1 if last_ip_line != -1 else section_start + 1
-        content.insert(insert_pos, line)
-        hosts_file.write_text("\n".join(content) + "\n")
-
-    def _remove_from_hosts_section(self, hosts_file: Path, role: str, ip: str) -> None:
-        """Remove a line from a specific section in hosts file"""
-        section = f"[kube_{role}]" if role != "etcd" else "[etcd]"
-
-        content = hosts_file.read_text().splitlines()
-        section_start = -1
-        section_end = -1
-
-        for i, line in enumerate(content):
-            if line.strip() == section:
-                section_start = i
-            elif section_start != -1 and line.startswith("[") and section_end == -1:
-                section_end = i
-                break
-
-        if section_start == -1:
-            raise ValueError(f"Section {section} not found in hosts file")
-
-        if section_end == -1:
-            section_end = len(content)
-
-        # Find and remove the line with the IP
-        new_section = []
-        removed = False
-
-        for line in content[section_start + 1:section_end]:
-            if not (line.startswith(ip) or f" {ip} " in line):
-                new_section.append(line)
-            else:
-                removed = True
-
-        if not removed:
-            raise NodeNotFoundError(f"Node {ip} not found in {section} section")
-
-        # Rebuild content
-        new_content = content[:section_start + 1] + new_section + content[section_end:]
-        hosts_file.write_text("\n".join(new_content) + "\n")
-
     def _notify_etcd_apiserver(self, cluster: str) -> None:
-        hosts_file = self.clusters_dir / cluster / "hosts"
-        config_file = self.clusters_dir / cluster / "config.yml"
-
         # Restart the etcd cluster
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"@{config_file}",
-            "-t", "restart_etcd",
-            str(self.playbooks_dir / "02.etcd.yml")
-        ]
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / "02.etcd.yml", "-t", "restart_etcd")
         logger.info(f"Restart the etcd cluster after adding or removing an etcd node, the command is {' '.join(cmd)}",
                     extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        self._run_playbook(cluster, cmd)
         logger.info("The etcd cluster has been restarted successfully!", extra={"to_stdout": True})
 
         # Restart the apiservers to use the new etcd cluster
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"@{config_file}",
-            "-t", "restart_master",
-            str(self.playbooks_dir / "04.kube-master.yml")
-        ]
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / "04.kube-master.yml", "-t", "restart_master")
         logger.info(f"Restart the apiservers to adapt to the changed etcd cluster, the command is {' '.join(cmd)}",
                     extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        self._run_playbook(cluster, cmd)
         logger.info("The apiservers have been restarted successfully!", extra={"to_stdout": True})
 
     def _restart_load_balancers(self, cluster: str) -> None:
         """Restart kube-lb and ex-lb services"""
-        hosts_file = self.clusters_dir / cluster / "hosts"
-        config_file = self.clusters_dir / cluster / "config.yml"
-
         # Restart kube-lb
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"@{config_file}",
-            "-t", "restart_kube-lb",
-            str(self.playbooks_dir / "90.setup.yml")
-        ]
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / "90.setup.yml", "-t", "restart_kube-lb")
         logger.info(f"Restart the kube-lb after adding or removing a master node, the command is {' '.join(cmd)}",
                     extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        self._run_playbook(cluster, cmd)
         logger.info("The kube-lb services have been restarted successfully!", extra={"to_stdout": True})
 
         # Restart ex-lb
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"@{config_file}",
-            "-t", "restart_lb",
-            str(self.playbooks_dir / "10.ex-lb.yml")
-        ]
+        cmd = self._playbook_cmd(cluster, self.playbooks_dir / "10.ex-lb.yml", "-t", "restart_lb")
         logger.info(f"Restart the ex-lb after adding or removing a master node, the command is {' '.join(cmd)}",
                     extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        self._run_playbook(cluster, cmd)
         logger.info("The ex-lb services have been restarted successfully!", extra={"to_stdout": True})
 
     def _kubectl_del_master(self, cluster: str, ip: str) -> None:
@@ -703,25 +992,27 @@ class ClusterManager:
 
     def _reconfigure_kubeconfig(self, cluster: str) -> None:
         """Reconfigure kubeconfig after master node removal"""
-        hosts_file = self.clusters_dir / cluster / "hosts"
-        config_file = self.clusters_dir / cluster / "config.yml"
-
-        cmd = [
-            "ansible-playbook",
-            "-i", str(hosts_file),
-            "-e", f"@{config_file}",
-            "-t", "create_kctl_cfg",
-            str(self.base_path / "roles/deploy/deploy.yml")
-        ]
+        cmd = self._playbook_cmd(cluster, self.base_path / "roles/deploy/deploy.yml", "-t", "create_kctl_cfg")
         logger.info(f"Reconfiguring kubeconfig after a master node removal, the command is {' '.join(cmd)}",
                     extra={"to_stdout": True})
-        run_command(cmd, capture_output=False)
+        self._run_playbook(cluster, cmd)
         logger.info("The kubeconfig has been reconfigured successfully!", extra={"to_stdout": True})
 
     def _show_component_versions(self, cluster: str) -> None:
-        """Show component versions before setup"""
-        v_kube = run_command([str(self.kube_bin_dir / "kube-apiserver"), "--version"]).stdout.split()[1]
-        v_etcd = "v" + run_command([str(self.extra_bin_dir / "etcd"), "--version"]).stdout.split()[2]
+        """Show component versions before setup, as recorded in the bundle manifests at install time"""
+        from .manifest import BundleManifest
+
+        k8s_manifest = BundleManifest.load(self.kube_bin_dir, "k8s_bin")
+        ext_manifest = BundleManifest.load(self.extra_bin_dir, "ext_bin")
+        if k8s_manifest and "kubernetes" in k8s_manifest.components:
+            v_kube = k8s_manifest.components["kubernetes"]
+        else:
+            # installed before manifests existed
+            v_kube = run_command([str(self.kube_bin_dir / "kube-apiserver"), "--version"]).stdout.split()[1]
+        if ext_manifest and "etcd" in ext_manifest.components:
+            v_etcd = ext_manifest.components["etcd"]
+        else:
+            v_etcd = "v" + run_command([str(self.extra_bin_dir / "etcd"), "--version"]).stdout.split()[2]
 
         # Get network plugin from hosts file
         hosts_content = (self.clusters_dir / cluster / "hosts").read_text()
@@ -1,14 +1,19 @@
 import json
 import re
+import subprocess
+import time
+from functools import cached_property
 from pathlib import Path
-from typing import Optional, Dict, List
+from typing import Optional, Dict, Iterable, Iterator, List
 import docker
 from docker.errors import DockerException, APIError, ImageNotFound
 from common.constants import KubeConstant
-from common.utils import run_command, rmrf
-from common.exceptions import CommandExecutionError
+from common.utils import run_command, rmrf, transfer_report
+from common.exceptions import CommandExecutionError, DockerManageError, DownloadError
+from common.fetch import HttpDownloader
 from common.logger import setup_logger
 from common.os import SystemProbe
+from .cache import CacheManager
 
 logger = setup_logger(__name__)
 
@@ -16,7 +21,6 @@ logger = setup_logger(__name__)
 class DockerManager:
     def __init__(self):
         self.kube_constant = KubeConstant()
-        self.system_probe = SystemProbe()
         self.base_path = Path(self.kube_constant.BASE_PATH)
         self.image_dir = Path(self.kube_constant.IMAGE_DIR)
         self.docker_bin_dir = Path(self.kube_constant.DOCKER_BIN_DIR)
@@ -25,12 +29,18 @@ class DockerManager:
         self.temp_path = Path(self.kube_constant.TEMP_PATH)
         self.docker_proxy_dir = Path(self.kube_constant.DOCKER_PROXY_DIR)
 
-        # Initialize Docker SDK client
+        # Docker SDK client is initialized on first access, commands never touching docker skip the socket ping
         self._client = None
-        self._initialize_docker_client()
+        self._client_initialized = False
+
+    @cached_property
+    def system_probe(self) -> SystemProbe:
+        """System probe, built on first use"""
+        return SystemProbe()
 
     def _initialize_docker_client(self):
         """Initialize Docker SDK client"""
+        self._client_initialized = True
         try:
             self._client = docker.from_env()
             # verify docker sdk connection
@@ -43,6 +53,8 @@ class DockerManager:
     @property
     def client(self):
         """Get Docker client，if SDK is unavailable return None"""
+        if not self._client_initialized:
+            self._initialize_docker_client()
         return self._client
 
     @property
@@ -197,27 +209,20 @@ class DockerManager:
 
         logger.info(f"Residual docker {docker_version} has been cleaned successfully!", extra={'to_stdout': True})
 
-    def _download_docker(self, version: str) -> None:
+    def _download_docker(self, version: str, sha256: Optional[str] = None) -> None:
         """
-        Download Docker binary
+        Download Docker binary from the fastest mirror, in parallel segments, resumable and checksum-verified
         """
-        # ensure image_dir exists
-        self.image_dir.mkdir(parents=True, exist_ok=True)
-
         docker_tgz = self.image_dir / f"docker-{version}.tgz"
-        if docker_tgz.exists():
-            logger.warning("Docker binary exists already", extra={'to_stdout': True})
-            return
+        CacheManager(self.image_dir).record(docker_tgz.name, hit=docker_tgz.exists())
 
         logger.info(f"Downloading Docker binary: {version}", extra={'to_stdout': True})
-        docker_bin_url = self.kube_constant.docker_bin_url(version)
-
         try:
-            run_command(["wget", "-c", "--no-check-certificate", docker_bin_url, "-O", str(docker_tgz)])
-        except CommandExecutionError:
-            run_command(["curl", "-k", "-C-", "-o", str(docker_tgz), docker_bin_url])
+            HttpDownloader().fetch(self.kube_constant.docker_bin_urls(version), docker_tgz, sha256)
+        except DownloadError as e:
+            raise DockerManageError(f"Failed to download docker {version}: {e}")
 
-        logger.info("Docker binary has been downloaded successfully!", extra={'to_stdout': True})
+        logger.info("Docker binary is ready!", extra={'to_stdout': True})
 
     def _install_docker_binaries(self, version) -> None:
         """
@@ -638,35 +643,63 @@ WantedBy=multi-user.target
 
         run_command(["docker", "pull", image])
 
-    def save_image(self, image: str, output: str) -> None:
+    def save_stream(self, image: str) -> Iterator[bytes]:
         """
-        save image to tar
+        stream `docker save` output in IMAGE_CHUNK_SIZE chunks, nothing is written to disk
         """
+        chunk_size = self.kube_constant.IMAGE_CHUNK_SIZE
         if self.client is not None:
             try:
                 image_obj = self.client.images.get(image)
-                with open(output, 'wb') as f:
-                    for chunk in image_obj.save():
-                        f.write(chunk)
-                return
             except APIError:
                 logger.warning("Docker SDK got wrong, roll back to docker command", extra={'to_stdout': True})
+            else:
+                yield from image_obj.save(chunk_size=chunk_size)
+                return
 
-        run_command(["docker", "save", "-o", output, image])
+        proc = subprocess.Popen(["docker", "save", image], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            yield from iter(lambda: proc.stdout.read(chunk_size), b"")
+        finally:
+            proc.stdout.close()
+            stderr = proc.stderr.read().decode(errors="replace").strip()
+            proc.stderr.close()
+            if proc.wait() != 0:
+                raise CommandExecutionError(f"docker save {image} failed: {stderr or '(empty)'}")
 
-    def load_image(self, input_file: str) -> None:
+    def load_stream(self, chunks: Iterable[bytes], label: str) -> None:
         """
-        load image from tar file
+        load an image tarball given as a stream of chunks
+
+        The request body is a chunk generator (chunked transfer encoding), so peak memory
+        stays flat whatever the size of the tarball.
         """
+        counted = _CountingChunks(chunks)
+        start = time.monotonic()
         if self.client is not None:
             try:
-                with open(input_file, 'rb') as f:
-                    self.client.images.load(f.read())
+                self.client.images.load(counted)
+                logger.info(transfer_report("Loaded", label, counted.nbytes, time.monotonic() - start),
+                            extra={'to_stdout': True})
                 return
             except APIError:
+                if counted.nbytes:
+                    raise
                 logger.warning("Docker SDK got wrong, roll back to docker command", extra={'to_stdout': True})
 
-        run_command(["docker", "load", "-i", input_file])
+        proc = subprocess.Popen(["docker", "load"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+        try:
+            for chunk in counted:
+                proc.stdin.write(chunk)
+        finally:
+            proc.stdin.close()
+            stderr = proc.stderr.read().decode(errors="replace").strip()
+            proc.stderr.close()
+        if proc.wait() != 0:
+            raise CommandExecutionError(f"docker load {label} failed: {stderr or '(empty)'}")
+        logger.info(transfer_report("Loaded", label, counted.nbytes, time.monotonic() - start),
+                    extra={'to_stdout': True})
 
     def tag_image(self, src: str, dest: str) -> None:
         """
@@ -690,6 +723,10 @@ WantedBy=multi-user.target
             try:
                 logger.info(f"Pushing image: {image}", extra={'to_stdout': True})
                 for line in self.client.images.push(image, stream=True, decode=True):
+                    # the engine reports a failed push in the stream, the call itself succeeds
+                    if 'error' in line or 'errorDetail' in line:
+                        message = line.get('error') or line['errorDetail'].get('message', '')
+                        raise DockerManageError(f"Failed to push {image}: {message}")
                     if 'status' in line:
                         logger.debug(line['status'])
                 logger.info(f"{image} has been pushed successfully", extra={'to_stdout': True})
@@ -768,6 +805,22 @@ WantedBy=multi-user.target
         except CommandExecutionError:
             return False
 
+    def image_size(self, image: str) -> int:
+        """
+        size of a local image in bytes, 0 if unknown
+        """
+        if self.client is not None:
+            try:
+                return int(self.client.images.get(image).attrs.get("Size", 0))
+            except APIError:
+                logger.warning("Docker SDK got wrong, roll back to docker command", extra={'to_stdout': True})
+
+        try:
+            output = run_command(["docker", "image", "inspect", "--format", "{{.Size}}", image])
+            return int(output.stdout.strip() or 0)
+        except (CommandExecutionError, ValueError):
+            return 0
+
     def remove_image(self, image: str) -> None:
         """
         remove image from registry
@@ -831,3 +884,19 @@ Environment="NO_PROXY={no_proxy_str}"
             conf_file.unlink()
             run_command(["systemctl", "daemon-reload"])
             run_command(["systemctl", "restart", "docker"])
+
+
+class _CountingChunks:
+    """Chunk iterator counting the bytes going through it"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self.nbytes = 0
+
+    def __iter__(self) -> "_CountingChunks":
+        return self
+
+    def __next__(self) -> bytes:
+        chunk = next(self._chunks)
+        self.nbytes += len(chunk)
+        return chunk
@@ -1,17 +1,32 @@
-import shutil, os
-from typing import Optional
+from typing import List, Optional, Set
 
+from common.dag import TaskGraph
 from common.exceptions import DownloadError
 from common.utils import rmrf
 
 from common.logger import setup_logger
 from pathlib import Path
+from .cache import CacheManager
 from .docker import DockerManager
+from .layerstore import LayerStore
+from .manifest import BundleManifest
+from .release import ReleaseDir, link_binaries, stage_dir, swap_into
 from .registry import RegistryManager
 from common.constants import KubeConstant
 
 logger = setup_logger(__name__)
 
+# bundles an older kubeauto installed without a manifest and the file by which it knew they were:
+# adopted only when the version of what is there can be told, from the marker or from a probe
+LEGACY_MARKERS = {
+    "k8s_bin": "kubelet",
+    "harbor": "harbor-offline-installer-{version}.tgz",
+}
+# bundle -> component of its manifest whose probed version is the version of the bundle
+VERSION_COMPONENTS = {
+    "k8s_bin": "kubernetes",
+}
+
 
 class DownloadManager:
     def __init__(self):
@@ -20,98 +35,84 @@ class DownloadManager:
         self.kube_constant = KubeConstant()
         self.base_path = Path(self.kube_constant.BASE_PATH)
         self.image_dir = Path(self.kube_constant.IMAGE_DIR)
-        self.temp_path = Path(self.kube_constant.TEMP_PATH)
         self.kube_bin_dir = Path(self.kube_constant.KUBE_BIN_DIR)
         self.extra_bin_dir = Path(self.kube_constant.EXTRA_BIN_DIR)
         self.sys_bin_dir = Path(self.kube_constant.SYS_BIN_DIR)
-
-    def download_all(self) -> None:
-        """Download all required components"""
-        if not self.docker.is_docker_installed:
-            self.docker.install_docker()
-
-        self.get_kubeauto()
-        self.get_k8s_bin()
-        self.get_ext_bin()
-        self.registry.start_local_registry()
-        self.get_default_images()
+        self.releases_dir = Path(self.kube_constant.RELEASES_DIR)
+        self.store = LayerStore(self.image_dir)
+        self.cache = CacheManager(self.image_dir)
+
+    def download_all(self, concurrency: Optional[int] = None, retries: Optional[int] = None) -> None:
+        """
+        Download all required components, scheduled as a dependency graph
+
+        Everything only needs dockerd, so once docker is up the bundles are pulled and extracted
+        concurrently with the registry start and the image uploads.
+        """
+        def ensure_docker() -> None:
+            if not self.docker.is_docker_installed:
+                self.docker.install_docker()
+
+        graph = TaskGraph(self.kube_constant.DOWNLOAD_WORKERS)
+        graph.add("docker", ensure_docker)
+        graph.add("kubeauto", self.get_kubeauto, deps=["docker"])
+        graph.add("k8s_bin", self.get_k8s_bin, deps=["docker"])
+        graph.add("ext_bin", self.get_ext_bin, deps=["docker"])
+        graph.add("registry", self.registry.start_local_registry, deps=["docker"])
+        graph.add("default_images", lambda: self.get_default_images(concurrency, retries), deps=["registry"])
+
+        failed = graph.run()
+        graph.report("Download timeline (* critical path):")
+        if failed:
+            raise DownloadError(f"Failed to download: {', '.join(f'{t.name} ({t.error})' for t in failed)}")
 
     def get_kubeauto(self, version: Optional[str] = None) -> None:
         """Download and setup kubeauto with full directory backup"""
         version = version or self.kube_constant.v_kubeauto
 
-        if self.__check_file_exists(self.base_path, "roles/kube-node"):
-            logger.warning("kubeauto already exists", extra={"to_stdout": True})
-            return
-
-        self.__handle_image(self.image_dir, f"kubeauto_{version}.tar", f"brinnatt/kubeauto:{version}")
-
-        self.__handle_files(f"brinnatt/kubeauto:{version}", "/usr/local/kubeauto", self.base_path)
-
-        logger.info("kubeauto has been installed successfully!", extra={'to_stdout': True})
+        if self.__install_bundle("kubeauto", version, f"brinnatt/kubeauto:{version}",
+                                 "/usr/local/kubeauto", self.base_path):
+            logger.info("kubeauto has been installed successfully!", extra={'to_stdout': True})
 
     def get_k8s_bin(self, version: Optional[str] = None) -> None:
         """Download Kubernetes binaries with caching and error handling"""
         version = version or self.kube_constant.v_k8s_bin
 
-        if self.__check_file_exists(self.kube_bin_dir, "kubelet") and (self.sys_bin_dir / "kubelet").is_symlink():
-            logger.warning("Kubernetes binaries already exist", extra={"to_stdout": True})
-            return
-
-        self.__handle_image(self.image_dir, f"k8s_bin_{version}.tar", f"brinnatt/kubeauto-k8s-bin:{version}")
-
-        self.__handle_files(f"brinnatt/kubeauto-k8s-bin:{version}", "/k8s", self.kube_bin_dir, create_symlink=True)
-
-        logger.info("k8s_bin has been installed successfully!", extra={'to_stdout': True})
+        if self.__install_bundle("k8s_bin", version, f"brinnatt/kubeauto-k8s-bin:{version}",
+                                 "/k8s", self.kube_bin_dir, create_symlink=True, versioned=True):
+            logger.info("k8s_bin has been installed successfully!", extra={'to_stdout': True})
 
     def get_ext_bin(self, version: Optional[str] = None) -> None:
         """Download extra binaries with caching and error handling"""
         version = version or self.kube_constant.v_extra_bin
 
-        if self.__check_file_exists(self.extra_bin_dir, "etcdctl"):
-            logger.warning("Extra binaries already exist", extra={"to_stdout": True})
-            return
-
-        self.__handle_image(self.image_dir, f"ext_bin_{version}.tar", f"brinnatt/kubeauto-ext-bin:{version}")
-
-        self.__handle_files(f"brinnatt/kubeauto-ext-bin:{version}", "/extra", self.extra_bin_dir, create_symlink=False)
-
-        logger.info("ext_bin has been installed successfully!", extra={'to_stdout': True})
+        if self.__install_bundle("ext_bin", version, f"brinnatt/kubeauto-ext-bin:{version}",
+                                 "/extra", self.extra_bin_dir, versioned=True):
+            logger.info("ext_bin has been installed successfully!", extra={'to_stdout': True})
 
     def get_harbor_offline_pkg(self, version: Optional[str] = None) -> None:
         """Download Harbor offline installer package with caching and error handling"""
         version = version or self.kube_constant.v_harbor
 
-        if self.__check_file_exists(self.image_dir, f"harbor-offline-installer-{version}.tgz"):
-            logger.warning("Harbor offline installer already exist", extra={"to_stdout": True})
-            return
-
-        self.__handle_image(self.image_dir, f"harbor_{version}.tar", f"brinnatt/harbor-offline:{version}")
+        if self.__install_bundle("harbor", version, f"brinnatt/harbor-offline:{version}",
+                                 "/harbor", self.image_dir):
+            logger.info("harbor_offline_pkg has been installed successfully!", extra={'to_stdout': True})
 
-        self.__handle_files(f"brinnatt/harbor-offline:{version}", "/harbor", self.image_dir)
-
-        logger.info("harbor_offline_pkg has been installed successfully!", extra={'to_stdout': True})
-
-    def get_default_images(self) -> None:
+    def get_default_images(self, concurrency: Optional[int] = None, retries: Optional[int] = None) -> None:
         """Download default images and upload to local registry"""
-        images = [
-            f"calico/cni:{self.kube_constant.v_calico}",
-            f"calico/kube-controllers:{self.kube_constant.v_calico}",
-            f"calico/node:{self.kube_constant.v_calico}",
-            f"coredns/coredns:{self.kube_constant.v_coredns}",
-            f"brinnatt/k8s-dns-node-cache:{self.kube_constant.v_dnsnodecache}",
-            f"brinnatt/metrics-server:{self.kube_constant.v_metricsserver}",
-            f"brinnatt/pause:{self.kube_constant.v_pause}"
-        ]
-
         try:
-            self.registry.upload_to_registry(images)
+            transfers = self.registry.upload_to_registry(self.kube_constant.default_images, concurrency, retries)
         except Exception as e:
             raise DownloadError(f"Failed to upload images: {e}")
 
+        failed = [t.image for t in transfers if not t.ok]
+        if failed:
+            raise DownloadError(f"Failed to upload images: {', '.join(failed)}")
+
         logger.info(f"Default images uploaded to registry successfully!", extra={'to_stdout': True})
 
-    def get_extra_images(self, component: str) -> None:
+    def get_extra_images(self, component: str, concurrency: Optional[int] = None,
+                         retries: Optional[int] = None) -> None:
         """Download extra images for specified component and upload to local registry"""
         if component not in self.kube_constant.component_images:
             logger.error(f"Invalid component: {component}")
@@ -120,74 +121,179 @@ class DownloadManager:
         logger.info(f"Downloading images for {component}, then uploading to local registry")
 
         try:
-            self.registry.upload_to_registry(self.kube_constant.component_images[component])
-            logger.info(f"{component} images uploaded to registry successfully!")
+            transfers = self.registry.upload_to_registry(self.kube_constant.component_images[component],
+                                                         concurrency, retries)
         except Exception as e:
             raise DownloadError(f"Failed to upload {component} images: {e}")
 
-    def __check_file_exists(self, directory: Path, filename: str) -> bool:
-        """Check if file exists"""
-        path = directory / filename
-        path.parent.mkdir(parents=True, exist_ok=True)
-        if path.exists():
-            return True
-        return False
-
-    def __handle_image(self, directory: Path, image_tar: str, image: str) -> None:
-        """Check if image exists"""
-        path = directory / image_tar
-        path.parent.mkdir(parents=True, exist_ok=True)
+        failed = [t.image for t in transfers if not t.ok]
+        if failed:
+            raise DownloadError(f"Failed to upload {component} images: {', '.join(failed)}")
+
+        logger.info(f"{component} images uploaded to registry successfully!")
+
+    def show_store_usage(self) -> None:
+        """Show how much space the saved images take and how much deduplication saves"""
+        usage = self.store.usage()
+        logger.info(f"{'IMAGE':<40} {'SIZE(MB)':>10} {'EXCLUSIVE(MB)':>14}", extra={"to_stdout": True})
+        for image in usage["images"]:
+            logger.info(f"{image['name']:<40} {image['bytes'] / 1024 ** 2:>10.1f} "
+                        f"{image['exclusive_bytes'] / 1024 ** 2:>14.1f}", extra={"to_stdout": True})
+
+        logical, stored = usage["logical_bytes"], usage["stored_bytes"]
+        saved = 1 - stored / logical if logical else 0.0
+        logger.info(f"{len(usage['images'])} images, {usage['blobs']} blobs: {logical / 1024 ** 2:.1f} MB as tarballs, "
+                    f"{stored / 1024 ** 2:.1f} MB stored in {self.store.root} ({saved:.0%} saved)",
+                    extra={"to_stdout": True})
+
+    def rollback(self, bundle: str) -> None:
+        """Switch a versioned bundle back to the version active before the last switch"""
+        destinations = {"k8s_bin": self.kube_bin_dir, "ext_bin": self.extra_bin_dir}
+        if bundle not in destinations:
+            raise DownloadError(f"Only {', '.join(destinations)} can be rolled back")
+
+        version = ReleaseDir(self.releases_dir, bundle, destinations[bundle]).rollback()
+        if bundle == "k8s_bin":
+            link_binaries(self.kube_bin_dir, self.sys_bin_dir)
+        logger.info(f"{bundle} has been rolled back to {version}", extra={"to_stdout": True})
+
+    def __install_bundle(self, bundle: str, version: str, image: str, image_carrier: str, destination: Path,
+                         create_symlink: bool = False, versioned: bool = False) -> bool:
+        """
+        Install a bundle unless its manifest shows the same version, intact, in destination
+
+        Files missing or modified since the install are re-extracted alone. A bundle installed
+        before manifests existed is adopted as it is when it is known to be version. A different version (or no install at all)
+        is extracted into a staging dir on the destination filesystem and moved into place by
+        renames: versioned bundles keep every version under RELEASES_DIR and destination becomes
+        a symlink flipped atomically to the active one. The clusters and the other bundles under
+        BASE_PATH are never replaced by a kubeauto install.
+
+        return False when nothing had to be done
+        """
+        releases = ReleaseDir(self.releases_dir, bundle, destination) if versioned else None
+        target = releases.path(version) if releases else destination
+
+        manifest = BundleManifest.load(target, bundle)
+        marker = LEGACY_MARKERS.get(bundle)
+        if manifest is None and marker and (destination / marker.format(version=version)).exists():
+            manifest = self.__adopt(bundle, version, image, destination, releases)
+        if manifest and manifest.version == version:
+            stale = manifest.verify(target)
+            if not stale and (releases is None or releases.current() == version):
+                if create_symlink:
+                    link_binaries(destination, self.sys_bin_dir)
+                logger.warning(f"{bundle} {version} already exists and is verified", extra={"to_stdout": True})
+                return False
+
+            if stale:
+                logger.warning(f"{len(stale)} files of {bundle} {version} are missing or modified, "
+                               f"re-extracting them", extra={"to_stdout": True})
+                image_name = self.__handle_image(self.image_dir, f"{bundle}_{version}.tar", image)
+                self.__handle_files(image_name, image_carrier, target, only=set(stale))
+                manifest.record(target, stale)
+                manifest.save(target)
+        else:
+            image_name = self.__handle_image(self.image_dir, f"{bundle}_{version}.tar", image)
+            staging = releases.staging(version) if releases else stage_dir(destination, bundle)
+            try:
+                files = self.__handle_files(image_name, image_carrier, staging)
+                manifest = BundleManifest(bundle=bundle, version=version, image=image)
+                manifest.record(staging, files)
+                manifest.capture_components(staging)
+                manifest.save(staging)
+                if releases:
+                    releases.commit(staging, version)
+                else:
+                    swap_into(staging, destination, BundleManifest.path(staging, bundle).name,
+                              keep=self.kube_constant.kept_items() if destination == self.base_path else ())
+            finally:
+                rmrf(staging)
+
+        if releases:
+            releases.activate(version)
+        if create_symlink:
+            link_binaries(destination, self.sys_bin_dir)
+        return True
+
+    def __adopt(self, bundle: str, version: str, image: str, destination: Path,
+                releases: Optional[ReleaseDir]) -> Optional[BundleManifest]:
+        """
+        Record the manifest of a bundle an older kubeauto installed without one, from the files on disk
+
+        What is there must be version: its marker names the version, or the probe of its
+        component reports it. Anything else (another version, a failed probe, an active symlink
+        not managed here) is left to a regular install (None). A versioned bundle installed as
+        a plain tree becomes that release.
+        """
+        if releases and destination.is_symlink():
+            return None
+
+        manifest = BundleManifest(bundle=bundle, version=version, image=image)
+        component = VERSION_COMPONENTS.get(bundle)
+        if component:
+            manifest.capture_components(destination)
+            found = manifest.components.get(component)
+            if found != version:
+                logger.warning(f"{bundle} found in {destination} is {found or 'of unknown version'}, "
+                               f"installing {version}", extra={"to_stdout": True})
+                return None
+
+        if releases:
+            releases.root.mkdir(parents=True, exist_ok=True)
+            target = releases.commit(destination, version)
+            releases.activate(version)
+        else:
+            target = destination
+
+        if bundle == "harbor":
+            # IMAGE_DIR is shared with the layer store, the installer is all the bundle owns there
+            files = [LEGACY_MARKERS[bundle].format(version=version)]
+        else:
+            files = [str(path.relative_to(target)) for top in target.iterdir() if not top.name.startswith(".")
+                     for path in ([top] if not top.is_dir() or top.is_symlink() else top.rglob("*"))]
+        manifest.record(target, files)
+        manifest.save(target)
+        logger.info(f"Adopted {bundle} found in {destination} as {version} ({len(manifest.files)} files)",
+                    extra={"to_stdout": True})
+        return manifest
+
+    def __handle_image(self, directory: Path, image_tar: str, image: str) -> str:
+        """
+        Make sure the image is in the layer store, return its name there
+
+        The `docker save` stream goes straight into the store, layers already stored for another
+        component or version are not written again. A tarball left by an older kubeauto is
+        moved into the store instead of being downloaded again.
+        """
+        name = Path(image_tar).stem
+        legacy_tar = directory / image_tar
+        self.cache.record(name, hit=self.store.exists(name) or legacy_tar.exists())
+        if self.store.exists(name):
+            return name
 
         try:
-            if not path.exists():
-                logger.info(f"Downloading {image}")
-                self.docker.pull_image(f"{image}")
-                self.docker.save_image(f"{image}", str(path))
-            self.docker.load_image(str(path))
+            if legacy_tar.exists():
+                self.store.ingest_file(name, legacy_tar, image)
+                rmrf(legacy_tar)
+                return name
+
+            logger.info(f"Downloading {image}")
+            self.docker.pull_image(f"{image}")
+            self.store.ingest(name, self.docker.save_stream(f"{image}"), image)
         except Exception as e:
-            raise DownloadError(f"Failed to pull, save, or load {image}: {e}")
+            raise DownloadError(f"Failed to pull or save {image}: {e}")
+        return name
 
-    def __handle_files(self, image: str, image_carrier: str, destination: Path, create_symlink=False) -> None:
-        """Handle files"""
-        # Creating temporary container and handle files
-        container_id = None
-        temp_carrier = None
-        try:
-            image_carrier = Path(image_carrier)
-            container_id = self.docker.run_container(image, f"temp_{image_carrier.name}")
-
-            temp_carrier = self.temp_path / f"{image_carrier.name}"
-            if temp_carrier.exists():
-                shutil.rmtree(str(temp_carrier))
-
-            self.docker.copy_from_container(
-                container_id,
-                str(image_carrier),
-                str(self.temp_path)
-            )
-
-            for item in temp_carrier.iterdir():
-                dest = destination / item.name
-                rmrf(dest)
-                shutil.move(str(item), str(destination))
-
-            if create_symlink:
-                # recurse destination to find executable binary file and make symlink to /usr/local/bin
-                for item in destination.rglob('*'):
-                    if item.is_file() and os.access(item, os.X_OK):
-                        target_link = self.sys_bin_dir / item.name
-                        rmrf(target_link)
-                        target_link.symlink_to(item)
+    def __handle_files(self, image_name: str, image_carrier: str, destination: Path,
+                       only: Optional[Set[str]] = None) -> List[str]:
+        """
+        Extract image_carrier of the image straight from the layer store, no container and no temporary copy
 
+        return relative paths of extracted files
+        """
+        try:
+            with self.store.open_image(image_name) as archive:
+                return archive.extract(image_carrier, destination, only=only)
         except Exception as e:
             raise DownloadError(f"Failed to copy image files to dest: {e}")
-
-        finally:
-            if container_id:
-                try:
-                    self.docker.remove_container(container_id)
-                except Exception as e:
-                    logger.warning(f"Failed to clean up temporary container: {e}")
-
-            if temp_carrier and temp_carrier.exists():
-                rmrf(temp_carrier)
@@ -0,0 +1,65 @@
+"""
+Fact cache of a cluster: the facts ansible gathers are kept in clusters/<name>/facts/ and reused by
+the following playbook runs until they expire
+"""
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from common.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+FACTS_DIR = "facts"
+
+
+def facts_dir(cluster_dir: Path, gather_subset: str) -> Path:
+    """
+    Cache of the facts gathered with gather_subset
+
+    ansible skips gathering for a host as soon as it has cached facts, whatever subset they
+    came from, so each subset keeps its own cache: a run wanting all facts never gets the
+    minimal ones of a fast run.
+    """
+    return cluster_dir / FACTS_DIR / (re.sub(r"[^\w.-]+", "_", gather_subset).strip("_") or "default")
+
+
+def fact_cache_env(cluster_dir: Path, gather_subset: str, ttl: int) -> Dict[str, str]:
+    """ANSIBLE_* variables making ansible-playbook read and write the cache, none when ttl is 0"""
+    if ttl <= 0:
+        return {}
+    return {
+        "ANSIBLE_GATHERING": "smart",
+        "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+        "ANSIBLE_CACHE_PLUGIN_CONNECTION": str(facts_dir(cluster_dir, gather_subset)),
+        "ANSIBLE_CACHE_PLUGIN_TIMEOUT": str(ttl),
+    }
+
+
+def invalidate_facts(cluster_dir: Path, hosts: Optional[Iterable[str]] = None) -> None:
+    """Forget the cached facts of hosts, of every host when hosts is None"""
+    root = cluster_dir / FACTS_DIR
+    if not root.is_dir():
+        return
+    if hosts is None:
+        shutil.rmtree(root, ignore_errors=True)
+        logger.debug(f"Fact cache {root} cleared")
+        return
+
+    hosts = list(hosts)
+    if not hosts:
+        return
+    # the jsonfile plugin keeps one file per host, named after it; ansible-core 2.19 and later
+    # put the version of their serialization in front (s1_<host>)
+    pattern = re.compile(rf"(s\d+_)?({'|'.join(map(re.escape, hosts))})")
+    for path in root.glob("*/*"):
+        if not pattern.fullmatch(path.name):
+            continue
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to drop the cached facts in {path}: {e}")
+    logger.debug(f"Cached facts of {' '.join(hosts)} dropped")
@@ -0,0 +1,196 @@
+"""
+SQLite mirror of the inventories of all managed clusters
+"""
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from common.logger import setup_logger
+from common.utils import read_config_values
+from .inventory import ROLE_SECTIONS, Inventory
+from .models import Cluster, Node
+
+logger = setup_logger(__name__)
+
+DB_NAME = ".fleet.db"
+SCHEMA_VERSION = 1
+
+# inventory section -> Node.role
+SECTION_ROLES = {section: role for role, section in ROLE_SECTIONS.items()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    name TEXT PRIMARY KEY,
+    hosts_mtime_ns INTEGER,
+    config_mtime_ns INTEGER,
+    synced_at REAL,
+    kubeconfig TEXT,
+    last_operation TEXT,
+    last_status TEXT,
+    last_operation_at REAL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    cluster TEXT NOT NULL REFERENCES clusters(name) ON DELETE CASCADE,
+    ip TEXT NOT NULL,
+    role TEXT NOT NULL,
+    vars TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (cluster, role, ip)
+);
+CREATE INDEX IF NOT EXISTS nodes_ip ON nodes(ip);
+CREATE INDEX IF NOT EXISTS nodes_role ON nodes(role, cluster);
+CREATE TABLE IF NOT EXISTS settings (
+    cluster TEXT NOT NULL REFERENCES clusters(name) ON DELETE CASCADE,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (cluster, key)
+);
+CREATE INDEX IF NOT EXISTS settings_key ON settings(key, value);
+"""
+
+
+class FleetStore:
+    """
+    clusters/.fleet.db: nodes, settings (config.yml and [all:vars]) and last operation per cluster
+
+    The INI hosts files stay the source of truth. A cluster is parsed again only when the
+    mtime of its hosts or config.yml changed, so queries cost one stat per cluster plus an
+    indexed lookup (nodes by ip, by role; settings by key and value).
+    """
+
+    def __init__(self, clusters_dir: Path):
+        self.clusters_dir = clusters_dir
+        self.db_path = clusters_dir / DB_NAME
+        clusters_dir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            with self.conn:
+                for table in ("nodes", "settings", "clusters"):
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self.conn.executescript(SCHEMA)
+                self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> "FleetStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def sync(self, force: bool = False) -> int:
+        """Re-read the clusters whose hosts or config.yml changed, drop removed ones, return clusters re-read"""
+        known = {row["name"]: (row["hosts_mtime_ns"], row["config_mtime_ns"])
+                 for row in self.conn.execute("SELECT name, hosts_mtime_ns, config_mtime_ns FROM clusters")}
+        present = set()
+        synced = 0
+        # one transaction: a single commit whatever the number of clusters re-read
+        with self.conn:
+            for hosts_file in sorted(self.clusters_dir.glob("*/hosts")):
+                name = hosts_file.parent.name
+                config_file = hosts_file.parent / "config.yml"
+                try:
+                    stamps = (hosts_file.stat().st_mtime_ns,
+                              config_file.stat().st_mtime_ns if config_file.exists() else 0)
+                except OSError:
+                    continue
+                present.add(name)
+                if force or known.get(name) != stamps:
+                    self._sync_cluster(name, hosts_file, config_file, stamps)
+                    synced += 1
+
+            removed = set(known) - present
+            self.conn.executemany("DELETE FROM clusters WHERE name = ?", [(n,) for n in removed])
+        return synced
+
+    def _sync_cluster(self, name: str, hosts_file: Path, config_file: Path, stamps: Tuple[int, int]) -> None:
+        inventory = Inventory.load(hosts_file)
+        settings = read_config_values(config_file) if config_file.exists() else {}
+        settings.update(inventory.section_vars("all:vars"))
+        kubeconfig = hosts_file.parent / "kubectl.kubeconfig"
+
+        self.conn.execute(
+            "INSERT INTO clusters (name, hosts_mtime_ns, config_mtime_ns, synced_at, kubeconfig) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET hosts_mtime_ns = excluded.hosts_mtime_ns, "
+            "config_mtime_ns = excluded.config_mtime_ns, synced_at = excluded.synced_at, "
+            "kubeconfig = excluded.kubeconfig",
+            (name, *stamps, time.time(), str(kubeconfig) if kubeconfig.exists() else None))
+        self.conn.execute("DELETE FROM nodes WHERE cluster = ?", (name,))
+        self.conn.execute("DELETE FROM settings WHERE cluster = ?", (name,))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO nodes (cluster, ip, role, vars) VALUES (?, ?, ?, ?)",
+            [(name, host, SECTION_ROLES.get(section, section), json.dumps(inventory.host_vars(section, host)))
+             for section in inventory.sections() if ":" not in section for host in inventory.hosts(section)])
+        self.conn.executemany("INSERT INTO settings (cluster, key, value) VALUES (?, ?, ?)",
+                              [(name, key, value) for key, value in settings.items()])
+
+    def nodes(self, ip: Optional[str] = None, role: Optional[str] = None,
+              cluster: Optional[str] = None) -> List[Node]:
+        """Nodes of the fleet, filtered by exact ip, role and cluster"""
+        where, params = [], []
+        for column, value in (("ip", ip), ("role", role), ("cluster", cluster)):
+            if value:
+                where.append(f"{column} = ?")
+                params.append(value)
+        query = "SELECT cluster, ip, role, vars FROM nodes"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        rows = self.conn.execute(query + " ORDER BY cluster, role, ip", params)
+        return [Node(ip=r["ip"], role=r["role"], cluster=r["cluster"], extra_info=json.loads(r["vars"]))
+                for r in rows]
+
+    def clusters(self, settings: Optional[Dict[str, str]] = None) -> List[Cluster]:
+        """Clusters whose settings match every key=glob pattern of settings (e.g. calico_ver=v3.26*)"""
+        query, params = "SELECT * FROM clusters", []
+        for key, pattern in (settings or {}).items():
+            query += (" WHERE" if not params else " AND") + \
+                     " name IN (SELECT cluster FROM settings WHERE key = ? AND value GLOB ?)"
+            params += [key, pattern]
+        rows = self.conn.execute(query + " ORDER BY name", params).fetchall()
+
+        result = []
+        for row in rows:
+            config = {r["key"]: r["value"] for r in
+                      self.conn.execute("SELECT key, value FROM settings WHERE cluster = ?", (row["name"],))}
+            hosts = [r["ip"] for r in
+                     self.conn.execute("SELECT DISTINCT ip FROM nodes WHERE cluster = ? ORDER BY ip", (row["name"],))]
+            result.append(Cluster(name=row["name"], config=config, hosts=hosts, kubeconfig=row["kubeconfig"],
+                                  last_operation=row["last_operation"], last_status=row["last_status"],
+                                  last_operation_at=row["last_operation_at"]))
+        return result
+
+    def record_operation(self, cluster: str, operation: str, status: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO clusters (name, last_operation, last_status, last_operation_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET last_operation = excluded.last_operation, "
+                "last_status = excluded.last_status, last_operation_at = excluded.last_operation_at",
+                (cluster, operation, status, time.time()))
+
+
+@contextmanager
+def track_operation(clusters_dir: Path, cluster: str, operation: str) -> Iterator[None]:
+    """Record operation as the last one of cluster: running, then ok or failed"""
+
+    def record(status: str) -> None:
+        # the fleet store is an index, an operation never fails because of it
+        try:
+            with FleetStore(clusters_dir) as fleet:
+                fleet.record_operation(cluster, operation, status)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to record {operation} of cluster {cluster}: {e}")
+
+    record("running")
+    try:
+        yield
+    except BaseException:
+        record("failed")
+        raise
+    record("ok")
@@ -0,0 +1,153 @@
+"""
+Inputs of the setup stages of a cluster, hashed per role and per host so that a re-run of
+`setup all --incremental` only touches what changed since the last successful run
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from common.logger import setup_logger
+from .inventory import Inventory
+from .stages import Stage, playbook_files, playbook_roles
+
+logger = setup_logger(__name__)
+
+INPUTS_FILE = "inputs.json"
+# a playbook is an input of its stage the way a role is, under this name
+PLAYBOOK_UNIT = "playbook"
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _unit_inputs(files: List[Path], base: Path, config: Dict[str, str], inventory: Inventory,
+                 groups: Iterable[str], bin_dirs: Iterable[Path]) -> Dict:
+    """
+    Inputs of a role (or playbook) made of files: their content, the config.yml keys and
+    [all:vars] they name, the members of the inventory groups they look up and the binaries
+    they install; all but the config are kept as digests
+    """
+    contents, text = [], []
+    for path in sorted(files):
+        data = path.read_bytes()
+        contents.append((str(path.relative_to(base)), hashlib.sha256(data).hexdigest()))
+        if b"\0" not in data[:1024]:
+            text.append(data.decode("utf-8", errors="replace"))
+    text = "\n".join(text)
+
+    words = set(re.findall(r"[A-Za-z_]\w*", text))
+    all_vars = inventory.section_vars("all:vars")
+    config_inputs = {key: _digest(value) for key, value in config.items() if key in words}
+    config_inputs.update({f"hosts:{key}": _digest(value) for key, value in all_vars.items() if key in words})
+
+    looked_up = set(groups) | {a or b for a, b in re.findall(r"groups\[['\"]([\w-]+)['\"]\]|groups\.(\w+)", text)}
+    tokens = set(re.findall(r"[\w.+-]+", text))
+    binaries = sorted((path.name, path.stat().st_size, path.stat().st_mtime_ns)
+                      for bin_dir in bin_dirs if bin_dir.is_dir()
+                      for path in bin_dir.iterdir() if path.is_file() and path.name in tokens)
+    return {
+        "files": _digest(contents),
+        "config": config_inputs,
+        "groups": _digest({group: inventory.hosts(group) for group in sorted(looked_up)}),
+        "binaries": _digest(binaries),
+    }
+
+
+def config_blocks(config_file: Path) -> Dict[str, str]:
+    """Top-level keys of a config.yml with their text, lists and mappings under them included"""
+    blocks: Dict[str, List[str]] = {}
+    key = None
+    for line in config_file.read_text().splitlines():
+        match = re.match(r"^(\w+):(.*)", line)
+        if match:
+            key = match.group(1)
+            blocks[key] = [match.group(2).strip()]
+        elif key and line.strip() and not line.lstrip().startswith("#"):
+            blocks[key].append(line.rstrip())
+    return {key: "\n".join(lines) for key, lines in blocks.items()}
+
+
+def host_inputs(inventory: Inventory, host: str) -> str:
+    """Digest of the groups of a host and the variables on its lines"""
+    sections = sorted(inventory.sections_of(host))
+    host_vars = {}
+    for section in sections:
+        host_vars.update(inventory.host_vars(section, host))
+    return _digest([sections, host_vars])
+
+
+def stage_inputs(stage: Stage, playbooks_dir: Path, roles_dir: Path, config: Dict[str, str], inventory: Inventory,
+                 bin_dirs: Iterable[Path]) -> Dict[str, Dict]:
+    """unit (the playbook, then each role it names) -> inputs"""
+    playbook = playbooks_dir / stage.playbook
+    units = {PLAYBOOK_UNIT: _unit_inputs(playbook_files(playbook), playbooks_dir, config, inventory,
+                                         stage.groups, bin_dirs)}
+    for role in playbook_roles(playbook, roles_dir):
+        files = [path for path in (roles_dir / role).rglob("*") if path.is_file()]
+        units[role] = _unit_inputs(files, roles_dir, config, inventory, (), bin_dirs)
+    return units
+
+
+class InputStore:
+    """
+    stage -> {"hosts": {host: {"time", "host", "units": {unit: inputs}}}} as of the last successful
+    run of the stage on each host, in clusters/<name>/inputs.json
+    """
+
+    def __init__(self, cluster_dir: Path):
+        self.path = cluster_dir / INPUTS_FILE
+        self._lock = threading.Lock()
+        try:
+            self.stages: Dict[str, Dict] = json.loads(self.path.read_text()).get("stages", {})
+        except (OSError, ValueError, AttributeError):
+            self.stages = {}
+
+    def changes(self, stage: str, host: str, units: Dict[str, Dict], host_digest: str) -> List[Tuple[str, str]]:
+        """(unit, what changed) since the last successful run of stage on host, empty when nothing did"""
+        last = self.stages.get(stage, {}).get("hosts", {}).get(host)
+        if last is None:
+            return [(stage, "no successful run recorded")]
+
+        found = []
+        if last.get("host") != host_digest:
+            found.append(("host", "groups or variables changed"))
+        for unit, inputs in units.items():
+            before = last.get("units", {}).get(unit)
+            if before is None:
+                found.append((unit, "new"))
+                continue
+            for part, what in (("files", "files changed"), ("groups", "inventory groups changed"),
+                               ("binaries", "binaries changed")):
+                if before.get(part) != inputs[part]:
+                    found.append((unit, what))
+            config_before = before.get("config", {})
+            for key in sorted(set(config_before) | set(inputs["config"])):
+                if config_before.get(key) != inputs["config"].get(key):
+                    found.append((unit, f"{key} changed"))
+        return found
+
+    def last_run(self, stage: str) -> float:
+        return max((entry.get("time", 0.0) for entry in self.stages.get(stage, {}).get("hosts", {}).values()),
+                   default=0.0)
+
+    def record(self, stage: str, hosts: Iterable[str], units: Dict[str, Dict], host_digests: Dict[str, str]) -> None:
+        """Inputs of a successful run of stage on hosts"""
+        with self._lock:
+            entries = self.stages.setdefault(stage, {}).setdefault("hosts", {})
+            for host in hosts:
+                entries[host] = {"time": time.time(), "host": host_digests[host], "units": units}
+            self._save()
+
+    def _save(self) -> None:
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps({"stages": self.stages}))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to save the setup inputs in {self.path}: {e}")
@@ -0,0 +1,179 @@
+"""
+Ansible INI inventory (the hosts file of a cluster) as an editable object
+"""
+import os
+import shlex
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from common.exceptions import NodeExistsError, NodeNotFoundError
+
+# Node.role -> inventory section
+ROLE_SECTIONS = {"etcd": "etcd", "master": "kube_master", "node": "kube_node"}
+
+
+def parse_vars(text: str) -> Dict[str, str]:
+    """key=value words of an inventory line, quotes removed"""
+    try:
+        words = shlex.split(text, comments=True)
+    except ValueError:
+        words = text.split()
+    return dict(w.split("=", 1) for w in words if "=" in w)
+
+
+class _Section:
+    """Lines of one [section], hosts indexed by their first word"""
+
+    def __init__(self, name: Optional[str], header: Optional[str]):
+        self.name = name
+        self.header = header
+        self.body: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.removed: Set[int] = set()
+        self.added: Dict[str, str] = {}
+        self.last_host = -1
+
+    def append_line(self, line: str) -> None:
+        stripped = line.strip()
+        if stripped and not stripped.startswith(("#", ";")) and self.name and ":" not in self.name:
+            host = stripped.split(None, 1)[0]
+            self.positions.setdefault(host, len(self.body))
+            self.last_host = len(self.body)
+        self.body.append(line)
+
+    def host_line(self, host: str) -> Optional[str]:
+        if host in self.added:
+            return self.added[host]
+        position = self.positions.get(host)
+        return self.body[position] if position is not None else None
+
+    def hosts(self) -> List[str]:
+        return list(self.positions) + list(self.added)
+
+    def render(self) -> List[str]:
+        lines = [self.header] if self.header is not None else []
+        if self.last_host == -1:
+            lines.extend(self.added.values())
+        for i, line in enumerate(self.body):
+            if i not in self.removed:
+                lines.append(line)
+            if i == self.last_host:
+                lines.extend(self.added.values())
+        return lines
+
+
+class Inventory:
+    """
+    Parsed hosts file: section -> hosts, host -> sections, all lines kept as they are
+
+    Lookups are dict lookups on the exact host (10.0.0.1 never matches 10.0.0.10). Edits are
+    kept in memory, new hosts go after the last host of their section, and save() writes the
+    file once, atomically, with comments, blank lines and ordering untouched.
+    """
+
+    def __init__(self, text: str = "", path: Optional[Path] = None):
+        self.path = path
+        self.dirty = False
+        self._trailing_newline = text.endswith("\n")
+        self._sections: List[_Section] = [_Section(None, None)]
+        self._by_name: Dict[str, _Section] = {}
+        self._host_sections: Dict[str, Set[str]] = {}
+
+        for line in text.splitlines():
+            stripped = line.strip()
+            if stripped.startswith("[") and stripped.endswith("]"):
+                name = stripped[1:-1].strip()
+                section = _Section(name, line)
+                self._sections.append(section)
+                self._by_name.setdefault(name, section)
+            else:
+                self._sections[-1].append_line(line)
+
+        for section in self._sections[1:]:
+            for host in section.positions:
+                self._host_sections.setdefault(host, set()).add(section.name)
+
+    @classmethod
+    def load(cls, path: Path) -> "Inventory":
+        return cls(path.read_text(), path)
+
+    @staticmethod
+    def role_section(role: str) -> str:
+        if role not in ROLE_SECTIONS:
+            raise ValueError(f"Invalid node role: {role}")
+        return ROLE_SECTIONS[role]
+
+    def sections(self) -> List[str]:
+        return list(self._by_name)
+
+    def hosts(self, section: str) -> List[str]:
+        """Hosts of a section in file order, commented lines excluded"""
+        found = self._by_name.get(section)
+        return found.hosts() if found else []
+
+    def has(self, section: str, host: str) -> bool:
+        return section in self._host_sections.get(host, ())
+
+    def sections_of(self, host: str) -> Set[str]:
+        """Sections listing host"""
+        return set(self._host_sections.get(host, ()))
+
+    def host_vars(self, section: str, host: str) -> Dict[str, str]:
+        """Inline variables of a host line"""
+        found = self._by_name.get(section)
+        line = found.host_line(host) if found else None
+        if line is None:
+            raise NodeNotFoundError(f"Node {host} not found in {section} section")
+        return parse_vars(line.strip().split(None, 1)[1] if len(line.split()) > 1 else "")
+
+    def section_vars(self, section: str) -> Dict[str, str]:
+        """key=value lines of a [group:vars] section, e.g. all:vars"""
+        found = self._by_name.get(section)
+        values = {}
+        for line in found.body if found else []:
+            stripped = line.strip()
+            if stripped and not stripped.startswith(("#", ";")) and "=" in stripped:
+                key, _, value = stripped.partition("=")
+                values[key.strip()] = value.strip().strip("'\"")
+        return values
+
+    def add(self, section: str, host: str, host_vars: str = "") -> None:
+        """Append a host line to section"""
+        found = self._by_name.get(section)
+        if found is None:
+            raise ValueError(f"Section [{section}] not found in hosts file")
+        if self.has(section, host):
+            raise NodeExistsError(f"Node {host} already exists in {section} section")
+        found.added[host] = f"{host} {host_vars}".strip()
+        self._host_sections.setdefault(host, set()).add(section)
+        self.dirty = True
+
+    def remove(self, section: str, host: str) -> None:
+        """Drop the line of host from section"""
+        if not self.has(section, host):
+            raise NodeNotFoundError(f"Node {host} not found in {section} section")
+        found = self._by_name[section]
+        if found.added.pop(host, None) is None:
+            found.removed.add(found.positions.pop(host))
+        self._host_sections[host].discard(section)
+        self.dirty = True
+
+    def render(self) -> str:
+        lines = [line for section in self._sections for line in section.render()]
+        return "\n".join(lines) + ("\n" if self._trailing_newline or self.dirty else "")
+
+    def save(self, path: Optional[Path] = None) -> None:
+        """Write all pending edits at once: temp file in the same dir, then rename over the hosts file"""
+        path = path or self.path
+        if path is None:
+            raise ValueError("Inventory has no file to save to")
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(self.render())
+            if path.exists():
+                os.chmod(tmp, path.stat().st_mode & 0o7777)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        self.dirty = False
@@ -0,0 +1,111 @@
+"""
+Fingerprints of cluster kubeconfigs, to tell which cluster ~/.kube/config belongs to
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+from common.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+INDEX_NAME = ".fingerprints.json"
+
+
+def kubeconfig_fingerprint(path: Path) -> str:
+    """
+    md5 of a kubeconfig without its server lines, as `sed /server/d <path> | md5sum`
+
+    The server address differs between the copy in ~/.kube/config and the one of the cluster
+    directory (load balancer vs first master), everything else identifies the cluster.
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for line in f:
+            if b"server" not in line:
+                md5.update(line)
+    return md5.hexdigest()
+
+
+class FingerprintIndex:
+    """
+    Fingerprints of clusters/<name>/kubectl.kubeconfig persisted in clusters/.fingerprints.json
+
+    An entry is trusted while size and mtime of its kubeconfig are unchanged, so answering
+    which cluster is current costs one stat per cluster and hashes only what changed since.
+    """
+
+    def __init__(self, clusters_dir: Path):
+        self.clusters_dir = clusters_dir
+        self.index_file = clusters_dir / INDEX_NAME
+        self._entries: Dict[str, Dict] = self._load()
+        self._dirty = False
+
+    def fingerprint(self, key: str, path: Path) -> Optional[str]:
+        """Fingerprint of path, from the index when its stat matches, None if missing"""
+        try:
+            st = path.stat()
+        except OSError:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+            return None
+
+        entry = self._entries.get(key)
+        if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size \
+                and entry.get("path", str(path)) == str(path):
+            return entry["md5"]
+
+        self._entries[key] = {"path": str(path), "mtime_ns": st.st_mtime_ns, "size": st.st_size,
+                              "md5": kubeconfig_fingerprint(path)}
+        self._dirty = True
+        return self._entries[key]["md5"]
+
+    def set(self, key: str, path: Path, md5: str) -> None:
+        """Record a fingerprint known without reading path (e.g. of a copy just made)"""
+        st = path.stat()
+        self._entries[key] = {"path": str(path), "mtime_ns": st.st_mtime_ns, "size": st.st_size, "md5": md5}
+        self._dirty = True
+
+    def match(self, current: Path) -> Optional[str]:
+        """Name of the cluster whose kubeconfig current is a copy of, None when none is"""
+        current_md5 = self.fingerprint("@current", current)
+        if current_md5 is None:
+            return None
+
+        found = None
+        clusters = set()
+        with os.scandir(self.clusters_dir) as it:
+            for entry in it:
+                if not entry.is_dir() or entry.name.startswith("."):
+                    continue
+                clusters.add(entry.name)
+                md5 = self.fingerprint(entry.name, Path(entry.path) / "kubectl.kubeconfig")
+                if md5 == current_md5 and (found is None or entry.name < found):
+                    found = entry.name
+
+        # clusters removed since the last run
+        for key in [k for k in self._entries if not k.startswith("@") and k not in clusters]:
+            del self._entries[key]
+            self._dirty = True
+        return found
+
+    def save(self) -> None:
+        """Persist the index if anything changed, an index that cannot be written is only a lost cache"""
+        if not self._dirty:
+            return
+        tmp = self.index_file.with_name(f"{self.index_file.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps(self._entries))
+            os.replace(tmp, self.index_file)
+            self._dirty = False
+        except OSError as e:
+            logger.debug(f"Failed to save {self.index_file}: {e}")
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            entries = json.loads(self.index_file.read_text())
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError):
+            return {}
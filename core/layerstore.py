@@ -0,0 +1,338 @@
+"""
+Content-addressed store of saved images for kubeauto
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Dict, Iterable, Iterator, List, Optional
+
+from common.constants import KubeConstant
+from common.exceptions import ImageArchiveError
+from common.logger import setup_logger
+from common.compress import ZstdWriter, iter_decompressed, open_archive_file, zstd_available
+from .archive import ImageArchive, _normalize
+
+logger = setup_logger(__name__)
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+OCI_BLOB_NAME = re.compile(r"blobs/sha256/([0-9a-f]{64})")
+TMP_GRACE_SECONDS = 3600
+
+
+class _IterReader:
+    """File-like reader over an iterator of byte chunks"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._chunk = b""
+        self._pos = 0
+
+    def read(self, n: int = -1) -> bytes:
+        parts = []
+        while n < 0 or n > 0:
+            if self._pos >= len(self._chunk):
+                self._chunk = next(self._chunks, b"")
+                self._pos = 0
+                if not self._chunk:
+                    break
+            end = len(self._chunk) if n < 0 else min(len(self._chunk), self._pos + n)
+            parts.append(self._chunk[self._pos:end])
+            if n > 0:
+                n -= end - self._pos
+            self._pos = end
+        return b"".join(parts)
+
+
+class LayerStore:
+    """
+    Content-addressed store for image tarballs under IMAGE_DIR
+
+    Every regular file of a saved tarball (layers, configs, manifest.json) is kept once under
+    blobs/sha256/<digest>, and every image gets a small manifest under manifests/<name>.json
+    listing its tar entries. Base layers shared between components and versions are therefore
+    stored once, and the tarball is rebuilt as a stream when something needs it.
+
+    A .zst suffix marks a blob stored compressed; the digest is always that of the plain content.
+    """
+
+    def __init__(self, root: Optional[Path] = None):
+        self.kube_constant = KubeConstant()
+        self.root = Path(root or self.kube_constant.IMAGE_DIR)
+        self.blob_dir = self.root / "blobs" / "sha256"
+        self.manifest_dir = self.root / "manifests"
+
+    @property
+    def compress(self) -> bool:
+        return self.kube_constant.IMAGE_COMPRESSION == "zstd" and zstd_available()
+
+    def blob_path(self, digest: str) -> Optional[Path]:
+        """File holding a blob, plain or zstd-compressed, None when not stored"""
+        plain = self.blob_dir / digest.split(":", 1)[-1]
+        for path in (plain.with_name(plain.name + ".zst"), plain):
+            if path.exists():
+                return path
+        return None
+
+    def blob_file(self, digest: str) -> Path:
+        path = self.blob_path(digest)
+        if path is None:
+            raise ImageArchiveError(f"Blob {digest} missing from {self.blob_dir}")
+        return path
+
+    @staticmethod
+    def is_compressed(blob: Path) -> bool:
+        return blob.name.endswith(".zst")
+
+    def manifest_path(self, name: str) -> Path:
+        return self.manifest_dir / f"{name}.json"
+
+    def exists(self, name: str) -> bool:
+        return self.manifest_path(name).exists()
+
+    def names(self) -> List[str]:
+        """Names of all stored images"""
+        if not self.manifest_dir.exists():
+            return []
+        return sorted(p.stem for p in self.manifest_dir.glob("*.json"))
+
+    @contextmanager
+    def lock(self, exclusive: bool = False) -> Iterator[None]:
+        """
+        flock of the store shared by every kubeauto process: ingests hold it shared, gc exclusive
+
+        An ingest renames its blobs into place before it writes the manifest naming them, a gc
+        running in between would take them for orphans.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / ".store.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load_manifest(self, name: str) -> Dict:
+        try:
+            return json.loads(self.manifest_path(name).read_text())
+        except (OSError, ValueError) as e:
+            raise ImageArchiveError(f"Failed to read stored image {name}: {e}")
+
+    def ingest(self, name: str, chunks: Iterable[bytes], image: Optional[str] = None) -> Dict:
+        """
+        Store a tarball given as a stream of chunks (e.g. `docker save` output)
+
+        Blobs named by their digest (OCI layout) that are already stored are skipped without
+        writing anything; other files are hashed while written and dropped if already stored.
+        """
+        with self.lock():
+            return self._ingest(name, chunks, image)
+
+    def _ingest(self, name: str, chunks: Iterable[bytes], image: Optional[str] = None) -> Dict:
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+
+        entries = []
+        new_bytes = 0
+        # one compression pool for all the blobs of the image
+        workers = self.kube_constant.COMPRESSION_WORKERS or os.cpu_count() or 1
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="zstd") if self.compress else None
+        try:
+            with tarfile.open(fileobj=_IterReader(chunks), mode="r|") as tar:
+                for member in tar:
+                    entry = {
+                        "name": _normalize(member.name),
+                        "mode": member.mode,
+                        "mtime": member.mtime,
+                    }
+                    if member.isdir():
+                        entry["type"] = "dir"
+                    elif member.issym() or member.islnk():
+                        entry.update(type="symlink" if member.issym() else "hardlink", linkname=member.linkname)
+                    elif member.isfile():
+                        digest, written = self._store_blob(entry["name"], member.size, tar.extractfile(member), pool)
+                        entry.update(type="file", size=member.size, digest=digest)
+                        new_bytes += written
+                    else:
+                        continue
+                    entries.append(entry)
+        except tarfile.TarError as e:
+            raise ImageArchiveError(f"Failed to store image {name}: {e}")
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+        manifest = {"name": name, "image": image, "created": int(time.time()), "entries": entries}
+        tmp = self.manifest_path(name).with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(manifest, indent=1))
+        os.replace(tmp, self.manifest_path(name))
+
+        logger.info(f"Stored image {name}: {sum(e.get('size', 0) for e in entries) / 1024 ** 2:.1f} MB, "
+                    f"{new_bytes / 1024 ** 2:.1f} MB new", extra={"to_stdout": True})
+        return manifest
+
+    def ingest_file(self, name: str, path: Path, image: Optional[str] = None) -> Dict:
+        """Store an existing tarball file, plain or zstd-compressed"""
+        return self.ingest(name, iter_decompressed(path, self.kube_constant.IMAGE_CHUNK_SIZE,
+                                                   self.kube_constant.COMPRESSION_WORKERS), image)
+
+    def _store_blob(self, name: str, size: int, src: IO[bytes],
+                    pool: Optional[ThreadPoolExecutor] = None) -> tuple[str, int]:
+        """Store one file, return (digest, bytes written)"""
+        known = OCI_BLOB_NAME.fullmatch(name)
+        if known and self.blob_path(known.group(1)) is not None:
+            return f"sha256:{known.group(1)}", 0
+
+        sha = hashlib.sha256()
+        tmp = self.blob_dir / f".tmp-{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}"
+        try:
+            with open(tmp, "wb") as f:
+                dst = ZstdWriter(f, self.kube_constant.IMAGE_COMPRESSION_LEVEL,
+                                 self.kube_constant.COMPRESSION_WORKERS, pool=pool) if self.compress else f
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    sha.update(chunk)
+                    dst.write(chunk)
+                if dst is not f:
+                    dst.close()
+            if self.blob_path(sha.hexdigest()) is not None:
+                tmp.unlink()
+                return f"sha256:{sha.hexdigest()}", 0
+            written = tmp.stat().st_size
+            os.replace(tmp, self.blob_dir / (sha.hexdigest() + (".zst" if self.compress else "")))
+            return f"sha256:{sha.hexdigest()}", written
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def stream(self, name: str, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        """Rebuild the tarball of a stored image as a stream of chunks"""
+        chunk_size = chunk_size or self.kube_constant.IMAGE_CHUNK_SIZE
+        for entry in self.load_manifest(name)["entries"]:
+            info = tarfile.TarInfo(entry["name"])
+            info.mode = entry["mode"]
+            info.mtime = entry["mtime"]
+            if entry["type"] == "dir":
+                info.type = tarfile.DIRTYPE
+            elif entry["type"] in ("symlink", "hardlink"):
+                info.type = tarfile.SYMTYPE if entry["type"] == "symlink" else tarfile.LNKTYPE
+                info.linkname = entry["linkname"]
+            else:
+                info.size = entry["size"]
+            yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+            if entry["type"] == "file":
+                blob = self.blob_file(entry["digest"])
+                yield from iter_decompressed(blob, chunk_size, self.kube_constant.COMPRESSION_WORKERS,
+                                             compressed=self.is_compressed(blob))
+                remainder = entry["size"] % BLOCK_SIZE
+                if remainder:
+                    yield b"\0" * (BLOCK_SIZE - remainder)
+        # end-of-archive marker
+        yield b"\0" * (BLOCK_SIZE * 2)
+
+    def open_image(self, name: str) -> "StoredImage":
+        return StoredImage(self, name)
+
+    def usage(self) -> Dict:
+        """
+        du-style usage of the store
+
+        return per image logical size and size of the blobs no other image shares,
+        plus the totals: logical bytes (all images as tarballs) vs bytes actually stored
+        """
+        blob_users: Dict[str, int] = {}
+        images = {}
+        for name in self.names():
+            blobs = {e["digest"]: e["size"] for e in self.load_manifest(name)["entries"] if e["type"] == "file"}
+            images[name] = blobs
+            for digest in blobs:
+                blob_users[digest] = blob_users.get(digest, 0) + 1
+
+        report = []
+        for name, blobs in images.items():
+            report.append({
+                "name": name,
+                "bytes": sum(blobs.values()),
+                "exclusive_bytes": sum(size for digest, size in blobs.items() if blob_users[digest] == 1),
+            })
+
+        stored = 0
+        if self.blob_dir.exists():
+            stored = sum(blob.stat().st_size for blob in self.blob_dir.iterdir() if not blob.name.startswith(".tmp-"))
+        return {
+            "images": report,
+            "blobs": len(blob_users),
+            "logical_bytes": sum(r["bytes"] for r in report),
+            "stored_bytes": stored,
+        }
+
+    def remove(self, name: str) -> int:
+        """Drop a stored image and the blobs no other image uses, return bytes freed"""
+        freed = 0
+        path = self.manifest_path(name)
+        if path.exists():
+            freed += path.stat().st_size
+            path.unlink()
+        return freed + self.gc()
+
+    def gc(self) -> int:
+        """Delete blobs no stored image references (and temp files of interrupted writes), return bytes freed"""
+        if not self.blob_dir.exists():
+            return 0
+        with self.lock(exclusive=True):
+            return self._gc()
+
+    def _gc(self) -> int:
+        referenced = set()
+        for name in self.names():
+            referenced.update(e["digest"].split(":", 1)[-1] for e in self.load_manifest(name)["entries"]
+                              if e["type"] == "file")
+
+        freed = 0
+        for blob in self.blob_dir.iterdir():
+            st = blob.stat()
+            if blob.name.startswith(".tmp-"):
+                # only leftovers of a crashed run, a running ingest writes its temp file continuously
+                if time.time() - st.st_mtime < TMP_GRACE_SECONDS:
+                    continue
+            elif blob.name.split(".", 1)[0] in referenced:
+                continue
+            freed += st.st_size
+            blob.unlink()
+        return freed
+
+
+class StoredImage(ImageArchive):
+    """ImageArchive reading its members from the layer store instead of a tarball"""
+
+    def __init__(self, store: LayerStore, name: str):
+        self.store = store
+        self.path = store.manifest_path(name)
+        self._entries = {e["name"]: e for e in store.load_manifest(name)["entries"]}
+        self._members = self._entries
+
+    def close(self) -> None:
+        pass
+
+    def _entry(self, name: str) -> Dict:
+        entry = self._entries.get(_normalize(name))
+        if entry is None or entry["type"] != "file":
+            raise ImageArchiveError(f"{name} not found in stored image {self.path.stem}")
+        return entry
+
+    def _open_member(self, name: str) -> IO[bytes]:
+        blob = self.store.blob_file(self._entry(name)["digest"])
+        return open_archive_file(blob, compressed=self.store.is_compressed(blob))
+
+    def open_independent(self, name: str) -> IO[bytes]:
+        return self._open_member(name)
+
+    def member_size(self, name: str) -> int:
+        return self._entry(name)["size"]
@@ -0,0 +1,104 @@
+"""
+Manifests of the bundles installed by kubeauto
+"""
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from common.exceptions import CommandExecutionError
+from common.logger import setup_logger
+from common.utils import run_command
+
+logger = setup_logger(__name__)
+
+# bundle -> component -> (binary relative to the bundle destination, parser of its --version output)
+COMPONENT_PROBES: Dict[str, Dict[str, Tuple[str, Callable[[str], str]]]] = {
+    "k8s_bin": {
+        "kubernetes": ("kube-apiserver", lambda out: out.split()[1]),
+    },
+    "ext_bin": {
+        "etcd": ("etcd", lambda out: "v" + out.split()[2]),
+    },
+}
+
+
+def file_sha256(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@dataclass
+class BundleManifest:
+    """
+    What a bundle installed into its destination: `<destination>/.<bundle>.manifest.json`
+
+    Files are checked by size and mtime first, only files whose stat changed are hashed,
+    so verifying an intact bundle reads no file content at all.
+    """
+    bundle: str
+    version: str
+    image: str = ""
+    created: int = 0
+    components: Dict[str, str] = field(default_factory=dict)
+    files: Dict[str, Dict] = field(default_factory=dict)
+
+    @staticmethod
+    def path(destination: Path, bundle: str) -> Path:
+        return destination / f".{bundle}.manifest.json"
+
+    @classmethod
+    def load(cls, destination: Path, bundle: str) -> Optional["BundleManifest"]:
+        """Manifest of bundle in destination, None when missing or unreadable"""
+        try:
+            return cls(**json.loads(cls.path(destination, bundle).read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, destination: Path) -> None:
+        """Write the manifest atomically"""
+        target = self.path(destination, self.bundle)
+        tmp = target.with_name(target.name + ".tmp")
+        tmp.write_text(json.dumps(asdict(self), indent=1, sort_keys=True))
+        os.replace(tmp, target)
+
+    def record(self, destination: Path, files: Iterable[str]) -> None:
+        """(Re)compute size, mtime and sha256 of files"""
+        for rel in files:
+            path = destination / rel
+            if path.is_symlink() or not path.is_file():
+                self.files.pop(rel, None)
+                continue
+            st = path.stat()
+            self.files[rel] = {"sha256": file_sha256(path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        self.created = int(time.time())
+
+    def verify(self, destination: Path) -> List[str]:
+        """Files missing or differing from the manifest"""
+        stale = []
+        for rel, expected in self.files.items():
+            path = destination / rel
+            try:
+                st = path.stat()
+            except OSError:
+                stale.append(rel)
+                continue
+            if st.st_size != expected["size"]:
+                stale.append(rel)
+            elif st.st_mtime_ns != expected["mtime_ns"] and file_sha256(path) != expected["sha256"]:
+                stale.append(rel)
+        return stale
+
+    def capture_components(self, destination: Path) -> None:
+        """Run each component binary once, at install time, to record its version"""
+        for component, (binary, parse) in COMPONENT_PROBES.get(self.bundle, {}).items():
+            try:
+                self.components[component] = parse(run_command([str(destination / binary), "--version"]).stdout)
+            except (CommandExecutionError, IndexError) as e:
+                logger.warning(f"Failed to get the version of {component}: {e}")
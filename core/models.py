@@ -1,7 +1,7 @@
 """
 Data models for kubeauto
 """
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List, Optional, Dict, Any
 
 @dataclass
@@ -10,17 +10,20 @@ class Cluster:
     config: Dict[str, Any]
     hosts: List[str]
     kubeconfig: Optional[str] = None
+    last_operation: Optional[str] = None
+    last_status: Optional[str] = None
+    last_operation_at: Optional[float] = None
 
 @dataclass
 class Node:
     ip: str
-    role: str  # 'etcd', 'master', 'node'
+    role: str  # 'etcd', 'master', 'node', or the inventory section ('harbor', 'ex_lb', 'chrony')
     cluster: str
-    extra_info: Optional[Dict[str, str]] = None
+    extra_info: Optional[Dict[str, str]] = field(default_factory=dict)
 
 @dataclass
 class KubeConfigUser:
     name: str
     user_type: str  # 'admin' or 'view'
     expiry: str
-    cert_path: str
\ No newline at end of file
+    cert_path: str
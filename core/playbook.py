@@ -0,0 +1,242 @@
+"""
+ansible-playbook runs followed through the event stream of the kubeauto_events callback
+"""
+import json
+import os
+import signal
+import subprocess
+import threading
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from common.exceptions import CommandExecutionError
+from common.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+CALLBACK_NAME = "kubeauto_events"
+EVENTS_FD_ENV = "KUBEAUTO_EVENTS_FD"
+# seconds ansible-playbook gets to stop after SIGINT before it is terminated
+ABORT_GRACE = 30
+
+
+@dataclass
+class PlaybookEvent:
+    """
+    One line of the stream: playbook_start, play_start, task_start, host_start, host_retry,
+    host_end or playbook_end
+    """
+    event: str
+    time: float
+    play: Optional[str] = None
+    task: Optional[str] = None
+    task_id: Optional[str] = None
+    role: Optional[str] = None
+    action: Optional[str] = None
+    handler: bool = False
+    host: Optional[str] = None
+    status: Optional[str] = None  # host_end: ok, changed, failed, unreachable or skipped
+    duration: Optional[float] = None
+    attempts: Optional[int] = None
+    retries: Optional[int] = None
+    ignore_errors: bool = False
+    delegated_to: Optional[str] = None
+    msg: Optional[str] = None
+    playbook: Optional[str] = None
+    hosts: Any = None  # play_start: host pattern, playbook_end: counters per host
+
+    @classmethod
+    def from_json(cls, line: str) -> "PlaybookEvent":
+        data = json.loads(line)
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
+
+@dataclass
+class HostResult:
+    host: str
+    ok: int = 0
+    changed: int = 0
+    unreachable: int = 0
+    failed: int = 0
+    skipped: int = 0
+    rescued: int = 0
+    ignored: int = 0
+    msg: Optional[str] = None  # first failure
+
+    @property
+    def status(self) -> str:
+        if self.unreachable:
+            return "unreachable"
+        return "failed" if self.failed else "ok"
+
+
+@dataclass
+class PlaybookResult:
+    returncode: int
+    hosts: Dict[str, HostResult] = field(default_factory=dict)
+    streamed: bool = False
+    aborted: bool = False
+
+    def status(self, host: str) -> str:
+        """ok, failed or unreachable; without events (callback not loaded) only the exit code tells"""
+        if host in self.hosts:
+            return self.hosts[host].status
+        if not self.streamed:
+            return "ok" if self.returncode == 0 else "failed"
+        return "failed"
+
+    @property
+    def failed_hosts(self) -> List[str]:
+        return [host for host, result in self.hosts.items() if result.status != "ok"]
+
+
+Listener = Callable[[PlaybookEvent], None]
+
+
+class PlaybookRunner:
+    """
+    Run ansible-playbook with the kubeauto_events callback enabled and hand every event to listeners
+
+    The output of ansible is left on the terminal as it is (prompts included), or written to
+    the output file when given, events come through a pipe of their own and are read by a
+    thread, so listeners are called from that thread. Host counters are kept from the events
+    as they arrive; with max_failures set, the run is interrupted once more hosts than that
+    have failed.
+    """
+
+    def __init__(self, cmd: List[str], callback_dir: Path, env: Optional[Dict[str, str]] = None,
+                 listeners: Iterable[Listener] = (), max_failures: Optional[int] = None,
+                 output: Optional[Path] = None):
+        self.cmd = cmd
+        self.callback_dir = callback_dir
+        self.env = env or {}
+        self.listeners = list(listeners)
+        self.max_failures = max_failures
+        self.output = output
+        self.result = PlaybookResult(returncode=-1)
+        self._proc: Optional[subprocess.Popen] = None
+
+    def _environment(self, fd: int) -> Dict[str, str]:
+        env = dict(os.environ)
+
+        def prepend(key: str, value: str, sep: str) -> None:
+            env[key] = sep.join(v for v in (value, env.get(key)) if v)
+
+        prepend("ANSIBLE_CALLBACK_PLUGINS", str(self.callback_dir), ":")
+        # CALLBACKS_ENABLED since ansible-core 2.11, CALLBACK_WHITELIST before
+        prepend("ANSIBLE_CALLBACKS_ENABLED", CALLBACK_NAME, ",")
+        prepend("ANSIBLE_CALLBACK_WHITELIST", CALLBACK_NAME, ",")
+        env[EVENTS_FD_ENV] = str(fd)
+        env.update(self.env)
+        return env
+
+    def run(self) -> PlaybookResult:
+        logger.debug(f"Executing command: {' '.join(self.cmd)}")
+        read_fd, write_fd = os.pipe()
+        out = None
+        try:
+            if self.output:
+                out = open(self.output, "w")
+            self._proc = subprocess.Popen(self.cmd, env=self._environment(write_fd), pass_fds=(write_fd,),
+                                          stdin=subprocess.DEVNULL if out else None, stdout=out,
+                                          stderr=subprocess.STDOUT if out else None)
+        except OSError as e:
+            os.close(read_fd)
+            raise CommandExecutionError(f"Command failed: {e}")
+        finally:
+            os.close(write_fd)
+            if out:
+                out.close()
+
+        reader = threading.Thread(target=self._read_events, args=(read_fd,), daemon=True)
+        reader.start()
+        try:
+            self.result.returncode = self._proc.wait()
+        except BaseException:
+            # Ctrl-C reached ansible-playbook too, give it the time to stop its workers
+            self._stop()
+            raise
+        # the pipe closes with the last process holding it, which is normally ansible-playbook itself
+        reader.join(timeout=5)
+        return self.result
+
+    def _read_events(self, read_fd: int) -> None:
+        with os.fdopen(read_fd, "r", encoding="utf-8", errors="replace") as stream:
+            for line in stream:
+                try:
+                    event = PlaybookEvent.from_json(line)
+                except (ValueError, TypeError):
+                    logger.debug(f"Unreadable playbook event: {line.strip()}")
+                    continue
+                self.result.streamed = True
+                self._account(event)
+                for listener in self.listeners:
+                    try:
+                        listener(event)
+                    except Exception as e:
+                        logger.warning(f"Playbook event listener failed: {e}")
+
+    def _account(self, event: PlaybookEvent) -> None:
+        if event.event == "host_end" and event.host:
+            host = self.result.hosts.setdefault(event.host, HostResult(event.host))
+            if event.status == "failed" and event.ignore_errors:
+                host.ignored += 1
+            elif event.status in ("ok", "changed", "failed", "unreachable", "skipped"):
+                setattr(host, event.status, getattr(host, event.status) + 1)
+                if event.status == "changed":
+                    host.ok += 1
+                if event.status in ("failed", "unreachable") and host.msg is None:
+                    host.msg = f"{event.task}: {event.msg}" if event.msg else event.task
+            self._check_failures()
+        elif event.event == "playbook_end" and isinstance(event.hosts, dict):
+            # final counters of ansible itself, rescued tasks included
+            for name, stats in event.hosts.items():
+                host = self.result.hosts.setdefault(name, HostResult(name))
+                for key, value in stats.items():
+                    key = "failed" if key == "failures" else key
+                    if key in ("ok", "changed", "unreachable", "failed", "skipped", "rescued", "ignored"):
+                        setattr(host, key, value)
+
+    def _check_failures(self) -> None:
+        if self.max_failures is None or self.result.aborted:
+            return
+        failed = self.result.failed_hosts
+        if len(failed) > self.max_failures:
+            logger.error(f"{len(failed)} host(s) failed, more than the {self.max_failures} allowed, aborting the "
+                         f"playbook: {' '.join(failed)}", extra={"to_stdout": True})
+            self.result.aborted = True
+            # called from the reader thread, which must keep draining the pipe while ansible stops
+            threading.Thread(target=self._stop, daemon=True).start()
+
+    def _stop(self) -> None:
+        """SIGINT as a Ctrl-C would, then SIGTERM if ansible-playbook is still there after ABORT_GRACE"""
+        if self._proc is None or self._proc.poll() is not None:
+            return
+        try:
+            self._proc.send_signal(signal.SIGINT)
+            self._proc.wait(timeout=ABORT_GRACE)
+        except subprocess.TimeoutExpired:
+            self._proc.terminate()
+        except OSError:
+            pass
+
+
+def run_playbook(cmd: List[str], callback_dir: Path, env: Optional[Dict[str, str]] = None,
+                 listeners: Iterable[Listener] = (), max_failures: Optional[int] = None,
+                 check: bool = True, output: Optional[Path] = None) -> PlaybookResult:
+    """Run a playbook, with check a failed run raises CommandExecutionError naming the failed hosts"""
+    result = PlaybookRunner(cmd, callback_dir, env, listeners, max_failures, output).run()
+    if check and result.returncode != 0:
+        raise_for_result(cmd, result)
+    return result
+
+
+def raise_for_result(cmd: List[str], result: PlaybookResult) -> None:
+    """CommandExecutionError for a failed run, with the hosts that failed and their first error"""
+    failures = [f"{host} ({result.hosts[host].status}: {result.hosts[host].msg})" for host in result.failed_hosts]
+    raise CommandExecutionError(
+        f"Command failed with exit code {result.returncode}: {' '.join(cmd)}" +
+        (f"\nFailed hosts: {', '.join(failures)}" if failures else "") +
+        ("\nAborted after too many failed hosts" if result.aborted else ""))
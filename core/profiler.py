@@ -0,0 +1,203 @@
+"""
+Timings of the playbooks run on a cluster: recorded from the event stream, read back by `kubeauto profile`
+"""
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, TextIO, Tuple
+
+from common.logger import setup_logger
+from .playbook import PlaybookEvent, PlaybookResult
+
+logger = setup_logger(__name__)
+
+RUNS_DIR = "runs"
+FACT_ACTIONS = {"gather_facts", "setup", "ansible.builtin.gather_facts", "ansible.builtin.setup"}
+
+
+class RunRecorder:
+    """
+    Playbook listener writing every event of one run to clusters/<name>/runs/<timestamp>-<playbook>.jsonl
+
+    The first line describes the run (command, start), the last one its outcome; only the
+    newest keep runs of a cluster are kept.
+    """
+
+    def __init__(self, cluster_dir: Path, cmd: List[str], keep: int):
+        runs_dir = cluster_dir / RUNS_DIR
+        runs_dir.mkdir(parents=True, exist_ok=True)
+        stem = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{Path(cmd[-1]).stem}"
+        # stages of setup all start at the same time, the name is taken by creating the file
+        self.path = runs_dir / f"{stem}.jsonl"
+        n = 1
+        while True:
+            try:
+                self._file: Optional[TextIO] = open(self.path, "x")
+                break
+            except FileExistsError:
+                self.path = runs_dir / f"{stem}.{n}.jsonl"
+                n += 1
+
+        self._write({"event": "run_start", "time": time.time(), "cmd": cmd, "playbook": Path(cmd[-1]).name})
+        prune_runs(cluster_dir, keep)
+
+    def _write(self, record: Dict) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to record playbook run in {self.path}: {e}")
+            self._file = None
+
+    def __call__(self, event: PlaybookEvent) -> None:
+        self._write({k: v for k, v in asdict(event).items() if v is not None and v is not False})
+
+    def close(self, result: Optional[PlaybookResult]) -> None:
+        """Record the outcome (None: interrupted) and flush"""
+        self._write({"event": "run_end", "time": time.time(),
+                     "returncode": result.returncode if result else None,
+                     "aborted": result.aborted if result else True})
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def list_runs(cluster_dir: Path) -> List[Path]:
+    """Recorded runs of a cluster, oldest first"""
+    runs_dir = cluster_dir / RUNS_DIR
+    return sorted(runs_dir.glob("*.jsonl"), key=lambda p: p.stat().st_mtime_ns) if runs_dir.is_dir() else []
+
+
+def find_run(cluster_dir: Path, run: Optional[str] = None) -> Path:
+    """Run file whose name starts with run, the newest one when run is None"""
+    runs = list_runs(cluster_dir)
+    if run:
+        runs = [path for path in runs if path.stem.startswith(run) or path.name == run]
+    if not runs:
+        raise FileNotFoundError(f"No recorded run{f' matching {run}' if run else ''} in {cluster_dir / RUNS_DIR}")
+    return runs[-1]
+
+
+@dataclass
+class TaskTiming:
+    play: str
+    role: str
+    task: str
+    action: str
+    wall: float = 0.0  # task start to the end of its last host
+    host_seconds: float = 0.0  # summed over hosts
+    hosts: int = 0
+    slowest_host: str = ""
+    slowest: float = 0.0
+    retries: int = 0
+    failed: int = 0
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        return self.play, self.role, self.task
+
+    @property
+    def is_facts(self) -> bool:
+        return self.action in FACT_ACTIONS
+
+
+@dataclass
+class RunProfile:
+    """Where the time of one recorded run went: per task, role and host"""
+    run_id: str
+    playbook: str = ""
+    started: float = 0.0
+    wall: float = 0.0
+    returncode: Optional[int] = None
+    aborted: bool = False
+    tasks: List[TaskTiming] = field(default_factory=list)
+    hosts: Dict[str, float] = field(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Path) -> "RunProfile":
+        profile = cls(run_id=path.stem)
+        by_id: Dict[str, TaskTiming] = {}
+        task_start: Dict[str, float] = {}
+        first = last = None
+
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a run cut short may end with half a line
+                event, at = record.get("event"), record.get("time", 0.0)
+                first = at if first is None else first
+                last = max(last or at, at)
+
+                if event == "run_start":
+                    profile.playbook, profile.started = record.get("playbook", ""), at
+                elif event == "run_end":
+                    profile.returncode, profile.aborted = record.get("returncode"), record.get("aborted", False)
+                elif event == "task_start":
+                    task_id = record.get("task_id", "")
+                    task_start[task_id] = at
+                    if task_id not in by_id:
+                        by_id[task_id] = TaskTiming(record.get("play") or "", record.get("role") or "",
+                                                    record.get("task") or "", record.get("action") or "")
+                elif event == "host_retry" and record.get("task_id") in by_id:
+                    by_id[record["task_id"]].retries += 1
+                elif event == "host_end" and record.get("task_id") in by_id:
+                    timing = by_id[record["task_id"]]
+                    duration = record.get("duration") or 0.0
+                    host = record.get("host", "")
+                    timing.hosts += 1
+                    timing.host_seconds += duration
+                    timing.wall = max(timing.wall, at - task_start.get(record["task_id"], at))
+                    timing.failed += record.get("status") in ("failed", "unreachable")
+                    if duration >= timing.slowest:
+                        timing.slowest, timing.slowest_host = duration, host
+                    profile.hosts[host] = profile.hosts.get(host, 0.0) + duration
+
+        profile.tasks = list(by_id.values())
+        profile.wall = (last - first) if first is not None else 0.0
+        return profile
+
+    @property
+    def facts_wall(self) -> float:
+        """Time spent gathering facts, summed over the plays"""
+        return sum(t.wall for t in self.tasks if t.is_facts)
+
+    def slowest_tasks(self, top: int) -> List[TaskTiming]:
+        return sorted(self.tasks, key=lambda t: t.wall, reverse=True)[:top]
+
+    def roles(self) -> List[Tuple[str, float, int]]:
+        """(role, wall seconds, tasks) slowest first, tasks of the playbooks themselves as '-'"""
+        totals: Dict[str, List] = {}
+        for t in self.tasks:
+            entry = totals.setdefault(t.role or "-", [0.0, 0])
+            entry[0] += t.wall
+            entry[1] += 1
+        return sorted(((role, wall, n) for role, (wall, n) in totals.items()), key=lambda r: r[1], reverse=True)
+
+    def task_walls(self) -> Dict[Tuple[str, str, str], float]:
+        """Wall seconds per (play, role, task), repeated tasks (handlers, includes) summed"""
+        walls: Dict[Tuple[str, str, str], float] = {}
+        for t in self.tasks:
+            walls[t.key] = walls.get(t.key, 0.0) + t.wall
+        return walls
+
+
+def diff_runs(before: RunProfile, after: RunProfile) -> List[Tuple[Tuple[str, str, str], float, float]]:
+    """(task key, seconds before, seconds after) of the tasks of both runs, biggest change first"""
+    a, b = before.task_walls(), after.task_walls()
+    rows = [(key, a.get(key, 0.0), b.get(key, 0.0)) for key in set(a) | set(b)]
+    return sorted(rows, key=lambda r: abs(r[2] - r[1]), reverse=True)
+
+
+def prune_runs(cluster_dir: Path, keep: int) -> None:
+    """Drop all but the newest keep runs of a cluster"""
+    for old in list_runs(cluster_dir)[:-keep] if keep > 0 else []:
+        try:
+            os.unlink(old)
+        except OSError:
+            pass
@@ -1,12 +1,255 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from email.message import Message
 from common.logger import setup_logger
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
+from .archive import ImageArchive
+from .cache import CacheManager
 from .docker import DockerManager
+from .layerstore import LayerStore
 from common.constants import KubeConstant
-from common.exceptions import CommandExecutionError
+from common.exceptions import RegistryError
+from common.utils import rmrf, transfer_report
 
 logger = setup_logger(__name__)
 
+MEDIA_OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+MEDIA_OCI_CONFIG = "application/vnd.oci.image.config.v1+json"
+MEDIA_OCI_LAYER = "application/vnd.oci.image.layer.v1.tar"
+LAYER_COMPRESSION_MAGIC = {
+    b"\x1f\x8b": "+gzip",
+    b"\x28\xb5\x2f\xfd": "+zstd",
+}
+
+
+@dataclass
+class ImageTransfer:
+    """Result of moving one image into the local registry"""
+    image: str
+    local_image: str
+    size: int = 0
+    pull_seconds: float = 0.0
+    push_seconds: float = 0.0
+    pull_attempts: int = 0
+    push_attempts: int = 0
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def latency(self) -> float:
+        return self.pull_seconds + self.push_seconds
+
+
+@dataclass
+class BlobDescriptor:
+    """A config or layer blob of a saved image"""
+    member: str
+    digest: str
+    size: int
+    media_type: str
+
+    def to_json(self) -> Dict:
+        return {"mediaType": self.media_type, "digest": self.digest, "size": self.size}
+
+
+@dataclass
+class PushStats:
+    """Counters of a daemonless push"""
+    uploaded: int = 0
+    mounted: int = 0
+    skipped: int = 0
+    bytes_uploaded: int = 0
+    bytes_skipped: int = 0
+    manifests: int = 0
+
+
+class RegistryClient:
+    """
+    Minimal Registry HTTP API v2 client pushing images straight from saved tarballs
+
+    Each blob is HEAD-checked and skipped if the repository has it already. A blob
+    pushed once to another repository is cross-mounted instead of re-uploaded, and
+    the blobs of an image are uploaded concurrently. No docker daemon is involved.
+    """
+
+    def __init__(self, registry: str, concurrency: int = 4, timeout: int = 300):
+        self.base_url = f"http://{registry}"
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self.stats = PushStats()
+        self._lock = threading.Lock()
+        # digest -> upload in flight or done, so a layer shared by several images goes up once
+        self._blobs: Dict[str, Future] = {}
+        # digest -> a repository known to hold the blob, source of cross-repository mounts
+        self._blob_repos: Dict[str, str] = {}
+        # the local registry is never reached through a proxy
+        self._opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    def ping(self) -> None:
+        """Check the registry speaks API v2"""
+        self._request("GET", "/v2/", ok=(200, 401))
+
+    def push_archive(self, source: Path | str | ImageArchive) -> List[str]:
+        """Push every tagged image of a saved tarball (or of an image of the layer store), return pushed references"""
+        pushed = []
+        archive = source if isinstance(source, ImageArchive) else ImageArchive(source)
+        path = archive.path
+        with archive, \
+                ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="blob") as pool:
+            for entry in archive.manifest:
+                refs = entry.get("RepoTags") or []
+                if not refs:
+                    logger.warning(f"Skip untagged image in {path}", extra={"to_stdout": True})
+                    continue
+
+                members = [entry["Config"], *entry["Layers"]]
+                config, *layers = pool.map(lambda member: self._describe(archive, member), members)
+                config.media_type = MEDIA_OCI_CONFIG
+
+                for ref in refs:
+                    repo, tag = self._split_ref(ref)
+                    for future in [pool.submit(self._ensure_blob, archive, repo, blob) for blob in [config, *layers]]:
+                        future.result()
+                    self._put_manifest(repo, tag, config, layers)
+                    pushed.append(f"{repo}:{tag}")
+                    logger.info(f"Pushed {ref} to {self.base_url}/{repo}:{tag}", extra={"to_stdout": True})
+        return pushed
+
+    @staticmethod
+    def _split_ref(ref: str) -> Tuple[str, str]:
+        """Repository and tag of a reference, the registry host it may start with dropped"""
+        host, slash, path = ref.partition("/")
+        if slash and ("." in host or ":" in host or host == "localhost"):
+            ref = path
+        repo, _, tag = ref.rpartition(":")
+        if not repo or "/" in tag:
+            return ref, "latest"
+        return repo, tag
+
+    def _describe(self, archive: ImageArchive, member: str) -> BlobDescriptor:
+        """Digest, size and media type of a blob, hashing it only when its name is not its digest"""
+        size = archive.member_size(member)
+        with archive.open_independent(member) as f:
+            head = f.read(4)
+            known = re.fullmatch(r"blobs/sha256/([0-9a-f]{64})", member)
+            if known:
+                digest = f"sha256:{known.group(1)}"
+            else:
+                sha = hashlib.sha256(head)
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+                digest = f"sha256:{sha.hexdigest()}"
+
+        suffix = next((s for magic, s in LAYER_COMPRESSION_MAGIC.items() if head.startswith(magic)), "")
+        return BlobDescriptor(member=member, digest=digest, size=size, media_type=MEDIA_OCI_LAYER + suffix)
+
+    def _ensure_blob(self, archive: ImageArchive, repo: str, blob: BlobDescriptor) -> None:
+        """Make sure repo holds blob: skip, mount or upload"""
+        with self._lock:
+            future = self._blobs.get(blob.digest)
+            owner = future is None
+            if owner:
+                future = self._blobs[blob.digest] = Future()
+
+        if not owner:
+            # someone else pushes it, wait then mount into this repository
+            future.result()
+            source = self._blob_repos[blob.digest]
+            if source == repo:
+                with self._lock:
+                    self.stats.skipped += 1
+                    self.stats.bytes_skipped += blob.size
+            elif not self._blob_exists(repo, blob):
+                self._mount_or_upload(archive, repo, blob, source)
+            return
+
+        try:
+            if not self._blob_exists(repo, blob):
+                self._mount_or_upload(archive, repo, blob, None)
+            self._blob_repos[blob.digest] = repo
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+
+    def _blob_exists(self, repo: str, blob: BlobDescriptor) -> bool:
+        status, _ = self._request("HEAD", f"/v2/{repo}/blobs/{blob.digest}", ok=(200, 404))
+        if status == 200:
+            with self._lock:
+                self.stats.skipped += 1
+                self.stats.bytes_skipped += blob.size
+            return True
+        return False
+
+    def _mount_or_upload(self, archive: ImageArchive, repo: str, blob: BlobDescriptor,
+                         source: Optional[str]) -> None:
+        """Cross-mount blob from source if given, fall back to a monolithic upload"""
+        query = {"mount": blob.digest, "from": source} if source else {}
+        status, headers = self._request("POST", f"/v2/{repo}/blobs/uploads/?{urllib.parse.urlencode(query)}",
+                                        ok=(201, 202))
+        if status == 201:
+            with self._lock:
+                self.stats.mounted += 1
+            return
+
+        location = urllib.parse.urljoin(self.base_url, headers["Location"])
+        separator = "&" if "?" in location else "?"
+        with archive.open_independent(blob.member) as body:
+            self._request("PUT", f"{location}{separator}digest={urllib.parse.quote(blob.digest)}", body=body,
+                          headers={"Content-Type": "application/octet-stream", "Content-Length": str(blob.size)},
+                          ok=(201,))
+        with self._lock:
+            self.stats.uploaded += 1
+            self.stats.bytes_uploaded += blob.size
+
+    def _put_manifest(self, repo: str, tag: str, config: BlobDescriptor, layers: List[BlobDescriptor]) -> None:
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": MEDIA_OCI_MANIFEST,
+            "config": config.to_json(),
+            "layers": [layer.to_json() for layer in layers],
+        }
+        self._request("PUT", f"/v2/{repo}/manifests/{tag}", body=json.dumps(manifest).encode(),
+                      headers={"Content-Type": MEDIA_OCI_MANIFEST}, ok=(201,))
+        with self._lock:
+            self.stats.manifests += 1
+
+    def _request(self, method: str, url: str, body=None, headers: Optional[Dict[str, str]] = None,
+                 ok: Tuple[int, ...] = (200,)) -> Tuple[int, Message]:
+        """Send a request, return its status and headers if the status is in ok, raise RegistryError otherwise"""
+        if url.startswith("/"):
+            url = self.base_url + url
+        request = urllib.request.Request(url, data=body, method=method, headers=headers or {})
+        try:
+            response = self._opener.open(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            with e:
+                body = e.read()
+            if e.code in ok:
+                return e.code, e.headers
+            raise RegistryError(f"{method} {url} failed with {e.code}: {body[:200].decode(errors='replace')}")
+        except (urllib.error.URLError, OSError) as e:
+            raise RegistryError(f"{method} {url} failed: {e}")
+
+        with response:
+            response.read()
+        if response.status not in ok:
+            raise RegistryError(f"{method} {url} returned unexpected status {response.status}")
+        return response.status, response.headers
+
 
 class RegistryManager:
     def __init__(self):
@@ -14,6 +257,8 @@ class RegistryManager:
         self.kube_constant = KubeConstant()
         self.image_dir = Path(self.kube_constant.IMAGE_DIR)
         self.base_data_path = Path(self.kube_constant.BASE_DATA_PATH)
+        self.store = LayerStore(self.image_dir)
+        self.cache = CacheManager(self.image_dir)
 
     def start_local_registry(self, version: Optional[str] = None) -> None:
         """Start local Docker registry"""
@@ -23,14 +268,20 @@ class RegistryManager:
             logger.warning("Local registry is already running")
             return
 
-        # Load registry image if not exists
-        registry_tar = self.image_dir / f"registry-{version}.tar"
-        if not registry_tar.exists():
+        # Load registry image from the layer store if not exists
+        name = f"registry-{version}"
+        legacy_tar = self.image_dir / f"{name}.tar"
+        if not self.store.exists(name) and legacy_tar.exists():
+            self.store.ingest_file(name, legacy_tar, f"registry:{version}")
+            rmrf(legacy_tar)
+
+        self.cache.record(name, hit=self.store.exists(name))
+        if not self.store.exists(name):
             logger.info(f"Downloading registry:{version} image")
             self.docker.pull_image(f"registry:{version}")
-            self.docker.save_image(f"registry:{version}", str(registry_tar))
+            self.store.ingest(name, self.docker.save_stream(f"registry:{version}"), f"registry:{version}")
         else:
-            self.docker.load_image(str(registry_tar))
+            self.docker.load_stream(self.store.stream(name), f"registry:{version}")
 
         # Create registry directory
         registry_data = self.base_data_path / "registry"
@@ -53,27 +304,130 @@ class RegistryManager:
             with hosts_file.open("a") as f:
                 f.write("127.0.0.1  registry.talkschool.cn\n")
 
-    def upload_to_registry(self, images: List[str]) -> None:
-        """Upload images to local registry"""
+    def upload_to_registry(self, images: List[str], concurrency: Optional[int] = None,
+                           retries: Optional[int] = None) -> List[ImageTransfer]:
+        """
+        Upload images to local registry through a pull -> tag/push pipeline
+
+        Pulls and pushes run in two bounded pools, so an image is pushed as soon as its pull
+        is done while the next pulls are still going. Each pull and push is retried with
+        exponential backoff; failures are collected in the returned results, not skipped.
+        """
+        concurrency = max(self.kube_constant.REGISTRY_CONCURRENCY if concurrency is None else concurrency, 1)
+        retries = max(self.kube_constant.REGISTRY_RETRIES if retries is None else retries, 1)
 
         if not self.docker.check_container_exists("local_registry"):
             self.start_local_registry()
 
-        for image in images:
-            # Pull image if not exists locally
+        transfers = [ImageTransfer(image=image, local_image=self._local_image(image)) for image in images]
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="pull") as pull_pool, \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="push") as push_pool:
+            pushes: List[Future] = []
+
+            def pull_then_push(transfer: ImageTransfer) -> None:
+                self._pull_one(transfer, retries)
+                if transfer.ok:
+                    pushes.append(push_pool.submit(self._push_one, transfer, retries))
+
+            for transfer in transfers:
+                pull_pool.submit(pull_then_push, transfer)
+
+            # every push has been queued once the pull pool drained
+            pull_pool.shutdown(wait=True)
+            for future in pushes:
+                future.result()
+
+        self._log_summary(transfers, time.monotonic() - start)
+        return transfers
+
+    def _local_image(self, image: str) -> str:
+        """Map an image to its name in the local registry"""
+        parts = image.split(':')
+        repo = parts[0]
+        tag = parts[1] if len(parts) > 1 else "latest"
+        return f"{self.kube_constant.LOCAL_REGISTRY}/{repo}:{tag}"
+
+    def _pull_one(self, transfer: ImageTransfer, retries: int) -> None:
+        """Pull stage: pull image if not exists locally"""
+        start = time.monotonic()
+        try:
+            if not self.docker.image_exists(transfer.image):
+                self._with_retry(lambda: self.docker.pull_image(transfer.image), transfer, "pull", retries)
+            transfer.size = self.docker.image_size(transfer.image)
+        except Exception as e:
+            transfer.error = f"pull failed: {e}"
+        finally:
+            transfer.pull_seconds = time.monotonic() - start
+
+    def _push_one(self, transfer: ImageTransfer, retries: int) -> None:
+        """Push stage: tag and push to local registry"""
+        start = time.monotonic()
+        try:
+            self.docker.tag_image(transfer.image, transfer.local_image)
+            self._with_retry(lambda: self.docker.push_image(transfer.local_image), transfer, "push", retries)
+            logger.info(f"Uploaded {transfer.image} to local registry successfully!", extra={"to_stdout": True})
+        except Exception as e:
+            transfer.error = f"push failed: {e}"
+        finally:
+            transfer.push_seconds = time.monotonic() - start
+
+    def _with_retry(self, action: Callable[[], None], transfer: ImageTransfer, stage: str, retries: int) -> None:
+        """Run action, retrying with exponential backoff and jitter, re-raise the last error"""
+        backoff = self.kube_constant.REGISTRY_RETRY_BACKOFF
+        for attempt in range(1, retries + 1):
+            if stage == "pull":
+                transfer.pull_attempts += 1
+            else:
+                transfer.push_attempts += 1
             try:
-                if not self.docker.image_exists(image):
-                    self.docker.pull_image(image)
-            except CommandExecutionError:
-                logger.warning(f"Failed to pull image {image}, skipping")
-                continue
-
-            # Tag and push to local registry
-            parts = image.split(':')
-            repo = parts[0]
-            tag = parts[1] if len(parts) > 1 else "latest"
-            local_image = f"registry.talkschool.cn:5000/{repo}:{tag}"
-
-            self.docker.tag_image(image, local_image)
-            self.docker.push_image(local_image)
-            logger.info(f"Uploaded {image} to local registry successfully!", extra={"to_stdout": True})
+                action()
+                return
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                delay = backoff * 2 ** (attempt - 1) + random.uniform(0, backoff)
+                logger.warning(f"Failed to {stage} {transfer.image} (attempt {attempt}/{retries}): {e}, "
+                               f"retrying in {delay:.1f}s", extra={"to_stdout": True})
+                time.sleep(delay)
+
+    @staticmethod
+    def _log_summary(transfers: List[ImageTransfer], seconds: float) -> None:
+        """Print bytes moved, per-image latency and failures"""
+        moved = sum(t.size for t in transfers if t.ok)
+        failed = [t for t in transfers if not t.ok]
+
+        logger.info(f"{'IMAGE':<70} {'SIZE(MB)':>9} {'PULL(s)':>8} {'PUSH(s)':>8} {'PULLS':>5} {'PUSHES':>6}  RESULT",
+                    extra={"to_stdout": True})
+        for t in transfers:
+            logger.info(f"{t.image:<70} {t.size / 1024 ** 2:>9.1f} {t.pull_seconds:>8.1f} {t.push_seconds:>8.1f} "
+                        f"{t.pull_attempts:>5} {t.push_attempts:>6}  {'ok' if t.ok else t.error}",
+                        extra={"to_stdout": True})
+        logger.info(f"{len(transfers) - len(failed)}/{len(transfers)} images uploaded, "
+                    f"{moved / 1024 ** 2:.1f} MB moved in {seconds:.1f}s", extra={"to_stdout": True})
+
+    def push_archives(self, archives: List[str], concurrency: Optional[int] = None) -> PushStats:
+        """
+        Push saved image tarballs to the local registry through the registry API, without docker
+
+        archives are tarball paths or names of images in the layer store (see `download --du`)
+        """
+        client = RegistryClient(self.kube_constant.LOCAL_REGISTRY,
+                                concurrency or self.kube_constant.REGISTRY_CONCURRENCY)
+        client.ping()
+
+        start = time.monotonic()
+        for archive in archives:
+            if not Path(archive).exists() and self.store.exists(archive):
+                client.push_archive(self.store.open_image(archive))
+            else:
+                client.push_archive(archive)
+
+        stats = client.stats
+        logger.info(f"{stats.manifests} manifests pushed, blobs: {stats.uploaded} uploaded, "
+                    f"{stats.mounted} mounted, {stats.skipped} already present "
+                    f"({stats.bytes_skipped / 1024 ** 2:.1f} MB not re-sent)", extra={"to_stdout": True})
+        logger.info(transfer_report("Uploaded", self.kube_constant.LOCAL_REGISTRY, stats.bytes_uploaded,
+                                    time.monotonic() - start), extra={"to_stdout": True})
+        return stats
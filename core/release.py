@@ -0,0 +1,197 @@
+"""
+Side-by-side bundle versions switched by an atomic symlink flip
+"""
+import os
+import re
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from common.exceptions import DownloadError
+from common.logger import setup_logger
+from common.utils import rmrf
+
+logger = setup_logger(__name__)
+
+
+class ReleaseDir:
+    """
+    Versions of a bundle kept under <root>/<bundle>/<version>, the active one reached through a symlink
+
+    Versions are extracted into a staging dir next to them (same filesystem), renamed into
+    place once complete, and activated by atomically replacing the symlink. Switching to an
+    installed version or rolling back is therefore a rename, whatever the size of the bundle.
+    """
+
+    def __init__(self, root: Path, bundle: str, active: Path):
+        self.bundle = bundle
+        self.root = root / bundle
+        self.active = active
+        self.previous_link = self.root / "previous"
+
+    def path(self, version: str) -> Path:
+        return self.root / version
+
+    def versions(self) -> List[str]:
+        if not self.root.exists():
+            return []
+        return sorted(p.name for p in self.root.iterdir()
+                      if p.is_dir() and not p.is_symlink() and not p.name.startswith("."))
+
+    def current(self) -> Optional[str]:
+        """Active version, None when the active path is missing or not managed here"""
+        if not self.active.is_symlink():
+            return None
+        target = Path(os.readlink(self.active))
+        return target.name if target.parent == self.root else None
+
+    def staging(self, version: str, resume: bool = False) -> Path:
+        """
+        Staging dir for version, on the same filesystem as the releases
+
+        Empty unless resume, which reuses what an interrupted run left there.
+        """
+        staging = self.root / (f".staging-{version}" if resume else f".staging-{version}-{os.getpid()}")
+        if not resume:
+            clean_stale(self.root)
+            rmrf(staging)
+        staging.mkdir(parents=True, exist_ok=True)
+        return staging
+
+    def commit(self, staging: Path, version: str) -> Path:
+        """Move a complete staging dir into place as version"""
+        release = self.path(version)
+        if release.exists():
+            # a broken copy of the same version, never the active one
+            discarded = self.root / f".discard-{version}-{time.time_ns()}"
+            os.rename(release, discarded)
+            rmrf(discarded)
+        os.rename(staging, release)
+        return release
+
+    def activate(self, version: str) -> None:
+        """Point the active path at version with a single atomic rename"""
+        release = self.path(version)
+        if not release.is_dir():
+            raise DownloadError(f"{self.bundle} {version} is not installed")
+
+        current = self.current()
+        if current == version:
+            return
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        if self.active.exists() and not self.active.is_symlink():
+            # tree installed before releases existed, keep it as a release to roll back to
+            current = f"legacy-{time.strftime('%Y%m%d%H%M%S')}"
+            os.rename(self.active, self.path(current))
+            logger.info(f"Moved {self.active} to {self.path(current)}", extra={"to_stdout": True})
+
+        self._flip(self.active, release)
+        if current:
+            self._flip(self.previous_link, self.path(current))
+        logger.info(f"{self.bundle} {current or '-'} -> {version}", extra={"to_stdout": True})
+
+    def rollback(self) -> str:
+        """Activate the version that was active before the last switch, return it"""
+        if not self.previous_link.is_symlink():
+            raise DownloadError(f"No previous {self.bundle} version to roll back to")
+        previous = Path(os.readlink(self.previous_link)).name
+        self.activate(previous)
+        return previous
+
+    @staticmethod
+    def _flip(link: Path, target: Path) -> None:
+        tmp = link.with_name(f".{link.name}.{os.getpid()}.tmp")
+        rmrf(tmp)
+        os.symlink(target, tmp)
+        os.replace(tmp, link)
+
+
+def stage_dir(destination: Path, name: str, resume: bool = False) -> Path:
+    """
+    Staging dir inside destination, so that moving out of it is a rename
+
+    Empty unless resume, which reuses what an interrupted run left there.
+    """
+    staging = destination / (f".staging-{name}" if resume else f".staging-{name}-{os.getpid()}")
+    if not resume:
+        clean_stale(destination)
+        rmrf(staging)
+    staging.mkdir(parents=True, exist_ok=True)
+    return staging
+
+
+def clean_stale(directory: Path) -> None:
+    """Remove the staging dirs (and the .old trash of swap_into) of kubeauto processes that are gone"""
+    if not directory.is_dir():
+        return
+    for path in directory.iterdir():
+        match = re.fullmatch(r"\.staging-.+-(\d+)(\.old)?", path.name)
+        if not match or int(match.group(1)) == os.getpid():
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue
+        if match.group(2) and path.is_dir():
+            # items an interrupted swap_into moved aside and never replaced go back first
+            for old in path.iterdir():
+                if not (directory / old.name).is_symlink() and not (directory / old.name).exists():
+                    os.rename(old, directory / old.name)
+        logger.debug(f"Removing {path} left by an interrupted install")
+        rmrf(path)
+
+
+def swap_into(staging: Path, destination: Path, last: Optional[str] = None, keep: Iterable[str] = ()) -> None:
+    """
+    Replace the top-level items of destination by those of staging, one rename each
+
+    The item named last (the manifest) goes last, an interrupted swap is then caught by the next verification.
+    A rename failing halfway puts the new items back into staging and the old ones back into
+    destination before the error is raised. Items named in keep are never replaced, whatever staging holds.
+    """
+    keep = set(keep)
+    trash = destination / f"{staging.name}.old"
+    rmrf(trash)
+    trash.mkdir()
+    items = sorted((p for p in staging.iterdir() if p.name not in keep), key=lambda p: p.name == last)
+    placed = []
+    try:
+        for item in items:
+            current = destination / item.name
+            if current.is_symlink() or current.exists():
+                os.rename(current, trash / item.name)
+            os.rename(item, current)
+            placed.append(item.name)
+    except BaseException:
+        _restore(staging, destination, trash, placed)
+        raise
+    rmrf(trash)
+
+
+def _restore(staging: Path, destination: Path, trash: Path, placed: List[str]) -> None:
+    """Undo the renames of an interrupted swap_into, trash is kept if anything could not be moved back"""
+    try:
+        for name in reversed(placed):
+            os.rename(destination / name, staging / name)
+        for old in trash.iterdir():
+            os.rename(old, destination / old.name)
+        trash.rmdir()
+    except OSError as e:
+        logger.error(f"Failed to restore {destination} after an interrupted install, "
+                     f"the items it replaced are kept in {trash}: {e}")
+
+
+def link_binaries(source: Path, sys_bin_dir: Path) -> None:
+    """Recurse source to find executable binary files and make symlinks to them in sys_bin_dir"""
+    try:
+        for item in source.rglob('*'):
+            if item.is_file() and os.access(item, os.X_OK):
+                target_link = sys_bin_dir / item.name
+                rmrf(target_link)
+                target_link.symlink_to(item)
+    except Exception as e:
+        raise DownloadError(f"Failed to link binaries of {source}: {e}")
@@ -0,0 +1,90 @@
+"""
+Stages of `setup all`: one playbook run each, ordered by the dependencies they declare
+"""
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from .inventory import Inventory
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A playbook run of `setup all`
+
+    groups are the inventory groups of its plays (none: localhost), limit narrows them to the
+    hosts of a group (or those out of it with !group), deps are the stages that must be done
+    first and step is the setup step the stage is part of.
+    """
+    name: str
+    playbook: str
+    step: str
+    deps: Tuple[str, ...] = ()
+    groups: Tuple[str, ...] = ()
+    limit: Optional[str] = None
+    optional: bool = False  # only installed when its group has hosts
+
+    def hosts(self, inventory: Inventory) -> List[str]:
+        """Hosts the stage runs on, localhost for the stages on the deploy machine"""
+        if not self.groups:
+            return ["localhost"]
+        hosts = list(dict.fromkeys(host for group in self.groups for host in inventory.hosts(group)))
+        if self.limit:
+            group = set(inventory.hosts(self.limit.lstrip("!")))
+            hosts = [host for host in hosts if (host in group) != self.limit.startswith("!")]
+        return hosts
+
+    def args(self) -> List[str]:
+        return ["--limit", self.limit] if self.limit else []
+
+
+def playbook_files(playbook: Path) -> List[Path]:
+    """The playbook and those it imports, directly or not"""
+    files = [playbook]
+    for path in files:
+        text = path.read_text() if path.exists() else ""
+        files += [path.parent / imported for imported in re.findall(r"import_playbook:\s*(\S+)", text)
+                  if path.parent / imported not in files]
+    return [path for path in files if path.exists()]
+
+
+def playbook_roles(playbook: Path, roles_dir: Path) -> List[str]:
+    """Roles the plays of a playbook (and of those it imports) name, in order"""
+    names = []
+    for path in playbook_files(playbook):
+        roles_indent = None
+        for line in path.read_text().splitlines():
+            indent = len(line) - len(line.lstrip())
+            stripped = line.strip()
+            if re.match(r"-?\s*roles:\s*$", stripped):
+                roles_indent = indent + (2 if stripped.startswith("-") else 0)
+                continue
+            # the items of 'roles:' may sit at its own indentation, as they do in kubeauto playbooks
+            if roles_indent is not None and stripped and not stripped.startswith("#") and (
+                    indent < roles_indent or (indent == roles_indent and not stripped.startswith("-"))):
+                roles_indent = None
+            if roles_indent is not None:
+                names += re.findall(r"^-\s*(?:\{\s*)?(?:role:\s*)?([\w.-]+)\s*(?:[,}]|$)", stripped)
+    return [name for name in dict.fromkeys(names) if (roles_dir / name).is_dir()]
+
+
+NODES = ("kube_master", "kube_node")
+
+# the runtime goes on the etcd members once etcd is there, on the other nodes at the same time as etcd;
+# ex_lb and harbor hosts only need the base stage (and harbor the /etc/hosts of prepare)
+SETUP_STAGES = (
+    Stage("base", "stages/base.yml", "01", groups=NODES + ("etcd", "ex_lb", "chrony")),
+    Stage("deploy", "stages/deploy.yml", "01"),
+    Stage("prepare", "stages/prepare.yml", "01", ("base", "deploy"), NODES + ("etcd",)),
+    Stage("etcd", "02.etcd.yml", "02", ("prepare",), ("etcd",)),
+    Stage("runtime", "03.runtime.yml", "03", ("prepare",), NODES, limit="!etcd"),
+    Stage("runtime-etcd", "03.runtime.yml", "03", ("etcd",), NODES, limit="etcd"),
+    Stage("kube-master", "04.kube-master.yml", "04", ("etcd", "runtime", "runtime-etcd"), ("kube_master",)),
+    Stage("kube-node", "05.kube-node.yml", "05", ("kube-master",), ("kube_node",)),
+    Stage("network", "06.network.yml", "06", ("kube-node",), NODES),
+    Stage("cluster-addon", "07.cluster-addon.yml", "07", ("network",)),
+    Stage("ex-lb", "10.ex-lb.yml", "10", ("base",), ("ex_lb",), optional=True),
+    Stage("harbor", "11.harbor.yml", "11", ("prepare",), ("harbor",), optional=True),
+)
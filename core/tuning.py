@@ -0,0 +1,172 @@
+"""
+Ansible execution profile of a cluster, sized at run time from its inventory and the controller
+"""
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from common.logger import setup_logger
+from .inventory import Inventory
+from .stages import playbook_files, playbook_roles
+
+logger = setup_logger(__name__)
+
+PROFILES = ("safe", "fast")
+# ansible.cfg keeps the ssh sockets there too, the warm-up and ansible must agree on the path
+CONTROL_PATH_DIR = "/tmp"
+CONTROL_PATH = "ansible-ssh-%h-%p-%r"
+# rough RSS of an ansible worker with a task in flight
+FORK_MEMORY_MB = 120
+# workers per controller cpu: they mostly wait on ssh, fast accepts a busier controller
+FORKS_PER_CPU = {"safe": 4, "fast": 10}
+CONTROL_PERSIST = {"safe": "60s", "fast": "30m"}
+WARM_UP_TIMEOUT = 10
+
+
+@dataclass
+class AnsibleProfile:
+    """Effective settings of a run, passed to ansible-playbook as ANSIBLE_* variables"""
+    name: str
+    forks: int
+    strategy: str
+    gather_subset: str
+    control_persist: str
+    hosts: int
+    cpus: int
+    memory_mb: int
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def ssh_args(self) -> str:
+        return f"-C -o ControlMaster=auto -o ControlPersist={self.control_persist} -o ServerAliveInterval=30"
+
+    def env(self) -> Dict[str, str]:
+        return {
+            "ANSIBLE_FORKS": str(self.forks),
+            "ANSIBLE_STRATEGY": self.strategy,
+            "ANSIBLE_GATHER_SUBSET": self.gather_subset,
+            "ANSIBLE_SSH_ARGS": self.ssh_args,
+            "ANSIBLE_SSH_CONTROL_PATH_DIR": CONTROL_PATH_DIR,
+            # %(directory)s and %% are expanded by ansible before ssh sees the path
+            "ANSIBLE_SSH_CONTROL_PATH": "%(directory)s/" + CONTROL_PATH.replace("%", "%%"),
+            "ANSIBLE_PIPELINING": "True",
+        }
+
+    def describe(self) -> str:
+        text = (f"ansible profile {self.name}: forks={self.forks} ({self.hosts} hosts, {self.cpus} cpus, "
+                f"{self.memory_mb} MB available), strategy={self.strategy}, gather_subset={self.gather_subset}, "
+                f"ssh ControlPersist={self.control_persist}")
+        return text + "".join(f"\n  {note}" for note in self.notes)
+
+
+def controller_capacity() -> Tuple[int, int]:
+    """(cpus, MB of available memory) of the machine running ansible"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        memory_mb = int(meminfo["MemAvailable"].split()[0]) // 1024
+    except (OSError, KeyError, ValueError):
+        memory_mb = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 1024 ** 2
+    return cpus, memory_mb
+
+
+def inventory_hosts(inventory: Inventory) -> List[str]:
+    hosts = {}
+    for section in inventory.sections():
+        if ":" not in section:
+            hosts.update(dict.fromkeys(inventory.hosts(section)))
+    return list(hosts)
+
+
+def run_once_users(playbook: Path, roles_dir: Path) -> List[str]:
+    """
+    The playbook and the roles it names that use run_once, which the free strategy ignores
+    (the task then runs on every host)
+    """
+    users = [path.name for path in playbook_files(playbook) if re.search(r"^\s*run_once:", path.read_text(), re.M)]
+    for name in playbook_roles(playbook, roles_dir):
+        tasks_dir = roles_dir / name / "tasks"
+        if tasks_dir.is_dir() and any(re.search(r"^\s*run_once:", p.read_text(), re.M)
+                                      for p in tasks_dir.rglob("*.yml")):
+            users.append(name)
+    return users
+
+
+def tune(profile: str, inventory: Inventory, config: Dict[str, str], playbook: Path, roles_dir: Path,
+         fork_cap: int) -> AnsibleProfile:
+    """Settings of profile for running playbook against the cluster of inventory and config"""
+    if profile not in PROFILES:
+        raise ValueError(f"Invalid ansible profile: {profile}, expected one of {', '.join(PROFILES)}")
+
+    hosts = len(inventory_hosts(inventory))
+    cpus, memory_mb = controller_capacity()
+    forks = max(1, min(hosts or 1, cpus * FORKS_PER_CPU[profile], memory_mb // FORK_MEMORY_MB, fork_cap))
+    notes = []
+
+    strategy = "linear"
+    if profile == "fast":
+        users = run_once_users(playbook, roles_dir)
+        if users:
+            notes.append(f"strategy free not used, run_once in {', '.join(users)}")
+        else:
+            strategy = "free"
+
+    # the roles read distribution/os_family/kernel/env (min) and virtualization_type; only
+    # os-harden needs mounts and processor (hardware), the slowest subset to collect
+    gather_subset = "all"
+    if profile == "fast":
+        gather_subset = "!all,virtual"
+        if str(config.get("OS_HARDEN", "")).lower() in ("true", "yes", "1"):
+            gather_subset += ",hardware"
+
+    return AnsibleProfile(profile, forks, strategy, gather_subset, CONTROL_PERSIST[profile], hosts, cpus,
+                          memory_mb, notes)
+
+
+def warm_up_ssh(inventory: Inventory, profile: AnsibleProfile) -> List[str]:
+    """
+    Open the ssh master connection of every host at the same time, so the first play starts on
+    live sockets instead of ansible connecting forks hosts at a time; returns the hosts that failed
+    """
+    all_vars = inventory.section_vars("all:vars")
+    targets = []
+    for host in inventory_hosts(inventory):
+        host_vars = dict(all_vars)
+        for section in inventory.sections_of(host):
+            host_vars.update(inventory.host_vars(section, host))
+        if host_vars.get("ansible_connection", "ssh") not in ("ssh", "smart"):
+            continue
+
+        # as ansible does: -p and -l only when set, so %p and %r expand the same way
+        cmd = ["ssh", "-o", "ControlMaster=auto", "-o", f"ControlPersist={profile.control_persist}",
+               "-o", f"ControlPath={CONTROL_PATH_DIR}/{CONTROL_PATH}", "-o", "BatchMode=yes",
+               "-o", f"ConnectTimeout={WARM_UP_TIMEOUT}", "-o", "StrictHostKeyChecking=no"]
+        port = host_vars.get("ansible_port") or host_vars.get("ansible_ssh_port")
+        user = host_vars.get("ansible_user") or host_vars.get("ansible_ssh_user")
+        if port:
+            cmd += ["-p", port]
+        if user:
+            cmd += ["-l", user]
+        address = host_vars.get("ansible_host") or host_vars.get("ansible_ssh_host") or host
+        targets.append((host, cmd + [address, "true"]))
+
+    def connect(target: Tuple[str, List[str]]) -> bool:
+        # no pipes: the backgrounded master would hold them open until ControlPersist expires
+        try:
+            return subprocess.run(target[1], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, timeout=WARM_UP_TIMEOUT + 5).returncode == 0
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+
+    if not targets:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(targets), 64)) as executor:
+        connected = list(executor.map(connect, targets))
+    failed = [host for (host, _), ok in zip(targets, connected) if not ok]
+    logger.debug(f"ssh warm-up: {len(targets) - len(failed)} of {len(targets)} hosts connected")
+    return failed
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Event stream of the playbooks run by kubeauto: one JSON object per line, written to the
+# file descriptor kubeauto passes in KUBEAUTO_EVENTS_FD and read by core/playbook.py
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: kubeauto_events
+    type: notification
+    short_description: JSON lines of play, task and host events for kubeauto
+    description:
+      - Writes playbook_start, play_start, task_start, host_start, host_retry, host_end and
+        playbook_end events to the file descriptor named by KUBEAUTO_EVENTS_FD
+      - Does nothing when that variable is not set, the stdout callback is left as it is
+    requirements:
+      - enabled by kubeauto (ANSIBLE_CALLBACKS_ENABLED=kubeauto_events)
+'''
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+MSG_LIMIT = 2000
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'notification'
+    CALLBACK_NAME = 'kubeauto_events'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self._out = None
+        self._play = None
+        self._started = {}
+
+        fd = os.environ.get('KUBEAUTO_EVENTS_FD')
+        if fd:
+            try:
+                self._out = os.fdopen(int(fd), 'w', buffering=1)
+            except (OSError, ValueError) as e:
+                self._display.warning('kubeauto_events: cannot write to fd %s: %s' % (fd, e))
+
+    def _emit(self, event, **fields):
+        if self._out is None:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        try:
+            self._out.write(json.dumps(fields, default=str) + '\n')
+        except (OSError, ValueError):
+            # kubeauto is gone, the playbook goes on without it
+            self._out = None
+
+    def _task_fields(self, task):
+        return {
+            'play': self._play,
+            'task': task.get_name(),
+            'task_id': task._uuid,
+            'role': task._role.get_name() if task._role else None,
+            'action': task.action,
+        }
+
+    def _host_end(self, result, status, **fields):
+        host = result._host.get_name()
+        task = result._task
+        started = self._started.pop((host, task._uuid), None)
+        res = result._result
+        if status in ('failed', 'unreachable'):
+            msg = res.get('msg') or res.get('stderr') or ''
+            fields['msg'] = str(msg)[:MSG_LIMIT]
+        delegated = res.get('_ansible_delegated_vars')
+        if isinstance(delegated, dict) and delegated.get('ansible_host'):
+            fields['delegated_to'] = delegated['ansible_host']
+        fields.update(self._task_fields(task))
+        self._emit('host_end', host=host, status=status, duration=time.time() - started if started else None,
+                   attempts=res.get('attempts'), **fields)
+
+    def v2_playbook_on_start(self, playbook):
+        self._emit('playbook_start', playbook=playbook._file_name)
+
+    def v2_playbook_on_play_start(self, play):
+        self._play = play.get_name()
+        self._emit('play_start', play=self._play, hosts=play.hosts)
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._emit('task_start', handler=False, **self._task_fields(task))
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._emit('task_start', handler=True, **self._task_fields(task))
+
+    def v2_runner_on_start(self, host, task):
+        self._started[(host.get_name(), task._uuid)] = time.time()
+        self._emit('host_start', host=host.get_name(), **self._task_fields(task))
+
+    def v2_runner_retry(self, result):
+        self._emit('host_retry', host=result._host.get_name(), attempts=result._result.get('attempts'),
+                   retries=result._result.get('retries'), **self._task_fields(result._task))
+
+    def v2_runner_on_ok(self, result):
+        self._host_end(result, 'changed' if result._result.get('changed') else 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._host_end(result, 'failed', ignore_errors=ignore_errors)
+
+    def v2_runner_on_unreachable(self, result):
+        self._host_end(result, 'unreachable')
+
+    def v2_runner_on_skipped(self, result):
+        self._host_end(result, 'skipped')
+
+    def v2_playbook_on_stats(self, stats):
+        self._emit('playbook_end', hosts={host: stats.summarize(host) for host in sorted(stats.processed)})
+        if self._out is not None:
+            try:
+                self._out.close()
+            except OSError:
+                pass
+            self._out = None
@@ -0,0 +1,114 @@
+"""
+Export and import of single-file offline bundles
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from common.exceptions import DownloadError
+from core.bundle import BundleManager, INDEX_FOOTER
+
+
+def manager(root: Path) -> BundleManager:
+    bm = BundleManager()
+    bm.base_path = root / "base"
+    bm.image_dir = root / "down"
+    bm.kube_bin_dir = root / "kube-bin"
+    bm.extra_bin_dir = root / "extra-bin"
+    bm.releases_dir = root / ".releases"
+    bm.registry_dir = root / "registry"
+    bm.clusters_dir = root / "base" / "clusters"
+    bm.store.root = bm.image_dir
+    bm.store.blob_dir = bm.image_dir / "blobs" / "sha256"
+    bm.store.manifest_dir = bm.image_dir / "manifests"
+    return bm
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.source = manager(root / "source")
+        self.target = manager(root / "target")
+        self.source.image_dir.mkdir(parents=True)
+        self.files = {
+            "docker-27.1.1.tgz": os.urandom(300 * 1024),
+            "docker-27.1.1.tgz.sha256": b"checksum  docker-27.1.1.tgz\n",
+            "docker-28.0.0.tgz": os.urandom(200 * 1024),
+        }
+        for name, data in self.files.items():
+            (self.source.image_dir / name).write_bytes(data)
+        # an unfinished download and its resume state
+        (self.source.image_dir / "docker-28.1.0.tgz.part").write_bytes(b"half")
+        (self.source.image_dir / "docker-28.1.0.tgz.part.json").write_text("{}")
+        self.bundle = root / "offline.kbundle"
+        self.source.export_bundle(self.bundle, ["docker"])
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def imported(self) -> dict:
+        return {p.name: p.read_bytes() for p in self.target.image_dir.glob("docker-*")}
+
+    def test_unfinished_downloads_are_not_exported(self):
+        index, _ = BundleManager.read_index(self.bundle)
+        self.assertEqual(sorted(e["path"] for e in index["entries"]), sorted(self.files))
+
+    def test_interrupted_import_resumes(self):
+        extract = BundleManager._extract_entry
+        calls = []
+
+        def interrupted(f, entry, target):
+            calls.append(entry.path)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return extract(f, entry, target)
+
+        with mock.patch.object(BundleManager, "_extract_entry", side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.target.import_bundle(self.bundle)
+        first = calls[0]
+
+        calls.clear()
+        with mock.patch.object(BundleManager, "_extract_entry",
+                               side_effect=lambda *args: calls.append(args[1].path) or extract(*args)):
+            self.target.import_bundle(self.bundle)
+        self.assertNotIn(first, calls)
+        self.assertEqual(len(calls), len(self.files) - 1)
+        self.assertEqual(self.imported(), self.files)
+
+    def test_wrong_sha256_is_refused(self):
+        # a compressed entry and one stored as it is
+        for name in ("docker-28.0.0.tgz", "docker-27.1.1.tgz.sha256"):
+            with self.subTest(name=name):
+                shutil.rmtree(self.target.image_dir, ignore_errors=True)
+                index, _ = BundleManager.read_index(self.bundle)
+                entry = next(e for e in index["entries"] if e["path"] == name)
+                data = bytearray(self.bundle.read_bytes())
+                data[entry["offset"] + 10] ^= 0xff
+                damaged = self.bundle.with_name(f"damaged-{name}.kbundle")
+                damaged.write_bytes(data)
+
+                with self.assertRaisesRegex(DownloadError, "Checksum mismatch"):
+                    self.target.import_bundle(damaged, resume=False)
+                self.assertFalse((self.target.image_dir / name).exists())
+                self.assertEqual(list(self.target.image_dir.glob(".*.part")), [])
+
+    def test_corrupt_index(self):
+        raw = self.bundle.read_bytes()
+        length, magic = INDEX_FOOTER.unpack(raw[-INDEX_FOOTER.size:])
+        start = len(raw) - INDEX_FOOTER.size - length
+        index = json.dumps({"entries": "damaged"}).encode()[:length].ljust(length, b"}")
+        self.bundle.write_bytes(raw[:start] + index + raw[-INDEX_FOOTER.size:])
+
+        with self.assertRaisesRegex(DownloadError, "corrupt index"):
+            BundleManager.read_index(self.bundle)
+
+
+if __name__ == "__main__":
+    unittest.main()
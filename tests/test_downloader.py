@@ -0,0 +1,62 @@
+"""
+Adoption of the bundles an older kubeauto installed without a manifest
+"""
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from core.downloader import DownloadManager
+from core.manifest import BundleManifest
+from core.release import ReleaseDir
+
+
+class AdoptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = Path(self.tmp.name)
+        self.dm = DownloadManager()
+        self.dm.kube_bin_dir = root / "kube-bin"
+        self.dm.releases_dir = root / ".releases"
+        self.dm.sys_bin_dir = root / "bin"
+        self.dm.kube_bin_dir.mkdir()
+        (self.dm.kube_bin_dir / "kubelet").write_text("kubelet")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def legacy_k8s_bin(self, version: str) -> ReleaseDir:
+        apiserver = self.dm.kube_bin_dir / "kube-apiserver"
+        apiserver.write_text(f"#!/bin/sh\necho Kubernetes {version}\n")
+        os.chmod(apiserver, 0o755)
+        return ReleaseDir(self.dm.releases_dir, "k8s_bin", self.dm.kube_bin_dir)
+
+    def adopt(self, releases: ReleaseDir, version: str):
+        return self.dm._DownloadManager__adopt("k8s_bin", version, f"brinnatt/kubeauto-k8s-bin:{version}",
+                                               self.dm.kube_bin_dir, releases)
+
+    def test_same_version_is_adopted(self):
+        releases = self.legacy_k8s_bin("v1.33.1")
+        manifest = self.adopt(releases, "v1.33.1")
+
+        self.assertIsNotNone(manifest)
+        self.assertEqual(releases.current(), "v1.33.1")
+        self.assertEqual(BundleManifest.load(releases.path("v1.33.1"), "k8s_bin").components["kubernetes"], "v1.33.1")
+        self.assertEqual(sorted(manifest.files), ["kube-apiserver", "kubelet"])
+
+    def test_other_version_is_left_to_an_install(self):
+        releases = self.legacy_k8s_bin("v1.29.0")
+
+        self.assertIsNone(self.adopt(releases, "v1.33.1"))
+        self.assertFalse(self.dm.kube_bin_dir.is_symlink())
+        self.assertEqual(releases.versions(), [])
+        self.assertIsNone(BundleManifest.load(self.dm.kube_bin_dir, "k8s_bin"))
+
+    def test_failed_probe_is_left_to_an_install(self):
+        releases = ReleaseDir(self.dm.releases_dir, "k8s_bin", self.dm.kube_bin_dir)
+        self.assertIsNone(self.adopt(releases, "v1.33.1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""
+HttpDownloader against local HTTP servers
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from common.exceptions import DownloadError
+from common.fetch import HttpDownloader
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+SHA256 = hashlib.sha256(DATA).hexdigest()
+
+
+def serve(delay: float = 0.0, ranges: bool = True, cut_after: int = 0) -> ThreadingHTTPServer:
+    """Server of DATA, slowed down by delay, without range support, or closing each response after cut_after bytes"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            time.sleep(delay)
+            header = self.headers.get("Range")
+            if header and ranges:
+                first, _, last = header[len("bytes="):].partition("-")
+                first, last = int(first), int(last) if last else len(DATA) - 1
+                body = DATA[first:last + 1]
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {first}-{last}/{len(DATA)}")
+            else:
+                body = DATA
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", '"data"')
+            self.end_headers()
+            self.wfile.write(body[:cut_after] if cut_after else body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_port}/docker.tgz"
+
+
+class HttpDownloaderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = []
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = Path(self.tmp.name) / "docker.tgz"
+        self.downloader = HttpDownloader(segments=4, timeout=5, retries=2)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def server(self, **kwargs) -> str:
+        server = serve(**kwargs)
+        self.servers.append(server)
+        return url(server)
+
+    def test_segments_from_fastest_mirror(self):
+        self.downloader.fetch([self.server(delay=0.5), self.server()], self.dest, SHA256)
+        self.assertEqual(self.dest.read_bytes(), DATA)
+        self.assertEqual(self.dest.with_name("docker.tgz.sha256").read_text().split()[0], SHA256)
+
+    def test_server_without_ranges(self):
+        self.downloader.fetch([self.server(ranges=False)], self.dest, SHA256)
+        self.assertEqual(self.dest.read_bytes(), DATA)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(DownloadError):
+            self.downloader.fetch([self.server()], self.dest, "0" * 64)
+        self.assertFalse(self.dest.exists())
+
+    def test_resume_after_interruption(self):
+        with self.assertRaises(DownloadError):
+            HttpDownloader(segments=4, timeout=5, retries=1).fetch([self.server(cut_after=1024 * 1024)],
+                                                                    self.dest, SHA256)
+        state = json.loads(self.dest.with_name("docker.tgz.part.json").read_text())
+        self.assertTrue(all(segment["done"] == 1024 * 1024 for segment in state["segments"]))
+
+        self.downloader.fetch([self.server()], self.dest, SHA256)
+        self.assertEqual(self.dest.read_bytes(), DATA)
+        self.assertFalse(self.dest.with_name("docker.tgz.part.json").exists())
+
+    def test_truncated_copy_is_downloaded_again(self):
+        self.dest.write_bytes(DATA[:100])
+        self.downloader.fetch([self.server()], self.dest)
+        self.assertEqual(self.dest.read_bytes(), DATA)
+
+    def test_existing_copy_kept_offline(self):
+        self.dest.write_bytes(b"placed by hand")
+        closed = serve()
+        closed.shutdown()
+        closed.server_close()
+        self.downloader.fetch([url(closed)], self.dest)
+        self.assertEqual(self.dest.read_bytes(), b"placed by hand")
+        self.assertEqual(self.dest.with_name("docker.tgz.sha256").read_text().split()[0],
+                         hashlib.sha256(b"placed by hand").hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+RegistryClient pushes of saved tarballs
+
+An in-process Registry HTTP API v2 is used by default. Set KUBEAUTO_TEST_REGISTRY to a registry:2
+container (e.g. `docker run -d -p 5000:5000 registry:2` and KUBEAUTO_TEST_REGISTRY=127.0.0.1:5000)
+to run the same pushes against it.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import tempfile
+import threading
+import unittest
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from core.registry import RegistryClient
+
+
+class FakeRegistry(ThreadingHTTPServer):
+    """Blob HEAD, cross-repository mount, monolithic upload and manifest PUT of the API v2"""
+
+    def __init__(self):
+        self.blobs = set()  # (repository, digest)
+        self.manifests = {}  # (repository, tag) -> manifest
+        super().__init__(("127.0.0.1", 0), self._handler())
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.server_port}"
+
+    def _handler(self):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def reply(self, code: int, headers=None) -> None:
+                self.send_response(code)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self) -> None:
+                self.reply(200 if self.path == "/v2/" else 404)
+
+            def do_HEAD(self) -> None:
+                repo, digest = re.fullmatch(r"/v2/(.+)/blobs/(.+)", self.path).groups()
+                self.reply(200 if (repo, digest) in registry.blobs else 404)
+
+            def do_POST(self) -> None:
+                repo, query = re.fullmatch(r"/v2/(.+)/blobs/uploads/\?(.*)", self.path).groups()
+                query = dict(urllib.parse.parse_qsl(query))
+                if "mount" in query and (query["from"], query["mount"]) in registry.blobs:
+                    registry.blobs.add((repo, query["mount"]))
+                    return self.reply(201)
+                self.reply(202, {"Location": f"/v2/{repo}/blobs/uploads/{uuid.uuid4()}?_state=x"})
+
+            def do_PUT(self) -> None:
+                data = self.rfile.read(int(self.headers["Content-Length"]))
+                upload = re.fullmatch(r"/v2/(.+)/blobs/uploads/[^?]+\?(.*)", self.path)
+                if upload:
+                    digest = dict(urllib.parse.parse_qsl(upload.group(2)))["digest"]
+                    if digest != "sha256:" + hashlib.sha256(data).hexdigest():
+                        return self.reply(400)
+                    registry.blobs.add((upload.group(1), digest))
+                    return self.reply(201)
+                repo, tag = re.fullmatch(r"/v2/(.+)/manifests/(.+)", self.path).groups()
+                manifest = json.loads(data)
+                if any((repo, blob["digest"]) not in registry.blobs for blob in [manifest["config"], *manifest["layers"]]):
+                    return self.reply(400)
+                registry.manifests[(repo, tag)] = manifest
+                self.reply(201)
+
+        return Handler
+
+
+def saved_tarball(path: Path, images) -> None:
+    """`docker save` layout: images are (tags, [layer content]) sharing layers of the same content"""
+    def add(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    def layer(content: bytes) -> bytes:
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            add(tar, "file", content)
+        return buf.getvalue()
+
+    manifest, written = [], set()
+    with tarfile.open(path, "w") as tar:
+        for tags, contents in images:
+            layers = []
+            for content in contents:
+                data = layer(content)
+                name = f"{hashlib.sha256(data).hexdigest()}/layer.tar"
+                if name not in written:
+                    add(tar, name, data)
+                    written.add(name)
+                layers.append(name)
+            config = json.dumps({"tags": tags}).encode()
+            config_name = f"{hashlib.sha256(config).hexdigest()}.json"
+            add(tar, config_name, config)
+            manifest.append({"Config": config_name, "RepoTags": tags, "Layers": layers})
+        add(tar, "manifest.json", json.dumps(manifest).encode())
+
+
+class RegistryClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fake = None
+        self.registry = os.environ.get("KUBEAUTO_TEST_REGISTRY")
+        if not self.registry:
+            self.fake = FakeRegistry()
+            self.registry = self.fake.address
+        # unique repositories, a real registry keeps what earlier runs pushed
+        self.prefix = f"kubeauto-test-{uuid.uuid4().hex[:8]}"
+
+    def tearDown(self):
+        if self.fake:
+            self.fake.shutdown()
+            self.fake.server_close()
+        self.tmp.cleanup()
+
+    def test_split_ref_drops_registry_host(self):
+        cases = {
+            "registry.talkschool.cn:5000/calico/node:v3.28": ("calico/node", "v3.28"),
+            "localhost/pause": ("pause", "latest"),
+            "127.0.0.1:5000/pause:3.10": ("pause", "3.10"),
+            "calico/node:v3.28": ("calico/node", "v3.28"),
+            "pause": ("pause", "latest"),
+        }
+        for ref, expected in cases.items():
+            self.assertEqual(RegistryClient._split_ref(ref), expected, ref)
+
+    def test_upload_mount_then_skip(self):
+        tarball = Path(self.tmp.name) / "images.tar"
+        saved_tarball(tarball, [
+            ([f"{self.registry}/{self.prefix}/base:1"], [b"base layer", b"one"]),
+            ([f"{self.prefix}/app:1"], [b"base layer", b"two"]),
+        ])
+
+        client = RegistryClient(self.registry, concurrency=2)
+        client.ping()
+        pushed = client.push_archive(tarball)
+        self.assertEqual(pushed, [f"{self.prefix}/base:1", f"{self.prefix}/app:1"])
+        # base: config and 2 layers uploaded; app: the shared layer mounted, config and 1 layer uploaded
+        self.assertEqual((client.stats.uploaded, client.stats.mounted, client.stats.skipped), (5, 1, 0))
+        if self.fake:
+            self.assertEqual(set(self.fake.manifests), {(f"{self.prefix}/base", "1"), (f"{self.prefix}/app", "1")})
+
+        again = RegistryClient(self.registry, concurrency=2)
+        again.push_archive(tarball)
+        self.assertEqual((again.stats.uploaded, again.stats.mounted, again.stats.skipped), (0, 0, 6))
+
+
+if __name__ == "__main__":
+    unittest.main()
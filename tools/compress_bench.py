@@ -0,0 +1,96 @@
+"""
+Size and wall time of zstd-compressed image tarballs against plain tar
+
+Writes the given tarball (e.g. the output of `docker save`) plain and as seekable zstd
+at a few levels and thread counts, then reads every copy back in full.
+
+usage: python tools/compress_bench.py IMAGE.tar [--levels 1,3,9] [--workers 1,0] [--tmp DIR]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from common.compress import ZstdWriter, iter_decompressed, zstd_available  # noqa: E402
+from common.utils import iter_file_chunks  # noqa: E402
+
+CHUNK = 4 * 1024 * 1024
+
+
+def timed(action: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def drop(path: Path) -> None:
+    """Ask the kernel to forget the cached pages of path, so reads hit the disk"""
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark zstd image tarballs against plain tar")
+    parser.add_argument("tarball", type=Path)
+    parser.add_argument("--levels", default="1,3,9", help="Comma-separated zstd levels")
+    parser.add_argument("--workers", default="1,0", help="Comma-separated thread counts, 0 means one per CPU")
+    parser.add_argument("--tmp", type=Path, default=None, help="Directory of the copies (default: system temp)")
+    args = parser.parse_args()
+
+    if not zstd_available():
+        print("zstandard is not installed: pip install zstandard")
+        return 1
+
+    size = args.tarball.stat().st_size
+    levels: List[int] = [int(v) for v in args.levels.split(",")]
+    workers: List[int] = [int(v) for v in args.workers.split(",")]
+
+    with tempfile.TemporaryDirectory(dir=args.tmp) as tmp:
+        plain = Path(tmp) / "plain.tar"
+
+        def write_plain() -> None:
+            with open(plain, "wb") as f:
+                for chunk in iter_file_chunks(args.tarball, CHUNK):
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+        write_s = timed(write_plain)
+        drop(plain)
+        read_s = timed(lambda: sum(len(c) for c in iter_file_chunks(plain, CHUNK)))
+
+        print(f"{'FORMAT':<18} {'SIZE(MB)':>10} {'RATIO':>7} {'WRITE(s)':>9} {'MB/s':>8} {'READ(s)':>8} {'MB/s':>8}")
+        print(f"{'tar':<18} {size / 1024 ** 2:>10.1f} {1:>7.2f} {write_s:>9.2f} {size / 1024 ** 2 / write_s:>8.0f} "
+              f"{read_s:>8.2f} {size / 1024 ** 2 / read_s:>8.0f}")
+
+        for level in levels:
+            for threads in workers:
+                target = Path(tmp) / f"l{level}-w{threads}.tar.zst"
+
+                def write_zstd() -> None:
+                    with open(target, "wb") as f, ZstdWriter(f, level, threads) as writer:
+                        for chunk in iter_file_chunks(args.tarball, CHUNK):
+                            writer.write(chunk)
+                    with open(target, "rb") as f:
+                        os.fsync(f.fileno())
+
+                write_s = timed(write_zstd)
+                drop(target)
+                read_s = timed(lambda: sum(len(c) for c in iter_decompressed(target, CHUNK, threads)))
+                compressed = target.stat().st_size
+                label = f"zstd-{level} x{threads or os.cpu_count()}"
+                print(f"{label:<18} {compressed / 1024 ** 2:>10.1f} {size / compressed:>7.2f} {write_s:>9.2f} "
+                      f"{size / 1024 ** 2 / write_s:>8.0f} {read_s:>8.2f} {size / 1024 ** 2 / read_s:>8.0f}")
+                target.unlink()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
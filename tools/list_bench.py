@@ -0,0 +1,126 @@
+"""
+Wall time of `kubeauto list` current-cluster detection over many clusters
+
+Creates N fake clusters (kubectl.kubeconfig each) and a ~/.kube/config copied from the last
+one listed in a temp dir, then times ClusterManager.get_current_cluster with a cold fingerprint
+index, a warm one, and after a few kubeconfigs changed. --legacy also times the former
+`sed /server/d | md5sum` pipeline per cluster.
+
+usage: python tools/list_bench.py [--clusters 1000] [--changed 10] [--legacy]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.controller import ClusterManager  # noqa: E402
+from core.kubeconfig import INDEX_NAME  # noqa: E402
+
+KUBECONFIG = """apiVersion: v1
+clusters:
+- cluster:
+    certificate-authority-data: {ca}
+    server: https://10.0.{n2}.{n1}:6443
+  name: cluster{n}
+contexts:
+- context:
+    cluster: cluster{n}
+    user: admin
+  name: context-cluster{n}
+current-context: context-cluster{n}
+kind: Config
+users:
+- name: admin
+  user:
+    client-certificate-data: {cert}
+    client-key-data: {key}
+"""
+
+
+def make_kubeconfig(n: int) -> str:
+    blob = lambda size: os.urandom(size).hex()  # noqa: E731
+    return KUBECONFIG.format(n=n, n1=n % 256, n2=n // 256, ca=blob(800), cert=blob(800), key=blob(1200))
+
+
+def timed(action: Callable[[], Optional[str]]) -> tuple[float, Optional[str], int]:
+    """return (seconds, result, processes spawned)"""
+    spawned = 0
+    popen = subprocess.Popen
+
+    class CountingPopen(popen):
+        def __init__(self, *args, **kwargs):
+            nonlocal spawned
+            spawned += 1
+            super().__init__(*args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    try:
+        start = time.perf_counter()
+        result = action()
+        return time.perf_counter() - start, result, spawned
+    finally:
+        subprocess.Popen = popen
+
+
+def legacy_current(cm: ClusterManager, current_config: Path) -> Optional[str]:
+    def md5(path: Path) -> str:
+        return subprocess.run(f"sed /server/d {path} | md5sum", shell=True, capture_output=True,
+                              text=True, check=True).stdout.split()[0]
+
+    current_md5 = md5(current_config)
+    for cluster in cm.list_clusters():
+        if md5(cm.clusters_dir / cluster / "kubectl.kubeconfig") == current_md5:
+            return cluster
+    return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark current-cluster detection of `kubeauto list`")
+    parser.add_argument("--clusters", type=int, default=1000, help="Number of fake clusters")
+    parser.add_argument("--changed", type=int, default=10, help="Kubeconfigs rewritten before the last run")
+    parser.add_argument("--legacy", action="store_true", help="Also time one shell pipeline per cluster")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["HOME"] = tmp
+        cm = ClusterManager()
+        cm.clusters_dir = Path(tmp) / "clusters"
+        for n in range(args.clusters):
+            cluster_dir = cm.clusters_dir / f"cluster{n:04d}"
+            cluster_dir.mkdir(parents=True)
+            (cluster_dir / "kubectl.kubeconfig").write_text(make_kubeconfig(n))
+
+        # the worst case for a linear scan: the last cluster in directory order, through the load
+        # balancer rather than the first master
+        current_config = Path(tmp) / ".kube/config"
+        current_config.parent.mkdir()
+        current_config.touch()
+        target = cm.clusters_dir / cm.list_clusters()[-1] / "kubectl.kubeconfig"
+        current_config.write_text(target.read_text().replace("server: https://", "server: https://lb."))
+
+        print(f"{'RUN':<28} {'TIME(ms)':>10} {'SPAWNED':>8}  CURRENT")
+        runs = []
+        if args.legacy:
+            runs.append(("sed | md5sum per cluster", lambda: legacy_current(cm, current_config)))
+        runs.append(("index cold", cm.get_current_cluster))
+        runs.append(("index warm", cm.get_current_cluster))
+        for label, action in runs:
+            seconds, current, spawned = timed(action)
+            print(f"{label:<28} {seconds * 1000:>10.1f} {spawned:>8}  {current}")
+
+        for n in range(args.changed):
+            (cm.clusters_dir / f"cluster{n:04d}" / "kubectl.kubeconfig").write_text(make_kubeconfig(n))
+        seconds, current, spawned = timed(cm.get_current_cluster)
+        print(f"{f'index, {args.changed} changed':<28} {seconds * 1000:>10.1f} {spawned:>8}  {current}")
+        print(f"index: {(cm.clusters_dir / INDEX_NAME).stat().st_size / 1024:.1f} KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
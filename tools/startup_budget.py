@@ -0,0 +1,87 @@
+"""
+Startup budget check for kubeauto subcommands
+
+Runs kubecli.py with `python -X importtime` for every read-only subcommand and
+fails when the import time or the wall time goes over its budget, or when a heavy
+module (docker, paramiko, psutil, distro) is imported by a command not needing it.
+
+usage: python tools/startup_budget.py [--repeat N] [--scale FACTOR]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+ENTRY = ROOT / "kubecli.py"
+
+HEAVY_MODULES = ("docker", "paramiko", "psutil", "distro")
+
+# argv -> (import budget ms, wall budget ms)
+BUDGETS: Dict[Tuple[str, ...], Tuple[float, float]] = {
+    ("--help",): (150, 400),
+    ("list",): (150, 400),
+    ("new", "--help"): (150, 400),
+    ("checkout", "--help"): (150, 400),
+    ("setup", "--help"): (150, 400),
+    ("download", "--help"): (150, 400),
+}
+
+
+def measure(argv: Tuple[str, ...]) -> Tuple[float, float, List[str]]:
+    """return (import ms, wall ms, heavy modules imported)"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", str(ENTRY), *argv],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    import_us = 0
+    heavy = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, module = line[len("import time:"):].split("|", 2)
+        import_us += int(self_us.strip())
+        name = module.strip()
+        if name.split(".")[0] in HEAVY_MODULES and name not in heavy:
+            heavy.append(name)
+
+    return import_us / 1000, wall_ms, heavy
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check kubeauto startup time against per-command budgets")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command, the best one is kept")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply all budgets (slow CI hosts)")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'COMMAND':<22} {'IMPORT(ms)':>12} {'BUDGET':>8} {'WALL(ms)':>10} {'BUDGET':>8}  HEAVY")
+    for argv, (import_budget, wall_budget) in BUDGETS.items():
+        runs = [measure(argv) for _ in range(max(args.repeat, 1))]
+        import_ms = min(r[0] for r in runs)
+        wall_ms = min(r[1] for r in runs)
+        heavy = runs[0][2]
+
+        import_budget *= args.scale
+        wall_budget *= args.scale
+        over = import_ms > import_budget or wall_ms > wall_budget or heavy
+        failed = failed or bool(over)
+
+        print(f"{' '.join(argv):<22} {import_ms:>12.1f} {import_budget:>8.0f} {wall_ms:>10.1f} {wall_budget:>8.0f}  "
+              f"{','.join(heavy) or '-'}{'  <- OVER BUDGET' if over else ''}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())